@@ -0,0 +1,156 @@
+"""
+Checkpoint journal for resuming load-csv
+
+Each batch committed is appended to the journal as a JSON line with its
+csv file, organization, row numbers and the position in the csv file
+(byte offset, row number) before which every row has been committed.
+Batches complete out of order when loading in parallel or from files
+partitioned by organization, so the position only advances past
+batches once all the batches before them are committed.
+
+Resuming seeks each csv file to its last position and skips the rows
+committed after it, so rows are never loaded twice.
+"""
+
+import os
+import json
+from bisect import bisect_right
+from collections import OrderedDict
+
+
+class CheckpointJournal(object):
+    """
+    Journal of load-csv batches committed, kept in file path. With
+    resume the batches already in path are read and new ones appended,
+    otherwise path is started over.
+    """
+    def __init__(self, path, resume=False):
+        self.files = {}
+        self.pending = {}
+        if not (resume and os.path.exists(path)):
+            self._f = open(path, 'wb')
+            return
+        self._f = open(path, 'r+b')
+        complete = 0
+        for line in self._f:
+            if not line.endswith('\n'):
+                break  # partly written when interrupted
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            self._read_entry(entry)
+            complete += len(line)
+        # drop any partly written entry so new ones start on a new line
+        self._f.seek(complete)
+        self._f.truncate()
+
+    def _read_entry(self, entry):
+        state = self._state(entry['file'])
+        if entry.get('complete'):
+            state['complete'] = True
+            return
+        if entry['position']:
+            state['position'] = tuple(entry['position'])
+        state['rows'].extend(tuple(r) for r in entry['rows'])
+
+    def _state(self, csv_path):
+        return self.files.setdefault(csv_path, {
+            'complete': False, 'position': None, 'rows': []})
+
+    def complete(self, csv_path):
+        """
+        True when every batch of csv_path was committed
+        """
+        return self._state(csv_path)['complete']
+
+    def position(self, csv_path):
+        """
+        (byte offset, row number) to resume csv_path from, or None
+        """
+        return self._state(csv_path)['position']
+
+    def skip_committed(self, csv_path, batches):
+        """
+        Generator of (org_name, records, rows, position) batches without
+        the rows committed after the position resumed from
+        """
+        state = self._state(csv_path)
+        first = state['position'][1] if state['position'] else 0
+        ranges = merge_ranges(r for r in state['rows'] if r[1] >= first)
+        starts = [r[0] for r in ranges]
+        for org_name, records, rows, position in batches:
+            keep = [
+                i for i, row in enumerate(rows)
+                if not _in_ranges(ranges, starts, row)]
+            if len(keep) < len(rows):
+                records = [records[i] for i in keep]
+                rows = [rows[i] for i in keep]
+            if records:
+                yield org_name, records, rows, position
+
+    def dispatch(self, csv_path, key, org_name, rows, position):
+        """
+        Record a batch, identified by key, that is about to be loaded.
+        Batches must be dispatched in the order they were read.
+        """
+        self.pending.setdefault(csv_path, OrderedDict())[key] = {
+            'org': org_name,
+            'rows': merge_ranges((r, r) for r in rows),
+            'position': position,
+            'done': False}
+
+    def commit(self, csv_path, key):
+        """
+        Write a dispatched batch to the journal once it is committed
+        """
+        pending = self.pending[csv_path]
+        batch = pending[key]
+        batch['done'] = True
+        state = self._state(csv_path)
+        while pending:
+            first = next(iter(pending.itervalues()))
+            if not first['done']:
+                break
+            pending.popitem(last=False)
+            if first['position']:
+                state['position'] = first['position']
+        self._write({
+            'file': csv_path,
+            'org': batch['org'],
+            'rows': batch['rows'],
+            'position': state['position']})
+
+    def finish(self, csv_path):
+        """
+        Record that every batch of csv_path was committed
+        """
+        self._state(csv_path)['complete'] = True
+        self._write({'file': csv_path, 'complete': True})
+
+    def close(self):
+        self._f.close()
+
+    def _write(self, entry):
+        self._f.write(json.dumps(entry) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+
+def merge_ranges(ranges):
+    """
+    Return a sorted list of [first, last] row ranges covering ranges,
+    with overlapping and adjacent ranges merged
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def _in_ranges(ranges, starts, row):
+    i = bisect_right(starts, row) - 1
+    return i >= 0 and row <= ranges[i][1]
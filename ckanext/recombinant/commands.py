@@ -7,7 +7,9 @@ Usage:
   paster recombinant create-triggers (-a | DATASET_TYPE ...) [-c CONFIG]
   paster recombinant update (-a | DATASET_TYPE ...) [-f] [-c CONFIG]
   paster recombinant delete (-a | DATASET_TYPE ...) [-c CONFIG]
-  paster recombinant load-csv CSV_FILE ... [-c CONFIG]
+  paster recombinant load-csv CSV_FILE ... [-n NAME] [-j N] [-r FILE]
+                             [--copy] [-b N] [-k FILE [--resume]]
+                             [-c CONFIG]
   paster recombinant combine (-a | RESOURCE_NAME ...) [-d DIR ] [-c CONFIG]
   paster recombinant target-datasets [-c CONFIG]
   paster recombinant dataset-types [DATASET_TYPE ...] [-c CONFIG]
@@ -19,17 +21,43 @@ Usage:
 Options:
   -h --help            Show this screen
   -a --all-types       All dataset types/resource names
+  -b --buffer-rows=N   Rows kept in memory while partitioning csv files
+                       not sorted by organization [default: 100000]
   -c --config=CONFIG   CKAN configuration file
   -d --output-dir=DIR  Save CSV files to DIR/RESOURCE_NAME.csv instead
                        of streaming to STDOUT
   -f --force-update    Force update of tables (required for changes
                        to only primary keys/indexes)
+  -j --jobs=N          Load organizations in N parallel processes
+                       [default: 1]
+  -k --checkpoint=FILE  Record batches loaded in FILE, a journal for
+                       resuming an interrupted load-csv
+  -n --resource-name=NAME  Load into resource NAME instead of the one
+                       named by CSV_FILE (NAME.csv, optionally
+                       compressed as NAME.csv.gz, .bz2 or .xz), required
+                       when CSV_FILE is - (STDIN)
+  -r --reject-file=FILE  Write rows that fail to load to FILE as JSON
+                       lines instead of to STDERR
+  --copy               Load each batch with PostgreSQL COPY and a single
+                       upsert statement instead of datastore_upsert
+  --resume             Continue after the batches recorded in the
+                       checkpoint FILE, appending to the reject file
+
+load-csv reads each CSV_FILE once. The datasets of its type are listed
+when the first organization is reached and missing datasets are created
+as their organizations are reached, so an organization without the
+resource is reported, and its rows skipped, only once its rows are read.
 """
 import os
 import csv
 import sys
+import time
+import zlib
+import Queue
 import logging
 import json
+import traceback
+import multiprocessing
 
 from ckan.lib.cli import CkanCommand
 from ckan.logic import ValidationError
@@ -40,13 +68,19 @@ import codecs
 from docopt import docopt
 
 from ckanext.recombinant.tables import (get_dataset_type_for_resource_name,
-    get_dataset_types, get_chromo, get_geno, get_target_datasets,
+    get_dataset_types, get_schema, get_geno, get_target_datasets,
     get_resource_names)
-from ckanext.recombinant.read_csv import csv_data_batch
-from ckanext.recombinant.write_excel import excel_template
+from ckanext.recombinant.read_csv import (csv_data_batch,
+    csv_resource_name, SPILL_BUFFER_ROWS, STDIN_PATH)
+from ckanext.recombinant.write_excel import save_excel_template
 from ckanext.recombinant.logic import _update_triggers
+from ckanext.recombinant.copy_load import copy_upsert
+from ckanext.recombinant.checkpoint import CheckpointJournal
 
 RECORDS_PER_ORGANIZATION = 1000000 # max records for single datastore query
+WORKER_QUEUE_BATCHES = 2 # csv batches waiting for each load-csv worker
+PACKAGE_SEARCH_ROWS = 1000 # datasets per package_search page
+LOAD_CHUNK_ROWS = 5000 # max records per load-csv datastore_upsert call
 
 class TableCommand(CkanCommand):
     summary = __doc__.split('\n')[0]
@@ -57,11 +91,19 @@ class TableCommand(CkanCommand):
     parser = paste.script.command.Command.standard_parser(verbose=True)
     parser.add_option('-a', '--all-types', action='store_true',
         dest='all_types', help='create all registered dataset types')
+    parser.add_option('-b', '--buffer-rows', dest='buffer_rows',
+        default='100000')
     parser.add_option('-c', '--config', dest='config',
         default='development.ini', help='Config file to use.')
     parser.add_option('-d', '--output-dir', dest='output_dir')
     parser.add_option('-f', '--force-update', action='store_true',
         dest='force_update', help='force update of tables')
+    parser.add_option('-j', '--jobs', dest='jobs', default='1')
+    parser.add_option('-k', '--checkpoint', dest='checkpoint')
+    parser.add_option('-n', '--resource-name', dest='resource_name')
+    parser.add_option('-r', '--reject-file', dest='reject_file')
+    parser.add_option('--copy', action='store_true', dest='copy')
+    parser.add_option('--resume', action='store_true', dest='resume')
 
     _orgs = None
 
@@ -85,7 +127,11 @@ class TableCommand(CkanCommand):
         elif opts['delete']:
             return self._delete(opts['DATASET_TYPE'])
         elif opts['load-csv']:
-            return self._load_csv_files(opts['CSV_FILE'])
+            return self._load_csv_files(
+                opts['CSV_FILE'], int(opts['--jobs']), opts['--reject-file'],
+                opts['--copy'], int(opts['--buffer-rows']),
+                opts['--checkpoint'], opts['--resume'],
+                opts['--resource-name'])
         elif opts['combine']:
             return self._combine_csv(
                 opts['--output-dir'], opts['RESOURCE_NAME'])
@@ -234,95 +280,105 @@ class TableCommand(CkanCommand):
                         pass
                 lc.action.package_delete(id=p['id'])
 
-    def _load_csv_files(self, csv_file_names):
+    def _load_csv_files(self, csv_file_names, jobs=1, reject_file_name=None,
+            copy=False, buffer_rows=SPILL_BUFFER_ROWS, checkpoint=None,
+            resume=False, resource_name=None):
         errs = 0
-        for n in csv_file_names:
-            errs |= self._load_one_csv_file(n)
+        journal = CheckpointJournal(checkpoint, resume) if checkpoint else None
+        reject_file = open(
+            reject_file_name, 'ab' if resume else 'wb'
+            ) if reject_file_name else None
+        try:
+            for n in csv_file_names:
+                errs |= self._load_one_csv_file(
+                    n, jobs, reject_file, copy, buffer_rows, journal,
+                    resource_name)
+        finally:
+            if reject_file:
+                reject_file.close()
+            if journal:
+                journal.close()
         return errs
 
-    def _load_one_csv_file(self, name):
-        path, csv_name = os.path.split(name)
-        assert csv_name.endswith('.csv'), csv_name
-        resource_name = csv_name[:-4]
+    def _load_one_csv_file(self, name, jobs=1, reject_file=None, copy=False,
+            buffer_rows=SPILL_BUFFER_ROWS, journal=None, resource_name=None):
+        resource_name = resource_name or csv_resource_name(name)
+        assert resource_name, 'use --resource-name for {0}'.format(name)
         print resource_name
-        chromo = get_chromo(resource_name)
+        chromo = get_schema(resource_name)
 
-        dataset_type = chromo['dataset_type']
-        method = 'upsert' if chromo.get('datastore_primary_key') else 'insert'
-        lc = LocalCKAN()
-        errors = 0
-
-        for org_name, records in csv_data_batch(name, chromo):
-            results = lc.action.package_search(
-                q='type:%s AND organization:%s' % (dataset_type, org_name),
-                include_private=True,
-                rows=2)['results']
-
-            if not results:
-                lc.action.recombinant_create(dataset_type=dataset_type, owner_org=org_name)
-                results = lc.action.package_search(
-                    q='type:%s AND organization:%s' % (dataset_type, org_name),
-                    include_private=True,
-                    rows=2)['results']
-
-            if len(results) > 1:
-                print 'type:%s organization:%s multiple found!' % (
-                    dataset_type, org_name)
-                return 1
-
-            for res in results[0]['resources']:
-                if res['name'] == resource_name:
-                    break
-            else:
-                print 'type:%s organization:%s missing resource:%s' % (
-                    dataset_type, org_name, resource_name)
-                return 1
-
-            # convert list values to lists
-            list_fields = [f['datastore_id']
-                for f in chromo['fields'] if f['datastore_type'] == '_text']
-            if list_fields:
-                for r in records:
-                    for k in list_fields:
-                        if not r[k]:
-                            r[k] = []
-                        else:
-                            r[k] = r[k].split(',')
-
-            print '-', org_name, len(records)
-
-            if 'csv_org_extras' in chromo:
-                # remove 'csv_org_extras' fields from records
-                for r in records:
-                    for e in chromo['csv_org_extras']:
-                        del r[e]
+        if name == STDIN_PATH and journal:
+            print 'STDIN can\'t be resumed, remove --checkpoint'
+            return 1
 
-            offset = 0
-            while offset < len(records):
+        # the file is only read once, so resolve each organization as
+        # it appears
+        resource_ids = LazyResourceIds(LocalCKAN(), chromo)
+        if name == STDIN_PATH:
+            return self._load_csv_batches(
+                resource_name, chromo, resource_ids,
+                csv_data_batch(
+                    name, chromo, positions=True, buffer_rows=buffer_rows),
+                jobs, reject_file, copy)
+
+        csv_path = os.path.abspath(name)
+        resume_at = None
+        if journal:
+            if journal.complete(csv_path):
+                print 'already loaded'
+                return 0
+            resume_at = journal.position(csv_path)
+            if resume_at:
+                print 'resuming from row {0}'.format(resume_at[1])
+
+        batches = csv_data_batch(
+            name, chromo, positions=True, buffer_rows=buffer_rows,
+            start=resume_at)
+        if journal:
+            batches = journal.skip_committed(csv_path, batches)
+        return self._load_csv_batches(
+            resource_name, chromo, resource_ids, batches, jobs, reject_file,
+            copy, journal, csv_path)
+
+    def _load_csv_batches(self, resource_name, chromo, resource_ids, batches,
+            jobs=1, reject_file=None, copy=False, journal=None,
+            csv_path=None):
+        stats = LoadStats()
+
+        if jobs > 1:
+            errors = _load_batches_parallel(
+                resource_name, resource_ids, batches, jobs, stats,
+                reject_file, copy, journal, csv_path)
+        else:
+            lc = LocalCKAN()
+            conn = _datastore_connection() if copy else None
+            errors = 0
+            failed = set()
+            for seq, (org_name, records, rows, position) in enumerate(batches):
+                print '-', org_name, len(records)
+                resource_id = resource_ids[org_name]
+                if resource_id is None or org_name in failed:
+                    errors |= 1
+                    continue
+                if journal:
+                    journal.dispatch(csv_path, seq, org_name, rows, position)
                 try:
-                    lc.action.datastore_upsert(
-                        method=method,
-                        resource_id=res['id'],
-                        records=records[offset:])
-                except ValidationError as err:
-                    if '_records_row' not in err.error_dict:
-                        raise
-                    bad = err.error_dict['_records_row']
-                    errors |= 2
-                    sys.stderr.write(json.dumps([
-                        err.error_dict['records'],
-                        org_name,
-                        records[offset + bad]]).encode('utf-8') + '\n')
-                    # retry records that passed validation
-                    good = records[offset: offset+bad]
-                    if good:
-                        lc.action.datastore_upsert(
-                            method=method,
-                            resource_id=res['id'],
-                            records=good)
-                    offset += bad + 1  # skip and continue
-                else:
-                    break
+                    err, rejects = _load_org_batch(
+                        lc, chromo, resource_id, org_name, records, rows,
+                        conn)
+                except Exception:
+                    traceback.print_exc()
+                    err, rejects = 1, []
+                _write_rejects(reject_file, resource_name, org_name, rejects)
+                if err & 1:
+                    failed.add(org_name)  # as workers do, see _load_worker
+                elif journal:
+                    journal.commit(csv_path, seq)
+                errors |= err
+                stats.add(org_name, len(records))
+        if journal and not errors & 1:
+            journal.finish(csv_path)
+        stats.report()
         return errors
 
     def _combine_csv(self, target_dir, resource_names):
@@ -342,7 +398,7 @@ class TableCommand(CkanCommand):
                 lc,
                 self._get_packages(
                     get_dataset_type_for_resource_name(resource_name), orgs),
-                get_chromo(resource_name),
+                get_schema(resource_name),
                 outf)
 
             if target_dir:
@@ -350,8 +406,7 @@ class TableCommand(CkanCommand):
 
     def _write_one_csv(self, lc, pkgs, chromo, outfile):
         out = unicodecsv.writer(outfile)
-        column_ids = [f['datastore_id'] for f in chromo['fields']
-            ] + chromo.get('csv_org_extras', []) + [
+        column_ids = list(chromo.field_ids) + chromo.get('csv_org_extras', []) + [
             'owner_org', 'owner_org_title']
         out.writerow(column_ids)
 
@@ -367,7 +422,7 @@ class TableCommand(CkanCommand):
             try:
                 result = lc.action.datastore_search(
                     limit=RECORDS_PER_ORGANIZATION,
-                    resource_id=res['id'],
+                    resource_id=resource_id,
                 )
                 records = result['records']
                 assert len(records) == result.get('total', 0), (chromo['resource_name'], pkg['owner_org'])
@@ -447,6 +502,399 @@ class TableCommand(CkanCommand):
     def _template(self, dataset_type, org_name, output_file):
         lc = LocalCKAN()
         org = lc.action.organization_show(id=org_name)
-        tmpl = excel_template(dataset_type, org)
-        with open(output_file, 'w') as out:
-            tmpl.save(out)
+        with open(output_file, 'wb') as out:
+            save_excel_template(dataset_type, org, out)
+
+
+class LoadStats(object):
+    """
+    Row and organization counts for load-csv throughput reporting
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.rows = 0
+        self.orgs = set()
+
+    def add(self, org_name, count):
+        self.rows += count
+        self.orgs.add(org_name)
+
+    def report(self):
+        elapsed = time.time() - self.start
+        print '{0} rows, {1} orgs in {2:.1f}s ({3:.0f} rows/s)'.format(
+            self.rows, len(self.orgs), elapsed,
+            self.rows / elapsed if elapsed else 0)
+
+
+def _resolve_resource_ids(lc, chromo, org_names, datasets=None):
+    """
+    Find the resource for chromo in every organization's dataset with
+    one search for all datasets of its type, creating the datasets
+    missing for org_names first. datasets, from _datasets_by_org, is
+    searched instead when given and updated with any datasets created.
+
+    :return: {org_name: resource id or None if not found}
+    """
+    dataset_type = chromo['dataset_type']
+    resource_name = chromo['resource_name']
+
+    if datasets is None:
+        datasets = _datasets_by_org(lc, dataset_type)
+    missing = sorted(set(org_names) - set(datasets))
+    for org_name in missing:
+        print 'type:%s organization:%s creating' % (dataset_type, org_name)
+        lc.action.recombinant_create(
+            dataset_type=dataset_type, owner_org=org_name)
+    if missing:
+        datasets.update(_datasets_by_org(lc, dataset_type))
+
+    resource_ids = {}
+    for org_name in org_names:
+        found = datasets.get(org_name, [])
+        resource_ids[org_name] = None
+        if len(found) != 1:
+            print 'type:%s organization:%s %d found!' % (
+                dataset_type, org_name, len(found))
+            continue
+        for res in found[0]['resources']:
+            if res['name'] == resource_name:
+                resource_ids[org_name] = res['id']
+                break
+        else:
+            print 'type:%s organization:%s missing resource:%s' % (
+                dataset_type, org_name, resource_name)
+    return resource_ids
+
+
+class LazyResourceIds(dict):
+    """
+    {org_name: resource id or None} like _resolve_resource_ids for a csv
+    file that is only read once, resolving each organization the first
+    time it is looked up
+    """
+    def __init__(self, lc, chromo):
+        super(LazyResourceIds, self).__init__()
+        self.lc = lc
+        self.chromo = chromo
+        self.datasets = None
+
+    def __missing__(self, org_name):
+        if self.datasets is None:
+            self.datasets = _datasets_by_org(
+                self.lc, self.chromo['dataset_type'])
+        resource_id = _resolve_resource_ids(
+            self.lc, self.chromo, [org_name], self.datasets)[org_name]
+        self[org_name] = resource_id
+        return resource_id
+
+
+def _datasets_by_org(lc, dataset_type):
+    """
+    return {org_name: [dataset, ...]} for all datasets of dataset_type
+    """
+    datasets = {}
+    start = 0
+    while True:
+        results = lc.action.package_search(
+            q='type:%s' % dataset_type,
+            include_private=True,
+            sort='id asc',
+            rows=PACKAGE_SEARCH_ROWS,
+            start=start)['results']
+        for d in results:
+            datasets.setdefault(d['organization']['name'], []).append(d)
+        if len(results) < PACKAGE_SEARCH_ROWS:
+            return datasets
+        start += PACKAGE_SEARCH_ROWS
+
+
+def _load_org_batch(lc, chromo, resource_id, org_name, records, rows,
+        conn=None):
+    """
+    Load records for one organization from a load-csv batch into
+    resource_id. rows are the csv row numbers of records
+
+    With conn, a datastore database connection, the batch is loaded
+    with copy_upsert. If that fails it is loaded again with
+    datastore_upsert to find the rows in error.
+
+    :return: (error flags, [(row number, error, record)] for rows that
+        failed)
+    """
+    method = 'upsert' if chromo.primary_key else 'insert'
+    list_fields = chromo.list_fields
+
+    # convert list values to lists
+    if list_fields:
+        for r in records:
+            for k in list_fields:
+                if not r[k]:
+                    r[k] = []
+                else:
+                    r[k] = r[k].split(',')
+
+    if 'csv_org_extras' in chromo:
+        # remove 'csv_org_extras' fields from records
+        for r in records:
+            for e in chromo['csv_org_extras']:
+                del r[e]
+
+    if conn is not None:
+        try:
+            copy_upsert(
+                conn, resource_id, chromo.field_ids, chromo.primary_key,
+                records)
+            return 0, []
+        except Exception as e:
+            conn.rollback()
+            print 'organization:%s COPY failed, using datastore_upsert: %s' % (
+                org_name, unicode(e).strip().encode('utf-8'))
+
+    rejects = []
+    for offset in range(0, len(records), LOAD_CHUNK_ROWS):
+        rejects.extend(_upsert_isolating_errors(
+            lc, method, resource_id,
+            records[offset:offset + LOAD_CHUNK_ROWS],
+            rows[offset:offset + LOAD_CHUNK_ROWS]))
+    return (2 if rejects else 0), rejects
+
+
+def _upsert_isolating_errors(lc, method, resource_id, records, rows):
+    """
+    datastore_upsert records, with csv row numbers rows, skipping the rows
+    that fail. A failing chunk is split around the row reported in
+    _records_row, or in half when no row is reported, until each bad row
+    is isolated, so a bad row costs O(log n) upsert calls. Earlier rows
+    are always upserted before later ones. Errors that aren't about
+    records, e.g. an unknown field, are raised.
+
+    :return: [(row number, error, record)] for the rows that failed
+    """
+    rejects = []
+    pending = [(0, len(records))]
+    while pending:
+        start, end = pending.pop()
+        if start >= end:
+            continue
+        try:
+            lc.action.datastore_upsert(
+                method=method,
+                resource_id=resource_id,
+                records=records[start:end])
+        except ValidationError as err:
+            if 'records' not in err.error_dict:
+                raise  # every chunk would fail the same way
+            bad = err.error_dict.get('_records_row')
+            if end - start == 1:
+                rejects.append(
+                    (rows[start], _upsert_error(err), records[start]))
+            elif bad is None:
+                half = (start + end) // 2
+                pending.append((half, end))
+                pending.append((start, half))
+            else:
+                # the failed call was rolled back: the rows before the bad
+                # row are resent as one chunk, and the rows after it in
+                # halves so rows after many bad rows aren't resent many
+                # times
+                bad += start
+                rejects.append((rows[bad], _upsert_error(err), records[bad]))
+                rest = bad + 1 + (end - bad) // 2
+                pending.append((rest, end))
+                pending.append((bad + 1, rest))
+                pending.append((start, bad))
+    rejects.sort(key=lambda r: r[0])
+    return rejects
+
+
+def _upsert_error(err):
+    """
+    the part of a datastore_upsert ValidationError describing the error
+    """
+    if 'records' in err.error_dict:
+        return err.error_dict['records']
+    if 'info' in err.error_dict:
+        return err.error_dict['info'].get('orig', err.error_dict['info'])
+    return err.error_dict
+
+
+def _write_rejects(reject_file, resource_name, org_name, rejects):
+    """
+    write load-csv rows that failed to reject_file as JSON lines, or to
+    stderr as [error, org_name, record] lines when reject_file is None
+    """
+    for row, error, record in rejects:
+        if reject_file:
+            reject_file.write(json.dumps({
+                'resource_name': resource_name,
+                'owner_org': org_name,
+                'row': row,
+                'error': error,
+                'record': record}) + '\n')
+        else:
+            sys.stderr.write(json.dumps([
+                error, org_name, record]).encode('utf-8') + '\n')
+
+
+def _load_batches_parallel(
+        resource_name, resource_ids, batches, jobs, stats, reject_file=None,
+        copy=False, journal=None, csv_path=None):
+    """
+    Load (org_name, records, row numbers, position) batches on jobs worker
+    processes into the resources in resource_ids, {org_name: resource id}
+    where batches for organizations with no resource id are skipped.
+    Rows that fail are written with _write_rejects and committed batches
+    are recorded in journal, a CheckpointJournal, under csv_path
+
+    Each organization is always sent to the same worker so its batches
+    are loaded in order, and its batches after one that fails fatally are
+    skipped. Results are reported as they arrive. A worker exiting
+    without finishing stops the load with the error flag set.
+
+    :return: error flags of all workers combined
+    """
+    # connections can't be shared with the workers, let them open their own
+    _dispose_engines()
+
+    tasks = [multiprocessing.Queue(WORKER_QUEUE_BATCHES) for i in range(jobs)]
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=_load_worker,
+            args=(resource_name, t, results, copy))
+        for t in tasks]
+    for w in workers:
+        w.start()
+
+    state = {'errors': 0, 'running': jobs}
+
+    def report(block):
+        try:
+            seq, org_name, count, err, rejects = results.get(block, 1)
+        except Queue.Empty:
+            if block and not any(w.is_alive() for w in workers):
+                state['errors'] |= 1  # a worker died without reporting
+                state['running'] = 0
+            return False
+        state['errors'] |= err
+        if org_name is None:
+            state['running'] -= 1
+        else:
+            print '-', org_name, count
+            _write_rejects(reject_file, resource_name, org_name, rejects)
+            if journal and not err & 1:
+                journal.commit(csv_path, seq)
+            stats.add(org_name, count)
+        return True
+
+    def put(i, task):
+        """
+        put task on worker i's queue, reporting results while it is
+        full. return False if the worker exits instead of taking it
+        """
+        while True:
+            try:
+                tasks[i].put(task, True, 1)
+                return True
+            except Queue.Full:
+                while report(False):
+                    pass
+                if not workers[i].is_alive():
+                    return False
+
+    try:
+        alive = True
+        for seq, (org_name, records, rows, position) in enumerate(batches):
+            resource_id = resource_ids[org_name]
+            if resource_id is None:
+                state['errors'] |= 1
+                continue
+            if journal:
+                journal.dispatch(csv_path, seq, org_name, rows, position)
+            alive = put(zlib.crc32(org_name.encode('utf-8')) % jobs,
+                (seq, org_name, resource_id, records, rows))
+            if not alive:
+                break
+            while report(False):
+                pass
+        alive = alive and all(put(i, None) for i in range(jobs))
+        while alive and state['running']:
+            report(True)
+        if not alive:
+            print 'a load-csv worker exited unexpectedly'
+            state['errors'] |= 1
+            for w in workers:
+                w.terminate()
+    except BaseException:
+        for w in workers:
+            w.terminate()
+        raise
+    finally:
+        for w in workers:
+            w.join()
+    return state['errors']
+
+
+def _load_worker(resource_name, tasks, results, copy=False):
+    """
+    load-csv worker process: load
+    (seq, org_name, resource_id, records, rows) batches
+    from the tasks queue until None is received, putting
+    (seq, org_name, record count, error flags, rejected rows) on the
+    results queue and (None, None, 0, error flags, []) when done
+    """
+    failed = set()
+    errors = 0
+    try:
+        lc = LocalCKAN()
+        conn = _datastore_connection() if copy else None
+        chromo = get_schema(resource_name)
+        for seq, org_name, resource_id, records, rows in iter(
+                tasks.get, None):
+            if org_name in failed:
+                continue
+            try:
+                err, rejects = _load_org_batch(
+                    lc, chromo, resource_id, org_name, records, rows, conn)
+            except Exception:
+                traceback.print_exc()
+                err, rejects = 1, []
+            if err & 1:
+                failed.add(org_name)  # keep later batches in order
+            results.put((seq, org_name, len(records), err, rejects))
+    except Exception:
+        traceback.print_exc()
+        errors = 1
+        for _task in iter(tasks.get, None):
+            pass  # don't block the parent
+    results.put((None, None, 0, errors, []))
+
+
+def _datastore_connection():
+    """
+    return a DB-API connection to the datastore database for writing
+    """
+    try:
+        from ckanext.datastore.backend.postgres import get_write_engine
+        engine = get_write_engine()
+    except ImportError:
+        from pylons import config
+        from ckanext.datastore.db import _get_engine
+        engine = _get_engine(
+            {'connection_url': config['ckan.datastore.write_url']})
+    return engine.raw_connection()
+
+
+def _dispose_engines():
+    """
+    close pooled database connections before starting worker processes
+    """
+    from ckan import model
+    model.Session.remove()
+    model.meta.engine.dispose()
+    try:
+        from ckanext.datastore.backend.postgres import _engines
+    except ImportError:
+        from ckanext.datastore.db import _engines
+    for engine in _engines.values():
+        engine.dispose()
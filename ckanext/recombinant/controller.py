@@ -3,30 +3,46 @@ from collections import OrderedDict
 import simplejson as json
 
 from logging import getLogger
+from gettext import NullTranslations
 
+from babel.support import Translations
 from pylons.i18n import _
-from pylons import config
-from paste.deploy.converters import asbool, aslist, aslist
+from pylons.i18n.translation import set_lang
+from pylons import config, translator
+from paste.deploy.converters import asbool, asint, aslist, aslist
 
 from ckan.lib.base import (c, render, model, request, h,
     response, abort)
 from ckan.controllers.package import PackageController
 from ckan.logic import ValidationError, NotAuthorized
+from ckan.plugins import PluginImplementations, ITranslation
 
 from ckanext.recombinant.errors import RecombinantException, BadExcelData
-from ckanext.recombinant.read_excel import read_excel, get_records
+from ckanext.recombinant.read_excel import get_record_chunks
+from ckanext.recombinant.read_xlsx import read_xlsx
+from ckanext.recombinant.read_csv import (
+    upload_format, read_csv_upload, read_ndjson_upload)
+from ckanext.recombinant.upload_jobs import (
+    get_upload_jobs, upload_async, QUEUED, RUNNING)
+from ckanext.recombinant.upload_diff import RecordDiff
+from ckanext.recombinant.validate import RecordValidator
 from ckanext.recombinant.write_excel import (
-    excel_template, excel_data_dictionary, append_data)
-from ckanext.recombinant.tables import get_chromo, get_geno
+    save_excel_template, excel_template_bytes, excel_data_dictionary)
+from ckanext.recombinant.tables import get_chromo, get_geno, get_schema
 from ckanext.recombinant.helpers import (
     recombinant_primary_key_fields, recombinant_choice_fields)
 
 from cStringIO import StringIO
+import tempfile
 
 log = getLogger(__name__)
 
 import ckanapi
 
+DEFAULT_UPLOAD_CHUNK_SIZE = 5000
+DEFAULT_UPLOAD_BLANK_ROWS = 1000
+DEFAULT_UPLOAD_MAX_ERRORS = 100
+
 
 class UploadController(PackageController):
     """
@@ -44,12 +60,26 @@ class UploadController(PackageController):
             if request.POST['xls_update'] == '':
                 raise BadExcelData('You must provide a valid file')
 
-            _process_upload_file(
+            if upload_async():
+                job_id = get_upload_jobs().submit(
+                    request.POST['xls_update'].file,
+                    process_upload_job,
+                    dataset_id=dataset['id'],
+                    user=c.user,
+                    dry_run=dry_run,
+                    filename=request.POST['xls_update'].filename,
+                    lang=h.lang())
+                return h.redirect_to(
+                    controller='ckanext.recombinant.controller:UploadController',
+                    action='upload_status', id=id, job_id=job_id)
+
+            counts = _process_upload_file(
                 lc,
                 dataset,
                 request.POST['xls_update'].file,
                 geno,
-                dry_run)
+                dry_run,
+                filename=request.POST['xls_update'].filename)
 
             if dry_run:
                 h.flash_success(_(
@@ -59,6 +89,10 @@ class UploadController(PackageController):
                 h.flash_success(_(
                     "Your file was successfully uploaded into the central system."
                     ))
+            if counts:
+                h.flash_notice(_(
+                    "{new} new rows, {updated} updated rows, "
+                    "{unchanged} unchanged rows").format(**counts))
 
             return h.redirect_to(controller='package', action='read', id=id)
         except BadExcelData, e:
@@ -66,7 +100,40 @@ class UploadController(PackageController):
             return self.preview_table(
                 resource_name=dataset['resources'][0]['name'],
                 owner_org=org['name'],
-                errors=[e.message])
+                errors=e.errors)
+
+    def upload_status(self, id, job_id):
+        job = self._upload_job(id, job_id)
+        return render('recombinant/upload_status.html', extra_vars={
+            'job': job,
+            'dataset_id': id,
+            'finished': job['status'] not in (QUEUED, RUNNING),
+            })
+
+    def upload_progress(self, id, job_id):
+        job = self._upload_job(id, job_id)
+        response.headers['Content-Type'] = 'application/json'
+        return json.dumps(dict(
+            (k, job[k]) for k in (
+                'id', 'status', 'dry_run', 'sheet', 'rows_parsed',
+                'rows_upserted', 'counts', 'errors')))
+
+    def _upload_job(self, id, job_id):
+        """
+        return the state of job_id if it was submitted by this user for
+        dataset id, otherwise abort with 404
+        """
+        job = get_upload_jobs().get(job_id)
+        if not job or job['user'] != c.user:
+            abort(404, _('Not found'))
+        lc = ckanapi.LocalCKAN(username=c.user)
+        try:
+            dataset = lc.action.package_show(id=id)
+        except ckanapi.NotFound:
+            abort(404, _('Not found'))
+        if dataset['id'] != job['dataset_id']:
+            abort(404, _('Not found'))
+        return job
 
     def delete_records(self, id, resource_id):
         lc = ckanapi.LocalCKAN(username=c.user)
@@ -195,8 +262,6 @@ class UploadController(PackageController):
         except ckanapi.NotFound:
             abort(404, _('Not found'))
 
-        book = excel_template(dataset_type, org)
-
         if request.method == 'POST':
             filters = {}
             resource_name = request.POST.get('resource_name','' )
@@ -209,7 +274,6 @@ class UploadController(PackageController):
 
             pk_fields = recombinant_primary_key_fields(resource['name'])
             primary_keys = request.POST.getall('bulk-template')
-            chromo = get_chromo(resource['name'])
             record_data = []
 
             for keys in primary_keys:
@@ -222,17 +286,20 @@ class UploadController(PackageController):
                     abort(403, _("Not authorized"))
                 record_data += result['records']
 
-            append_data(book, record_data, chromo)
+            blob = StringIO()
+            save_excel_template(
+                dataset_type, org, blob, {resource['name']: record_data})
+            data = blob.getvalue()
+        else:
+            data = excel_template_bytes(dataset_type, lang, org)
 
-        blob = StringIO()
-        book.save(blob)
         response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
         response.headers['Content-Disposition'] = (
             'inline; filename="{0}_{1}_{2}.xlsx"'.format(
                 dataset['owner_org'],
                 lang,
                 dataset['dataset_type']))
-        return blob.getvalue()
+        return data
 
 
     def data_dictionary(self, dataset_type):
@@ -403,9 +470,71 @@ class UploadController(PackageController):
             })
 
 
-def _process_upload_file(lc, dataset, upload_file, geno, dry_run):
+def process_upload_job(job_id):
     """
-    Use lc.action.datastore_upsert to load data from upload_file
+    Background job for an upload submitted with UploadJobs.submit,
+    processing is reported through the job's state file.
+    """
+    jobs = get_upload_jobs()
+    progress = jobs.progress(job_id)
+    state = progress.state
+    _push_translator(state['lang'])
+    try:
+        progress.start()
+        lc = ckanapi.LocalCKAN(username=state['user'])
+        dataset = lc.action.package_show(id=state['dataset_id'])
+        geno = get_geno(dataset['type'])
+        with open(jobs.upload_path(job_id), 'rb') as upload_file:
+            counts = _process_upload_file(
+                lc, dataset, upload_file, geno, state['dry_run'], progress,
+                state.get('filename'))
+        progress.complete(counts)
+    except BadExcelData as e:
+        progress.fail(*e.errors)
+    except Exception:
+        log.exception('upload job %s failed', job_id)
+        progress.fail(_(
+            "The server encountered a problem processing the file "
+            "uploaded."))
+    finally:
+        model.Session.remove()
+        translator._pop_object()
+
+
+def _push_translator(lang):
+    """
+    Register a translator for lang in this thread, as CKAN does for
+    web requests, so that job errors are in the user's language
+    """
+    if not lang or lang == 'en':
+        translator._push_object(NullTranslations())
+        return
+    t = set_lang(
+        lang, set_environ=False, pylons_config=config, class_=Translations)
+    for plugin in PluginImplementations(ITranslation):
+        if lang in plugin.i18n_locales():
+            t.merge(Translations.load(
+                plugin.i18n_directory(), [lang], plugin.i18n_domain()))
+    translator._push_object(t)
+
+
+def _process_upload_file(
+        lc, dataset, upload_file, geno, dry_run, progress=None, filename=None):
+    """
+    Use lc.action.datastore_upsert to load data from upload_file, an
+    Excel template, csv file or newline-delimited JSON file. filename
+    is used to choose the resource for csv and JSON files
+
+    progress is an upload_jobs.UploadProgress to update as the file
+    is processed, or None
+
+    With recombinant.upload_diff enabled only new and changed records are
+    sent for resources with a primary key, and the number of new, updated
+    and unchanged records is returned. Otherwise returns None.
+
+    Each sheet's records are validated locally with RecordValidator
+    before any are sent to the datastore, so that all the errors in a
+    sheet (up to recombinant.upload_max_errors) are reported at once.
 
     raises BadExcelData on errors.
     """
@@ -415,8 +544,16 @@ def _process_upload_file(lc, dataset, upload_file, geno, dry_run):
         (resource['name'], resource['id'])
         for resource in dataset['resources'])
 
-    upload_data = read_excel(upload_file)
+    chunk_size = asint(config.get(
+        'recombinant.upload_chunk_size', DEFAULT_UPLOAD_CHUNK_SIZE))
+    blank_rows = asint(config.get(
+        'recombinant.upload_blank_rows', DEFAULT_UPLOAD_BLANK_ROWS))
+    upload_diff = asbool(config.get('recombinant.upload_diff', False))
+    max_errors = asint(config.get(
+        'recombinant.upload_max_errors', DEFAULT_UPLOAD_MAX_ERRORS))
+    upload_data = _read_upload(upload_file, filename, dataset, blank_rows)
     total_records = 0
+    diffs = []
     while True:
         try:
             sheet_name, org_name, column_names, rows = next(upload_data)
@@ -443,7 +580,7 @@ def _process_upload_file(lc, dataset, upload_file, geno, dry_run):
                     '"/"'.join(sorted(expected_sheet_names)),
                     sheet_name))
 
-        if org_name != owner_org:
+        if org_name not in (owner_org, dataset['owner_org']):
             raise BadExcelData(_(
                 'Invalid sheet for this organization. ' +
                 'Sheet must be labeled for {0}, ' +
@@ -455,10 +592,8 @@ def _process_upload_file(lc, dataset, upload_file, geno, dry_run):
         while column_names and column_names[-1] is None:
             column_names.pop()
 
-        chromo = get_chromo(sheet_name)
-        expected_columns = [f['datastore_id'] for f in chromo['fields']
-            if f.get('import_template_include', True)]
-        if column_names != expected_columns:
+        schema = get_schema(sheet_name)
+        if tuple(column_names) != schema.template_ids:
             raise BadExcelData(
                 _("This template is out of date. "
                 "Please try copying your data into the latest "
@@ -466,51 +601,142 @@ def _process_upload_file(lc, dataset, upload_file, geno, dry_run):
                 "problem continues, send your Excel file to "
                 "open-ouvert@tbs-sct.gc.ca so we may investigate."))
 
-        pk = chromo.get('datastore_primary_key', [])
-        choice_fields = {
-            f['datastore_id']:
-                'full' if f.get('excel_full_text_choices') else True
-            for f in chromo['fields']
-            if ('choices' in f or 'choices_file' in f)}
-
-        records = get_records(
+        method = 'upsert' if schema.primary_key else 'insert'
+        resource_id = expected_sheet_names[sheet_name]
+        chunks = get_record_chunks(
             rows,
-            [f for f in chromo['fields'] if f.get('import_template_include', True)],
-            pk,
-            choice_fields)
-        method = 'upsert' if pk else 'insert'
-        total_records += len(records)
-        if not records:
+            schema.template_fields,
+            schema.primary_key_set,
+            schema.choice_fields,
+            chunk_size)
+        if progress:
+            progress.sheet(sheet_name)
+            chunks = progress.count_parsed(chunks)
+        validator = RecordValidator(schema, sheet_name, max_errors)
+        chunks = validator.checked_chunks(chunks)
+        if upload_diff and schema.primary_key:
+            diff = RecordDiff.from_datastore(lc, resource_id, schema)
+            diffs.append(diff)
+            chunks = diff.changed_chunks(chunks)
+        first = next(chunks, None)
+        if not first:
+            validator.raise_errors()
+            continue
+        second = next(chunks, None)
+        if not second:
+            validator.raise_errors()
+            total_records += len(first)
+            _upsert_records(
+                lc, resource_id, method, sheet_name, first, dry_run)
+            if progress and not dry_run:
+                progress.upserted(first)
             continue
+
+        # sheet larger than one chunk: validate all the chunks locally,
+        # then check them with dry_run before writing any of them, so
+        # that an error the database reports (e.g. from a trigger)
+        # doesn't leave part of the sheet loaded. Only a change made to
+        # the table between the passes can still fail part way. Records
+        # are spooled to disk between the passes to keep memory use
+        # independent of sheet length
+        spool = tempfile.TemporaryFile()
         try:
-            lc.action.datastore_upsert(
-                method=method,
-                resource_id=expected_sheet_names[sheet_name],
-                records=[r[1] for r in records],
-                dry_run=dry_run,
-                )
-        except ValidationError as e:
-            if 'info' in e.error_dict:
-                # because, where else would you put the error text?
-                # XXX improve this in datastore, please
-                pgerror = e.error_dict['info']['orig'][0].decode('utf-8')
-            else:
-                pgerror = e.error_dict['records'][0]
-            if isinstance(pgerror, dict):
-                pgerror = u'; '.join(
-                    k + u': ' + u', '.join(v)
-                    for k, v in pgerror.items())
-            else:
-                # remove some postgres-isms that won't help the user
-                # when we render this as an error in the form
-                pgerror = re.sub(ur'\nLINE \d+:', u'', pgerror)
-                pgerror = re.sub(ur'\n *\^\n$', u'', pgerror)
-            if '_records_row' in e.error_dict:
-                raise BadExcelData(_(u'Sheet {0} Row {1}:').format(
-                    sheet_name, records[e.error_dict['_records_row']][0])
-                    + u' ' + pgerror)
-            raise BadExcelData(
-                _(u"Error while importing data: {0}").format(
-                    pgerror))
-    if not total_records:
+            records, following = first, second
+            first = second = None
+            while records:
+                total_records += len(records)
+                spool.write(json.dumps(records) + '\n')
+                records = None
+                records, following = following or next(chunks, None), None
+            validator.raise_errors()
+            spool.seek(0)
+            for line in spool:
+                _upsert_records(
+                    lc, resource_id, method, sheet_name, json.loads(line),
+                    True)
+            if not dry_run:
+                spool.seek(0)
+                for line in spool:
+                    records = json.loads(line)
+                    _upsert_records(
+                        lc, resource_id, method, sheet_name, records, False)
+                    if progress:
+                        progress.upserted(records)
+        finally:
+            spool.close()
+    unchanged = sum(d.unchanged for d in diffs)
+    if not total_records and not unchanged:
         raise BadExcelData(_("The template uploaded is empty"))
+    if diffs:
+        return {
+            'new': sum(d.new for d in diffs),
+            'updated': sum(d.updated for d in diffs),
+            'unchanged': unchanged,
+            }
+
+
+def _read_upload(upload_file, filename, dataset, blank_rows):
+    """
+    Return a read_excel-style generator for upload_file based on its
+    contents. csv and JSON files are loaded into the resource they are
+    named after, e.g. "ati.csv", or the dataset's only resource.
+    """
+    upload_type = upload_format(upload_file)
+    if upload_type == 'xlsx':
+        return read_xlsx(upload_file, blank_rows)
+
+    resource_names = [r['name'] for r in dataset['resources']]
+    resource_name = re.split(r'[\\/]', filename or '')[-1].split('.')[0]
+    if resource_name not in resource_names:
+        if not resource_names:
+            raise BadExcelData(_(
+                'This dataset has no resources to load the file into'))
+        if len(resource_names) != 1:
+            raise BadExcelData(_(
+                'Name the file uploaded after the data type, '
+                'e.g. "{0}.csv"').format(resource_names[0]))
+        resource_name = resource_names[0]
+
+    schema = get_schema(resource_name)
+    if upload_type == 'ndjson':
+        return read_ndjson_upload(upload_file, schema)
+    return read_csv_upload(upload_file, schema)
+
+
+def _upsert_records(lc, resource_id, method, sheet_name, records, dry_run):
+    """
+    Use lc.action.datastore_upsert to load records, a list of
+    (row number, record) from sheet_name
+
+    raises BadExcelData on errors.
+    """
+    try:
+        lc.action.datastore_upsert(
+            method=method,
+            resource_id=resource_id,
+            records=[r[1] for r in records],
+            dry_run=dry_run,
+            )
+    except ValidationError as e:
+        if 'info' in e.error_dict:
+            # because, where else would you put the error text?
+            # XXX improve this in datastore, please
+            pgerror = e.error_dict['info']['orig'][0].decode('utf-8')
+        else:
+            pgerror = e.error_dict['records'][0]
+        if isinstance(pgerror, dict):
+            pgerror = u'; '.join(
+                k + u': ' + u', '.join(v)
+                for k, v in pgerror.items())
+        else:
+            # remove some postgres-isms that won't help the user
+            # when we render this as an error in the form
+            pgerror = re.sub(ur'\nLINE \d+:', u'', pgerror)
+            pgerror = re.sub(ur'\n *\^\n$', u'', pgerror)
+        if '_records_row' in e.error_dict:
+            raise BadExcelData(_(u'Sheet {0} Row {1}:').format(
+                sheet_name, records[e.error_dict['_records_row']][0])
+                + u' ' + pgerror)
+        raise BadExcelData(
+            _(u"Error while importing data: {0}").format(
+                pgerror))
@@ -0,0 +1,139 @@
+"""
+Bulk loading into datastore tables with PostgreSQL COPY
+
+Records are streamed into a temporary table with COPY FROM STDIN and
+merged into the datastore table with a single INSERT .. SELECT, with
+ON CONFLICT .. DO UPDATE on the primary key. Row triggers on the
+datastore table fire for every inserted or updated row, as they do for
+datastore_upsert.
+
+Only a DB-API connection (psycopg2) is needed, so this may be tested
+against any PostgreSQL 9.5+ database.
+"""
+
+COPY_TABLE = 'recombinant_copy'
+COPY_READ_SIZE = 65536
+FULL_TEXT_COLUMN = '_full_text'
+
+
+def copy_upsert(conn, table, field_ids, primary_key, records):
+    """
+    Load records, a list of dicts keyed by field id, into datastore
+    table with COPY and commit. With a primary_key (list of field ids)
+    existing rows are updated and only the last record for each key
+    is loaded, otherwise records are inserted.
+
+    Errors are raised by the database driver, the transaction is left
+    for the caller to roll back.
+
+    :return: number of records loaded
+    """
+    cur = conn.cursor()
+    cur.execute(
+        'SELECT column_name FROM information_schema.columns '
+        'WHERE table_schema = current_schema() AND table_name = %s',
+        (table,))
+    columns = set(row[0] for row in cur.fetchall())
+    if not columns:
+        raise ValueError('table not found: {0}'.format(table))
+    fields = [f for f in field_ids if f in columns]
+    cols = u', '.join(identifier(f) for f in fields)
+
+    if primary_key:
+        records = last_for_each_key(records, primary_key)
+
+    cur.execute(
+        u'CREATE TEMP TABLE {tmp} ON COMMIT DROP AS '
+        u'SELECT {cols} FROM {table} LIMIT 0'.format(
+            tmp=COPY_TABLE, cols=cols, table=identifier(table)))
+    cur.copy_expert(
+        u'COPY {tmp} ({cols}) FROM STDIN'.format(tmp=COPY_TABLE, cols=cols),
+        CopyStream(records, fields))
+
+    insert_cols = cols
+    select_cols = cols
+    if FULL_TEXT_COLUMN in columns:
+        # as datastore_upsert fills it: the text of every value
+        insert_cols += u', ' + FULL_TEXT_COLUMN
+        select_cols += u", to_tsvector(concat_ws(' ', {0}))".format(
+            u', '.join(u'{0}::text'.format(identifier(f)) for f in fields))
+    sql = u'INSERT INTO {table} ({insert_cols}) SELECT {select_cols} ' \
+        u'FROM {tmp}'.format(
+            table=identifier(table), insert_cols=insert_cols,
+            select_cols=select_cols, tmp=COPY_TABLE)
+    if primary_key:
+        update = [f for f in fields if f not in primary_key]
+        if FULL_TEXT_COLUMN in columns:
+            update.append(FULL_TEXT_COLUMN)
+        sql += u' ON CONFLICT ({key}) DO {action}'.format(
+            key=u', '.join(identifier(k) for k in primary_key),
+            action=(u'UPDATE SET ' + u', '.join(
+                u'{0} = EXCLUDED.{0}'.format(identifier(f))
+                for f in update)) if update else u'NOTHING')
+    cur.execute(sql)
+    conn.commit()
+    return len(records)
+
+
+def last_for_each_key(records, primary_key):
+    """
+    return records without those followed by a record with the same
+    primary key, which datastore_upsert would have overwritten
+    """
+    last = {}
+    for i, r in enumerate(records):
+        last[tuple(r.get(k) for k in primary_key)] = i
+    if len(last) == len(records):
+        return records
+    return [
+        r for i, r in enumerate(records)
+        if last[tuple(r.get(k) for k in primary_key)] == i]
+
+
+def identifier(name):
+    """
+    quoted SQL identifier
+    """
+    return u'"' + name.replace(u'"', u'""') + u'"'
+
+
+def copy_value(value):
+    """
+    value in COPY text format: \\N for None, arrays for lists
+    """
+    if value is None:
+        return u'\\N'
+    if isinstance(value, list):
+        value = u'{' + u','.join(
+            u'"' + unicode(v).replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+            + u'"' for v in value) + u'}'
+    else:
+        value = unicode(value)
+    return (value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+        .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+
+class CopyStream(object):
+    """
+    file-like object producing records as COPY text format lines
+    """
+    def __init__(self, records, fields):
+        self._lines = (
+            (u'\t'.join(copy_value(r.get(f)) for f in fields) + u'\n'
+                ).encode('utf-8')
+            for r in records)
+        self._buffer = b''
+
+    def read(self, size=COPY_READ_SIZE):
+        if size is None or size < 0:
+            size = COPY_READ_SIZE
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            if length >= size:
+                break
+        data = b''.join(chunks)
+        self._buffer = data[size:]
+        return data[:size]
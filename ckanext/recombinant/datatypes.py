@@ -5,6 +5,11 @@ from decimal import Decimal, InvalidOperation
 
 from ckanext.recombinant.errors import BadExcelData
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # Codifies data store types available in recombinant-tables JSON
 # specification:
@@ -33,6 +38,16 @@ datastore_type = {
 }
 
 
+# text that is already a canonical whole number, e.g. from csv uploads
+WHOLE_NUMBER_RE = re.compile(u'^(-?[1-9][0-9]*|0)\Z')
+# characters dropped from numbers, e.g. "$1,000.50" or "1 000,50 $"
+NUMBER_FILLER_RE = re.compile(r'[$,\s]')
+# accidental control characters removed from primary key values
+CONTROL_CHARS_RE = re.compile(u'[\x00-\x1f]')
+# column value types handled by _whole_number_column
+FLOAT_OR_BLANK = frozenset([float, type(None)])
+
+
 def canonicalize(
         dirty, dstore_tag, primary_key, choice_field=False):
     """
@@ -59,66 +74,170 @@ def canonicalize(
 
     Raises BadExcelData on formula cells
     """
+    return canonicalizer(dstore_tag, primary_key, choice_field)(dirty)
+
+
+def canonicalizer(dstore_tag, primary_key, choice_field=False):
+    """
+    Return a function f(dirty) equivalent to
+    canonicalize(dirty, dstore_tag, primary_key, choice_field) with the
+    checks that depend only on the column made once, for canonicalizing
+    many values from the same column.
+    """
     dtype = datastore_type[dstore_tag]
 
+    if dstore_tag == '_text':
+        def canonicalize_list(dirty):
+            dirty = unicode(_blank_or_formula(dirty))
+            if not dirty.strip():
+                return []
+            return [s.strip() for s in dirty.split(',')]
+        return canonicalize_list
+
+    blank = u'' if dstore_tag == 'text' or primary_key else None
+
+    def canonicalize_text(dirty):
+        dirty = unicode(dirty)
+
+        if choice_field == 'full':  # "code:full-text" style, just need code
+            dirty = dirty.split(':')[0].strip()
+        elif choice_field:
+            dirty = dirty.strip()
+
+        # accidental control characters and whitespace around primary keys
+        # leads to unpleasantness
+        if primary_key:
+            dirty = CONTROL_CHARS_RE.sub('', dirty.strip())
+
+        if not dirty:
+            return blank
+        return dirty
+
+    if dtype.whole_number:
+        def canonicalize_whole_number(dirty):
+            dirty = _blank_or_formula(dirty)
+            if type(dirty) in (int, long):
+                return unicode(dirty)
+            if type(dirty) is float:
+                # same digits as Decimal(unicode(dirty)) // 1 without the
+                # (slow) Decimal arithmetic
+                text = unicode(dirty)
+                if text.endswith(u'.0') and u'e' not in text:
+                    return text[:-2]
+            elif isinstance(dirty, unicode):
+                if not dirty:
+                    return blank  # Decimal(u'') is never valid
+                if WHOLE_NUMBER_RE.match(dirty):
+                    return dirty
+            try:
+                d = Decimal(NUMBER_FILLER_RE.sub('', unicode(dirty)))
+                if not d % 1:  # truncate trailing .00's
+                    return unicode(d // 1)
+            except InvalidOperation:
+                pass
+            return canonicalize_text(dirty)
+        return canonicalize_whole_number
+
+    if dstore_tag == 'money':
+        # User has overridden Excel format string, probably adding currency
+        # markers or digit group separators (e.g.,fr-CA uses 1$ (not $1)).
+        # Accept only "DDDDD.DD", discard other characters
+        def canonicalize_money(dirty):
+            dirty = _blank_or_formula(dirty)
+            if type(dirty) in (int, long):
+                return unicode(dirty)
+            if type(dirty) is float:
+                text = unicode(dirty)
+                if u'e' not in text and u'n' not in text:  # not inf, nan
+                    return text
+            elif isinstance(dirty, unicode) and not dirty:
+                return blank
+            try:
+                return unicode(
+                    Decimal(NUMBER_FILLER_RE.sub('', unicode(dirty))))
+            except InvalidOperation:
+                pass
+            return canonicalize_text(dirty)
+        return canonicalize_money
+
+    if dstore_tag == 'date':
+        def canonicalize_date(dirty):
+            dirty = _blank_or_formula(dirty)
+            if isinstance(dirty, datetime):
+                return u'%04d-%02d-%02d' % (dirty.year, dirty.month, dirty.day)
+            return canonicalize_text(dirty)
+        return canonicalize_date
+
+    return lambda dirty: canonicalize_text(_blank_or_formula(dirty))
+
+
+def canonicalize_column(values, dstore_tag, primary_key, choice_field=False):
+    """
+    Canonicalize a whole column of dirty input, returning the same list
+    as [canonicalize(v, dstore_tag, primary_key, choice_field)
+    for v in values]
+
+    Whole number columns containing only floats and blank cells are
+    converted with NumPy when it is installed and datetimes in date
+    columns are formatted in bulk. Other values are canonicalized one
+    at a time.
+
+    Raises BadExcelData on formula cells
+    """
+    canon = canonicalizer(dstore_tag, primary_key, choice_field)
+    values = list(values)
+
+    if (numpy is not None and datastore_type[dstore_tag].whole_number
+            and set(map(type, values)) <= FLOAT_OR_BLANK):
+        return _whole_number_column(values, canon)
+
+    if dstore_tag == 'date':
+        return [
+            u'%04d-%02d-%02d' % (v.year, v.month, v.day)
+            if type(v) is datetime else canon(v)
+            for v in values]
+
+    return [canon(v) for v in values]
+
+
+def _whole_number_column(values, canon):
+    """
+    canonicalize a list of floats and Nones with NumPy
+
+    Whole numbers below 1e12 are formatted by unicode() without an
+    exponent, so they canonicalize to the digits of the integer value.
+    Blanks and other floats use canon.
+    """
+    floats = numpy.array(values, dtype=numpy.float64)  # None -> nan
+    with numpy.errstate(invalid='ignore'):
+        whole = (floats == numpy.floor(floats)) & (numpy.abs(floats) < 1e12)
+    out = numpy.where(whole, floats, 0).astype(numpy.int64).astype(
+        numpy.unicode_).astype(object)
+    out[whole & (floats == 0) & numpy.signbit(floats)] = u'-0'
+    for i in numpy.flatnonzero(~whole).tolist():
+        out[i] = canon(values[i])
+    return out.tolist()
+
+
+def _blank_or_formula(dirty):
+    """
+    Return u"" for blank and whitespace-only cells, replace Excel
+    boolean functions with their values and raise BadExcelData on
+    other formula cells
+    """
     if dirty is None:
         # use common value for blank cells
-        dirty = u""
+        return u""
 
     if isinstance(dirty, basestring):
         if not dirty.strip():
             # whitespace-only values
-            dirty = u""
+            return u""
         # excel, you keep being you
         if dirty == u'=FALSE()':
-            dirty = u'FALSE'
+            return u'FALSE'
         elif dirty == u'=TRUE()':
-            dirty = u'TRUE'
+            return u'TRUE'
         if dirty.startswith('='):
             raise BadExcelData('Formulas are not supported')
-
-    if dstore_tag == '_text':
-        dirty = unicode(dirty)
-        if not dirty.strip():
-            return []
-        return [s.strip() for s in unicode(dirty).split(',')]
-
-    if dtype.whole_number:
-        canon = re.sub(r'[$,\s]', '', unicode(dirty))
-        try:
-            d = Decimal(canon)
-            if not d % 1:  # truncate trailing .00's
-                return unicode(d // 1)
-        except InvalidOperation:
-            pass
-
-    if dstore_tag == 'money':
-        # User has overridden Excel format string, probably adding currency
-        # markers or digit group separators (e.g.,fr-CA uses 1$ (not $1)).
-        # Accept only "DDDDD.DD", discard other characters
-        canon = re.sub(r'[$,\s]', '', unicode(dirty))
-        try:
-            d = Decimal(canon)
-            return unicode(d)
-        except InvalidOperation:
-            pass
-
-    if dstore_tag == 'date' and isinstance(dirty, datetime):
-        return u'%04d-%02d-%02d' % (dirty.year, dirty.month, dirty.day)
-
-    dirty = unicode(dirty)
-
-    if choice_field == 'full':  # "code:full-text" style, just need code
-        dirty = dirty.split(':')[0].strip()
-    elif choice_field:
-        dirty = dirty.strip()
-
-    # accidental control characters and whitespace around primary keys
-    # leads to unpleasantness
-    if primary_key:
-        dirty = dirty.strip()
-        dirty = re.sub(u'[\x00-\x1f]', '', dirty)
-
-    if dstore_tag != 'text' and not primary_key and not dirty:
-        return None
     return dirty
@@ -3,5 +3,6 @@ class RecombinantException(Exception):
     pass
 
 class BadExcelData(Exception):
-    def __init__(self, message):
+    def __init__(self, message, errors=None):
         self.message = message
+        self.errors = errors or [message]
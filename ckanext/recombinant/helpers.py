@@ -6,7 +6,8 @@ from pylons.i18n import gettext
 import ckanapi
 from ckan.lib.helpers import lang
 
-from ckanext.recombinant.tables import get_chromo, get_geno, get_dataset_types
+from ckanext.recombinant.tables import (
+    get_chromo, get_schema, get_geno, get_dataset_types)
 from ckanext.recombinant.errors import RecombinantException
 from ckanext.recombinant import load
 
@@ -73,13 +74,10 @@ def recombinant_get_types():
 
 def recombinant_primary_key_fields(resource_name):
     try:
-        chromo = get_chromo(resource_name)
+        schema = get_schema(resource_name)
     except RecombinantException:
         return []
-    return [
-        f for f in chromo['fields']
-        if f['datastore_id'] in chromo['datastore_primary_key']
-        ]
+    return list(schema.primary_key_fields)
 
 def recombinant_example(resource_name, doc_type, indent=2, lang='json'):
     """
@@ -182,7 +180,8 @@ def recombinant_get_field(resource_name, datastore_id):
     """
     Return field info from resource name and datastore column id
     """
-    chromo = recombinant_get_chromo(resource_name)
-    for f in chromo['fields']:
-        if f['datastore_id'] == datastore_id:
-            return f
+    try:
+        schema = get_schema(resource_name)
+    except RecombinantException:
+        return None
+    return schema.field_by_id.get(datastore_id)
@@ -9,6 +9,7 @@ import ckan.plugins as p
 from ckan.lib.plugins import DefaultDatasetForm, DefaultTranslation
 
 from ckanext.recombinant import logic, tables, helpers, load
+from ckanext.recombinant.schema import compile_schemas
 
 class RecombinantException(Exception):
     pass
@@ -35,7 +36,7 @@ class RecombinantPlugin(
         if not self._tables_urls:
             raise RecombinantException("Missing configuration option "
                 "recombinant.definitions")
-        self._chromos, self._genos = (
+        self._chromos, self._genos, self._schemas = (
             _load_table_definitions(self._tables_urls))
 
     def package_types(self):
@@ -59,6 +60,14 @@ class RecombinantPlugin(
         map.connect('/recombinant/upload/{id}', action='upload',
             conditions=dict(method=['POST']),
             controller='ckanext.recombinant.controller:UploadController')
+        map.connect('recombinant_upload_progress',
+            '/recombinant/upload/{id}/job/{job_id}.json',
+            action='upload_progress',
+            controller='ckanext.recombinant.controller:UploadController')
+        map.connect('recombinant_upload_status',
+            '/recombinant/upload/{id}/job/{job_id}',
+            action='upload_status',
+            controller='ckanext.recombinant.controller:UploadController')
         map.connect('/recombinant/delete/{id}/{resource_id}',
             action='delete_records',
             conditions=dict(method=['POST']),
@@ -143,7 +152,7 @@ def _load_table_definitions(urls):
                 chromo['_path'] = os.path.split(p)[0]
             chromos[chromo['resource_name']] = chromo
 
-    return chromos, genos
+    return chromos, genos, compile_schemas(chromos)
 
 
 def _load_tables_module_path(url):
@@ -1,58 +1,462 @@
-from unicodecsv import DictReader
+from unicodecsv import DictReader, reader, Error as CSVError
+import bz2
 import codecs
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from itertools import chain
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from ckanext.recombinant.schema import resource_schema
+from ckanext.recombinant.errors import BadExcelData
 
 BATCH_SIZE = 15000
+XLSX_MAGIC = 'PK\x03\x04'
+SNIFF_BYTES = 1024
+ORG_COLUMNS = ('owner_org', 'owner_org_title')
+CSV_FIRST_ROW = 2 # row number of the first record, after the header
+SPILL_BUFFER_ROWS = 100000
+MAX_OPEN_SPILL_FILES = 64
+STDIN_PATH = '-'
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.xz')
 
-def csv_data_batch(csv_path, chromo, strict=True):
+def csv_data_batch(csv_path, chromo, strict=True, positions=False,
+        buffer_rows=SPILL_BUFFER_ROWS, start=None):
     """
     Generator of dataset records from csv file
 
+    csv_path may be '-' for stdin or a file compressed with gzip, bzip2
+    or xz, see open_csv.
+
+    Files sorted by organization are read in a single pass. When an
+    organization appears again after rows for another organization the
+    rest of the file is partitioned by organization into temporary
+    files, keeping at most buffer_rows rows in memory, and then read
+    back one organization at a time. Records for each organization are
+    always produced in file order.
+
+    A batch's position is (byte offset, row number) just after its last
+    record, which may be passed as start to continue reading from there.
+    Batches read back from partitioned files have no position (None).
+
     :param csv_path: file to parse
     :param chromo: recombinant resource definition
     :param strict: True to fail on header mismatch
+    :param positions: True to include csv row numbers and the position
+                      of each batch
+    :param buffer_rows: rows kept in memory while partitioning
+    :param start: position to continue reading from, or None
 
     :return a batch of records for at most one organization
     :rtype: dict mapping at most one org-id to
-            at most BATCH_SIZE (dict) records
+            at most BATCH_SIZE (dict) records, then a list of their
+            csv row numbers and the batch position when positions is True
+    """
+    batches = _csv_org_batches(csv_path, chromo, strict, buffer_rows, start)
+    if positions:
+        return batches
+    return ((org, records) for org, records, rows, position in batches)
+
+
+def _csv_org_batches(csv_path, chromo, strict, buffer_rows, start):
+    """
+    Generator of (owner_org, records, row numbers, position) for
+    csv_data_batch
     """
+    schema = resource_schema(chromo)
     records = []
+    rows = []
+    position = None
     current_owner_org = None
+    finished_orgs = set()
+    partition = None
 
-    with open(csv_path, 'rb') as f:
-        first3bytes = f.read(3)
-        if first3bytes != codecs.BOM_UTF8:
-            f.seek(0)
-
-        csv_in = DictReader(f)
+    with open_csv(csv_path) as f:
+        lines, csv_lines = _csv_lines(f, start)
+        csv_in = DictReader(csv_lines)
         cols = [
             f for f in csv_in.unicode_fieldnames
             if f not in chromo.get('csv_org_extras', [])]
 
         if strict:
-            expected = [f['datastore_id'] for f in chromo['fields']
-                ] + ['owner_org', 'owner_org_title']
+            expected = list(schema.field_ids) + ['owner_org', 'owner_org_title']
             assert cols == expected, 'column mismatch:\n{0}\n{1}'.format(
                 cols, expected)
 
-        none_fields = [f['datastore_id'] for f in chromo['fields']
-            if f['datastore_type'] != 'text']
-
-        for row_dict in csv_in:
-            owner_org = row_dict.pop('owner_org')
-            owner_org_title = row_dict.pop('owner_org_title')
-            if owner_org != current_owner_org:
-                if records:
-                    yield (current_owner_org, records)
-                records = []
-                current_owner_org = owner_org
-
-            for f_id in none_fields:
-                if not row_dict.get(f_id, ''):
-                    row_dict[f_id] = None
-
-            records.append(row_dict)
-            if len(records) >= BATCH_SIZE:
-                yield (current_owner_org, records)
-                records = []
+        none_fields = [fid for fid in schema.field_ids
+            if schema.datastore_types[fid] != 'text']
+
+        try:
+            first_row = start[1] if start else CSV_FIRST_ROW
+            for row, row_dict in enumerate(csv_in, first_row):
+                owner_org = row_dict.pop('owner_org')
+                owner_org_title = row_dict.pop('owner_org_title')
+
+                for f_id in none_fields:
+                    if not row_dict.get(f_id, ''):
+                        row_dict[f_id] = None
+
+                if partition is not None:
+                    partition.add(owner_org, row, row_dict)
+                    continue
+
+                if owner_org != current_owner_org:
+                    if owner_org in finished_orgs:
+                        # not sorted by organization, partition the rest
+                        partition = OrgPartition(buffer_rows)
+                        for r, record in zip(rows, records):
+                            partition.add(current_owner_org, r, record)
+                        partition.add(owner_org, row, row_dict)
+                        records = []
+                        rows = []
+                        continue
+                    if records:
+                        yield (current_owner_org, records, rows, position)
+                    finished_orgs.add(current_owner_org)
+                    records = []
+                    rows = []
+                    current_owner_org = owner_org
+
+                records.append(row_dict)
+                rows.append(row)
+                position = (lines.offset, row + 1)
+                if len(records) >= BATCH_SIZE:
+                    yield (current_owner_org, records, rows, position)
+                    records = []
+                    rows = []
+
+            if partition is not None:
+                for owner_org, p_records, p_rows in partition.batches():
+                    yield (owner_org, p_records, p_rows, None)
+        finally:
+            if partition is not None:
+                partition.close()
     if records:
-        yield (current_owner_org, records)
+        yield (current_owner_org, records, rows, position)
+
+
+class CountingLines(object):
+    """
+    Lines of file object f, counting the bytes read in self.offset so
+    that there is a position to seek to between csv records, which may
+    span lines
+    """
+    def __init__(self, f, offset=0):
+        self.f = f
+        self.offset = offset
+
+    def __iter__(self):
+        for line in self.f:
+            self.offset += len(line)
+            yield line
+
+    def seek(self, offset):
+        """
+        continue from byte offset, dropping f's read-ahead buffer
+        """
+        self.f.seek(offset)
+        self.offset = offset
+
+
+def _csv_lines(f, start=None):
+    """
+    Skip any BOM in csv file object f and return (CountingLines,
+    iterator of the header line then the record lines) continuing after
+    the header from byte offset start[0] when start is given.
+
+    f is only read forward unless start is given, so it may be a pipe.
+    """
+    head = f.read(len(codecs.BOM_UTF8))
+    if head == codecs.BOM_UTF8:
+        lines = CountingLines(f, len(head))
+        header = f.readline()
+    else:
+        lines = CountingLines(f)
+        header = head + f.readline()
+    lines.offset += len(header)
+    if start:
+        lines.seek(start[0])
+    return lines, chain([header] if header else [], lines)
+
+
+def open_csv(csv_path):
+    """
+    Return a file object for reading csv_path: '-' for stdin, and files
+    ending with .gz, .bz2 or .xz are decompressed as they are read.
+    xz requires the lzma module (backports.lzma on python 2).
+    """
+    if csv_path == STDIN_PATH:
+        # a separate file object so closing it leaves sys.stdin open
+        return os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    if csv_path.endswith('.gz'):
+        return gzip.open(csv_path, 'rb')
+    if csv_path.endswith('.bz2'):
+        return bz2.BZ2File(csv_path, 'rb')
+    if csv_path.endswith('.xz'):
+        if lzma is None:
+            raise ValueError(
+                'reading {0} requires the lzma module, install '
+                'backports.lzma'.format(csv_path))
+        return lzma.LZMAFile(csv_path, 'rb')
+    return open(csv_path, 'rb')
+
+
+def csv_resource_name(csv_path):
+    """
+    Return the resource name for csv file csv_path, e.g. "ati" for
+    "path/ati.csv" or "ati.csv.gz", or None if the name doesn't end
+    with .csv
+    """
+    name = os.path.basename(csv_path)
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    if name.endswith('.csv'):
+        return name[:-len('.csv')]
+
+
+class OrgPartition(object):
+    """
+    Rows grouped by organization in temporary files, one per
+    organization. At most buffer_rows rows are kept in memory and at
+    most max_open_files files are kept open.
+    """
+    def __init__(self, buffer_rows=SPILL_BUFFER_ROWS,
+            max_open_files=MAX_OPEN_SPILL_FILES):
+        self.buffer_rows = buffer_rows
+        self.max_open_files = max_open_files
+        self.spill_dir = tempfile.mkdtemp(prefix='recombinant-csv-')
+        self.buffers = OrderedDict()
+        self.buffered = 0
+        self.paths = {}
+        self.handles = OrderedDict()
+
+    def add(self, owner_org, row, record):
+        self.buffers.setdefault(owner_org, []).append((row, record))
+        self.buffered += 1
+        if self.buffered >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        write all buffered rows to their organization's file
+        """
+        for owner_org, buf in self.buffers.iteritems():
+            if not buf:
+                continue
+            f = self._handle(owner_org)
+            for item in buf:
+                f.write(json.dumps(item) + '\n')
+            del buf[:]
+        self.buffered = 0
+
+    def batches(self):
+        """
+        Generator of (owner_org, records, row numbers) of at most
+        BATCH_SIZE records, each organization in the order first seen
+        """
+        for f in self.handles.itervalues():
+            f.close()
+        self.handles.clear()
+
+        for owner_org, buf in self.buffers.iteritems():
+            records = []
+            rows = []
+            for row, record in self._rows(owner_org):
+                records.append(record)
+                rows.append(row)
+                if len(records) >= BATCH_SIZE:
+                    yield (owner_org, records, rows)
+                    records = []
+                    rows = []
+            if records:
+                yield (owner_org, records, rows)
+            self.buffered -= len(buf)
+            del buf[:]
+
+    def close(self):
+        for f in self.handles.itervalues():
+            f.close()
+        self.handles.clear()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def _rows(self, owner_org):
+        """
+        Generator of (row number, record) spilled then buffered for
+        owner_org
+        """
+        if owner_org in self.paths:
+            with open(self.paths[owner_org], 'rb') as f:
+                for line in f:
+                    yield json.loads(line)
+        for item in self.buffers[owner_org]:
+            yield item
+
+    def _handle(self, owner_org):
+        f = self.handles.pop(owner_org, None)
+        if f is None:
+            if len(self.handles) >= self.max_open_files:
+                self.handles.popitem(last=False)[1].close()
+            path = self.paths.get(owner_org)
+            if path is None:
+                path = os.path.join(
+                    self.spill_dir, '{0}.jsonl'.format(len(self.paths)))
+                self.paths[owner_org] = path
+            f = open(path, 'ab')
+        self.handles[owner_org] = f  # most recently used last
+        return f
+
+
+def upload_format(f):
+    """
+    Return 'xlsx', 'ndjson' or 'csv' for the contents of uploaded file
+    object f, leaving f at its start
+    """
+    head = f.read(SNIFF_BYTES)
+    f.seek(0)
+    if head.startswith(XLSX_MAGIC):
+        return 'xlsx'
+    if head.startswith(codecs.BOM_UTF8):
+        head = head[len(codecs.BOM_UTF8):]
+    if head.lstrip().startswith('{'):
+        return 'ndjson'
+    return 'csv'
+
+
+def read_csv_upload(f, chromo):
+    """
+    Return a generator that reads an uploaded csv file object f with the
+    columns of `paster recombinant combine` output for resource chromo,
+    and produces the same values as read_excel:
+        (sheet-name, org-name, column_names, data_rows_generator)
+
+    Columns may be in any order and columns not in the template are
+    ignored. Every row must be for the same owner_org.
+    """
+    schema = resource_schema(chromo)
+    first3bytes = f.read(3)
+    if first3bytes != codecs.BOM_UTF8:
+        f.seek(0)
+    csv_in = reader(f, encoding='utf-8')
+    rows = _upload_rows(csv_in)
+
+    header = next(rows, (1, []))[1]
+    ignore = set(ORG_COLUMNS).union(
+        schema.get('csv_org_extras', []),
+        set(schema.field_ids) - set(schema.template_ids))
+    names = [c for c in header if c not in ignore]
+    if 'owner_org' not in header or sorted(names) != sorted(
+            schema.template_ids):
+        yield schema.resource_name, None, names, iter(())
+        return
+
+    org_col = header.index('owner_org')
+    columns = [header.index(c) for c in schema.template_ids]
+    org_name = None
+    first = None
+    for n, row in rows:
+        if any(row):
+            org_name = row[org_col] if org_col < len(row) else None
+            first = (n, row)
+            break
+
+    def data_rows():
+        if first is None:
+            return
+        for n, row in chain([first], rows):
+            if not any(row):
+                continue
+            row = row + [u''] * (len(header) - len(row))
+            if row[org_col] != org_name:
+                raise BadExcelData(
+                    u'Row {0}: owner_org must be "{1}" for every row'.format(
+                        n, org_name))
+            yield n, [row[i] for i in columns]
+
+    yield schema.resource_name, org_name, list(schema.template_ids), data_rows()
+
+
+def read_ndjson_upload(f, chromo):
+    """
+    Return a generator that reads an uploaded file object f with one
+    JSON object per line, keyed by datastore_id plus "owner_org", and
+    produces the same values as read_excel:
+        (sheet-name, org-name, column_names, data_rows_generator)
+
+    _text values may be given as lists. Every record must be for the
+    same owner_org.
+    """
+    schema = resource_schema(chromo)
+    first3bytes = f.read(3)
+    if first3bytes != codecs.BOM_UTF8:
+        f.seek(0)
+    known = set(ORG_COLUMNS).union(
+        schema.get('csv_org_extras', []), schema.field_ids)
+    template_ids = schema.template_ids
+    list_fields = set(schema.list_fields)
+
+    def records():
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise BadExcelData(u'Row {0}: {1}'.format(n, e))
+            if not isinstance(record, dict):
+                raise BadExcelData(
+                    u'Row {0}: each line must be a JSON object'.format(n))
+            unknown = set(record) - known
+            if unknown:
+                raise BadExcelData(u'Row {0}: unknown fields: {1}'.format(
+                    n, u', '.join(sorted(unknown))))
+            yield n, record
+
+    records = records()
+    first = next(records, None)
+    org_name = first[1].get('owner_org') if first else None
+
+    def data_rows():
+        if first is None:
+            return
+        for n, record in chain([first], records):
+            if record.get('owner_org') != org_name:
+                raise BadExcelData(
+                    u'Row {0}: owner_org must be "{1}" for every row'.format(
+                        n, org_name))
+            row = [record.get(fid) for fid in template_ids]
+            for i, fid in enumerate(template_ids):
+                if fid in list_fields and isinstance(row[i], list):
+                    row[i] = u','.join(row[i])
+            yield n, row
+
+    yield schema.resource_name, org_name, list(template_ids), data_rows()
+
+
+def _upload_rows(csv_in):
+    """
+    generate (row-number, row) from csv reader csv_in, reporting
+    encoding and format problems as BadExcelData
+    """
+    n = 0
+    while True:
+        n += 1
+        try:
+            row = next(csv_in)
+        except StopIteration:
+            return
+        except (CSVError, UnicodeDecodeError) as e:
+            raise BadExcelData(u'Row {0}: {1}'.format(n, e))
+        yield n, row
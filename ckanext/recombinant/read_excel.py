@@ -1,18 +1,23 @@
 import re
+from itertools import islice, repeat
 
 import openpyxl
 
-from ckanext.recombinant.datatypes import canonicalize
+from ckanext.recombinant.datatypes import canonicalizer, canonicalize_column
 from ckanext.recombinant.errors import BadExcelData
 
 HEADER_ROWS_V2 = 3
 HEADER_ROWS_V3 = 5
+DATA_FIRST_COL_NUM = 3  # column C, as in write_excel
+ESCAPED_REGEX = re.compile("_x([0-9A-Fa-f]{4})_")
 
-def read_excel(f, file_contents=None):
+def read_excel(f, file_contents=None, blank_rows=None):
     """
     Return a generator that opens the excel file f (name or file object)
     and then produces ((sheet-name, org-name), row1, row2, ...)
     :param: f: file name or xlsx file object
+    :param: blank_rows: accepted as for read_xlsx, but every row is
+        read because openpyxl can't skip rows without reading them
 
     :return: Generator that opens the excel file f
     and then produces:
@@ -25,45 +30,103 @@ def read_excel(f, file_contents=None):
     for sheetname in wb.sheetnames:
         if sheetname == 'reference':
             return
-        sheet = wb[sheetname]
-        rowiter = sheet.rows
-        organization_row = next(rowiter)
-
-        label_row = next(rowiter)
-        names_row = next(rowiter)
-
-        org_name = organization_row[0].value
-        if org_name and names_row[0].value != 'v3':
-            # v2 template
-            yield (
-                sheetname,
-                org_name,
-                [c.value for c in names_row],
-                _filter_bumf(rowiter, HEADER_ROWS_V2))
-            continue
-
-        cstatus_row = next(rowiter)
-        example_row = next(rowiter)
-        if example_row[0].value != 'e.g.' and example_row[0].value != 'ex.':
-            raise BadExcelData(u'Example record on row 5 is missing')
-
-        yield (
+        rowiter = iter(wb[sheetname].values)
+        yield sheet_contents(
             sheetname,
-            names_row[1].value,
-            [c.value for c in names_row[2:]],
-            _filter_bumf((row[2:] for row in rowiter), HEADER_ROWS_V3))
+            rowiter,
+            lambda start, stop: (row[start:stop] for row in rowiter),
+            blank_rows)
 
 
-def _filter_bumf(rowiter, header_rows):
+def sheet_contents(sheetname, rowiter, data_columns, blank_rows=None):
+    """
+    Read the header rows of one sheet and return
+    (sheet-name, org-name, column_names, data_rows_generator)
+
+    :param rowiter: iterator of rows of cell values, starting at row 1
+    :param data_columns: function (start, stop) returning an iterator of
+        the remaining rows sliced to [start:stop], called for v3 and v4
+        templates once the column names are known
+    :param blank_rows: passed to _filter_bumf
+    """
+    # blank or missing header rows are read as empty so that
+    # they are reported as a bad template below
+    organization_row = next(rowiter, ())
+
+    label_row = next(rowiter, ())
+    names_row = next(rowiter, ())
+
+    org_name = _header_cell(organization_row, 0)
+    version = _header_cell(names_row, 0)
+    if org_name and version not in ('v3', 'v4'):
+        # v2 template
+        return (
+            sheetname,
+            org_name,
+            list(names_row),
+            _filter_bumf(rowiter, HEADER_ROWS_V2, blank_rows))
+
+    cstatus_row = next(rowiter, ())
+    example_row = next(rowiter, ())
+    if _header_cell(example_row, 0) not in ('e.g.', 'ex.'):
+        raise BadExcelData(u'Example record on row 5 is missing')
+
+    start = DATA_FIRST_COL_NUM - 1
+    names = list(names_row[start:])
+    if version == 'v4' and None in names:
+        # hidden calculated columns follow the template columns
+        names = names[:names.index(None)]
+    return (
+        sheetname,
+        _header_cell(names_row, 1),
+        names,
+        _filter_bumf(
+            data_columns(start, start + len(names)),
+            HEADER_ROWS_V3,
+            blank_rows))
+
+
+def _header_cell(row, index):
+    """
+    value of cell index in header row, None for cells past its end
+    """
+    return row[index] if index < len(row) else None
+
+
+def _filter_bumf(rowiter, header_rows, blank_rows=None):
+    """
+    Generate (row-number, values) for rows in rowiter that aren't empty.
+    Empty sequences in rowiter are blank rows.
+
+    After blank_rows consecutive empty rows (if set) rowiter's
+    next_with_values method, when it has one, is used to skip to the
+    next row with any values without reading the rows before it, so
+    that formatting copied far past the data isn't all scanned but data
+    below a gap is still read.
+    """
     i = header_rows
-    for row in rowiter:
+    blank = 0
+    skip_ahead = getattr(rowiter, 'next_with_values', None)
+    while True:
+        try:
+            if skip_ahead and blank_rows and blank >= blank_rows:
+                skipped, row = skip_ahead()
+                i += skipped
+            else:
+                row = next(rowiter)
+        except StopIteration:
+            return
         i += 1
-        values = [
-            unescape(c.value) if isinstance(c.value, unicode) else c.value
-            for c in row]
-        # return next non-empty row
-        if not all(_is_bumf(v) for v in values):
-            yield i, values
+        if row:
+            values = [
+                unescape(v) if isinstance(v, unicode) else v
+                for v in row]
+            # return next non-empty row
+            if not all(_is_bumf(v) for v in values):
+                blank = 0
+                yield i, values
+                continue
+        blank += 1
 
 
 def _is_bumf(value):
@@ -84,44 +147,95 @@ def _is_bumf(value):
 def get_records(rows, fields, primary_key_fields, choice_fields):
     """
     Truncate/pad empty/missing records to expected row length, canonicalize
-    cell content, and return resulting record list.
+    cell content one column at a time, and return resulting record list.
 
     :param upload_data: generator producing rows of content
     :type upload_data: generator
     :param fields: collection of fields specified in JSON schema
     :type fields: list or tuple
-    :param primary_key_fields: list of field ids making up the PK
-    :type primary_key_fields: list of strings
+    :param primary_key_fields: field ids making up the PK
+    :type primary_key_fields: set or list of strings
     :param choice_fields: {field_id: 'full'/True/False}
     :type choice_fields: dict
 
     :return: canonicalized records of specified upload data
     :rtype: tuple of dicts
     """
-    records = []
+    num_fields = len(fields)
+
+    numbers = []
+    cells = []
     for n, row in rows:
         # trailing cells might be empty: trim row to fit
         while (row and
-                (len(row) > len(fields)) and
+                (len(row) > num_fields) and
                 (row[-1] is None or row[-1] == '')):
             row.pop()
-        while row and (len(row) < len(fields)):
+        while row and (len(row) < num_fields):
             row.append(None) # placeholder: canonicalize once only, below
+        numbers.append(n)
+        cells.append(row)
 
-        try:
-            records.append(
-                (n, dict((
-                    f['datastore_id'],
-                    canonicalize(
-                        v,
-                        f['datastore_type'],
-                        f['datastore_id'] in primary_key_fields,
-                        choice_fields.get(f['datastore_id'], False)))
-                for f, v in zip(fields, row))))
-        except BadExcelData, e:
-            raise BadExcelData(u'Row {0}:'.format(n) + u' ' + e.message)
+    try:
+        columns = [
+            canonicalize_column(
+                values,
+                f['datastore_type'],
+                f['datastore_id'] in primary_key_fields,
+                choice_fields.get(f['datastore_id'], False))
+            for f, values in zip(fields, zip(*(row for row in cells if row)))]
+    except BadExcelData:
+        # find the first row with an error, as when canonicalizing by row
+        plan = canonicalize_plan(fields, primary_key_fields, choice_fields)
+        for n, row in zip(numbers, cells):
+            try:
+                for (_fid, canon), v in zip(plan, row):
+                    canon(v)
+            except BadExcelData, e:
+                raise BadExcelData(u'Row {0}:'.format(n) + u' ' + e.message)
+        raise
+
+    field_ids = [f['datastore_id'] for f in fields]
+    canon_rows = iter(zip(*columns)) if columns else repeat(())
+    return [
+        (n, dict(zip(field_ids, next(canon_rows))) if row else {})
+        for n, row in zip(numbers, cells)]
+
+
+def get_record_chunks(
+        rows, fields, primary_key_fields, choice_fields, chunk_size):
+    """
+    Generator of get_records results for at most chunk_size rows at a
+    time, so that only one chunk of a sheet is held in memory
 
-    return records
+    Parameters are as for get_records. Empty chunks are skipped.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        records = get_records(
+            chunk, fields, primary_key_fields, choice_fields)
+        if records:
+            yield records
+
+
+def canonicalize_plan(fields, primary_key_fields, choice_fields):
+    """
+    Return [(datastore_id, canonicalizer)] for fields, with each
+    column's canonicalize function specialized once per upload
+    instead of once per cell
+
+    Parameters are as for get_records.
+    """
+    return [(
+            f['datastore_id'],
+            canonicalizer(
+                f['datastore_type'],
+                f['datastore_id'] in primary_key_fields,
+                choice_fields.get(f['datastore_id'], False)))
+        for f in fields]
 
 
 # XXX remove this function once we upgrade to openpyxl 2.4
@@ -129,15 +243,14 @@ def unescape(value):
     """
     copy of unescape from openpyxl.utils.escape, openpyxl version 2.4.x
     """
-    ESCAPED_REGEX = re.compile("_x([0-9A-Fa-f]{4})_")
-
-    def _sub(match):
-        """
-        Callback to unescape chars
-        """
-        return chr(int(match.group(1), 16))
-
     if "_x" in value:
-        value = ESCAPED_REGEX.sub(_sub, value)
+        value = ESCAPED_REGEX.sub(_unescape_sub, value)
 
     return value
+
+
+def _unescape_sub(match):
+    """
+    Callback to unescape chars
+    """
+    return chr(int(match.group(1), 16))
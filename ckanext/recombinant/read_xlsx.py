@@ -0,0 +1,370 @@
+"""
+Lean .xlsx upload reader that streams worksheet xml with iterparse
+
+read_xlsx produces the same values as read_excel (openpyxl read-only
+mode) without building openpyxl cell or style objects: shared strings
+are parsed only as far as the largest index used, only the number
+format ids are read from the stylesheet and cells outside the data
+columns of v3 and v4 templates are skipped. Sheets after "reference"
+are never opened.
+"""
+
+import zipfile
+
+from openpyxl.xml.functions import iterparse, fromstring
+from openpyxl.xml.constants import SHEET_MAIN_NS, ARC_ROOT_RELS
+from openpyxl.packaging.relationship import get_dependents, get_rels_path
+from openpyxl.packaging.workbook import WorkbookPackage
+from openpyxl.styles.numbers import builtin_format_code, is_date_format
+from openpyxl.formula.translate import Translator
+from openpyxl.utils import column_index_from_string, range_boundaries
+from openpyxl.utils.datetime import (
+    from_excel, from_ISO8601, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904)
+
+from ckanext.recombinant.read_excel import sheet_contents
+
+ROW_TAG = '{%s}row' % SHEET_MAIN_NS
+CELL_TAG = '{%s}c' % SHEET_MAIN_NS
+VALUE_TAG = '{%s}v' % SHEET_MAIN_NS
+FORMULA_TAG = '{%s}f' % SHEET_MAIN_NS
+INLINE_STRING_TAG = '{%s}is' % SHEET_MAIN_NS
+TEXT_TAG = '{%s}t' % SHEET_MAIN_NS
+RUN_TAG = '{%s}r' % SHEET_MAIN_NS
+SHARED_STRING_TAG = '{%s}si' % SHEET_MAIN_NS
+DIMENSION_TAG = '{%s}dimension' % SHEET_MAIN_NS
+SHEET_DATA_TAG = '{%s}sheetData' % SHEET_MAIN_NS
+NUM_FMT_TAG = '{%s}numFmt' % SHEET_MAIN_NS
+CELL_XFS_TAG = '{%s}cellXfs' % SHEET_MAIN_NS
+XF_TAG = '{%s}xf' % SHEET_MAIN_NS
+
+
+def read_xlsx(f, blank_rows=None):
+    """
+    Return a generator that opens the xlsx file f (name or file object)
+    and then produces:
+        (sheet-name, org-name, column_names, data_rows_generator)
+        ...
+    exactly like read_excel(f, blank_rows=blank_rows)
+    """
+    archive = zipfile.ZipFile(f)
+    workbook_path = _part_path(archive, ARC_ROOT_RELS, '/officeDocument')
+    package = WorkbookPackage.from_tree(
+        fromstring(archive.read(workbook_path)))
+    rels = get_dependents(archive, get_rels_path(workbook_path))
+
+    epoch = CALENDAR_WINDOWS_1900
+    if package.properties and package.properties.date1904:
+        epoch = CALENDAR_MAC_1904
+
+    strings_path = _rel_target(rels, '/sharedStrings')
+    styles_path = _rel_target(rels, '/styles')
+    cells = _CellReader(
+        _SharedStrings(archive.open(strings_path) if strings_path else None),
+        _date_styles(archive.open(styles_path)) if styles_path else set(),
+        epoch)
+
+    for sheet in package.sheets:
+        if not sheet.id:
+            continue  # openpyxl drops these too
+        if sheet.name == 'reference':
+            return
+        rows = _SheetRows(archive, rels[sheet.id].target, cells)
+        yield sheet_contents(
+            sheet.name, rows, rows.data_columns, blank_rows)
+
+
+def _part_path(archive, rels_path, rel_type):
+    return _rel_target(get_dependents(archive, rels_path), rel_type)
+
+
+def _rel_target(rels, rel_type):
+    """
+    target of the first relationship with a type ending in rel_type
+    """
+    for r in rels.Relationship:
+        if r.Type.endswith(rel_type):
+            return r.target
+
+
+def _iter_tag(src, tag):
+    """
+    iterparse src producing only tag elements, cleared once used
+    """
+    for _ev, element in iterparse(src):
+        if element.tag == tag:
+            yield element
+            element.clear()
+
+
+def _text_content(node):
+    """
+    fast openpyxl.cell.text.Text.from_tree(node).content
+    """
+    plain = None
+    snippets = []
+    for child in node:
+        if child.tag == TEXT_TAG:
+            plain = child.text
+        elif child.tag == RUN_TAG:
+            text = child.findtext(TEXT_TAG)
+            if text:
+                snippets.append(text)
+    if plain is not None:
+        snippets.insert(0, plain)
+    return u''.join(snippets)
+
+
+def _date_styles(src):
+    """
+    return the set of cell style indexes with date number formats,
+    without building the rest of the stylesheet
+    """
+    custom = {}
+    date_styles = set()
+    for _ev, element in iterparse(src):
+        if element.tag == NUM_FMT_TAG:
+            custom[int(element.get('numFmtId'))] = element.get('formatCode')
+        elif element.tag == CELL_XFS_TAG:
+            for idx, xf in enumerate(element.iterfind(XF_TAG)):
+                fmt_id = int(xf.get('numFmtId', 0))
+                fmt = custom.get(fmt_id) or builtin_format_code(fmt_id)
+                if is_date_format(fmt):
+                    date_styles.add(idx)
+            break
+    src.close()
+    return date_styles
+
+
+class _SharedStrings(object):
+    """
+    shared string table parsed only as far as the largest index used
+    """
+    def __init__(self, src):
+        self._strings = []
+        self._elements = _iter_tag(src, SHARED_STRING_TAG) if src else iter(())
+
+    def __getitem__(self, index):
+        strings = self._strings
+        while len(strings) <= index:
+            element = next(self._elements)
+            strings.append(
+                _text_content(element).replace('x005F_', ''))
+        return strings[index]
+
+
+class _CellReader(object):
+    """
+    cell values as openpyxl.worksheet._reader.WorkSheetParser.parse_cell
+    returns them
+    """
+    def __init__(self, shared_strings, date_styles, epoch):
+        self.shared_strings = shared_strings
+        self.date_styles = date_styles
+        self.epoch = epoch
+
+    def value(self, element, shared_formulae):
+        data_type = element.get('t', 'n')
+
+        formula = element.find(FORMULA_TAG)
+        if formula is not None:
+            value = '='
+            if formula.text is not None:
+                value += formula.text
+            if formula.get('t') == 'shared':
+                idx = formula.get('si')
+                coordinate = element.get('r')
+                if idx in shared_formulae:
+                    return shared_formulae[idx].translate_formula(coordinate)
+                if value != '=':
+                    shared_formulae[idx] = Translator(value, coordinate)
+            return value
+
+        if data_type == 'inlineStr':
+            child = element.find(INLINE_STRING_TAG)
+            if child is not None:
+                return _text_content(child)
+            return None
+
+        value = element.findtext(VALUE_TAG) or None
+        if value is None:
+            return None
+        if data_type == 'n':
+            if '.' in value or 'E' in value or 'e' in value:
+                value = float(value)
+            else:
+                value = long(value)
+            style_id = element.get('s')
+            if style_id and int(style_id) in self.date_styles:
+                try:
+                    return from_excel(value, self.epoch)
+                except ValueError:
+                    return '#VALUE!'
+            return value
+        if data_type == 's':
+            return self.shared_strings[int(value)]
+        if data_type == 'b':
+            return bool(int(value))
+        if data_type == 'd':
+            return from_ISO8601(value)
+        return value
+
+
+class _SheetRows(object):
+    """
+    iterator of rows of cell values from one worksheet, padded and
+    truncated as openpyxl's ReadOnlyWorksheet.values would produce them
+    """
+    def __init__(self, archive, path, cells):
+        self.archive = archive
+        self.path = path
+        self.cells = cells
+        self.max_col = self.max_row = None
+        self.first_col = 1
+        self.last_col = None
+        self.data_rows = False
+        self._skipping = False
+        self._skipped = 0
+
+        src = archive.open(path)
+        for _ev, element in iterparse(src, events=('start',)):
+            if element.tag == DIMENSION_TAG:
+                _c, _r, self.max_col, self.max_row = range_boundaries(
+                    element.get('ref'))
+                break
+            if element.tag == SHEET_DATA_TAG:
+                break  # dimension missing
+        src.close()
+
+        self._rows = self._parse_rows()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._rows)
+
+    def data_columns(self, start, stop):
+        """
+        read only columns [start:stop] of the following rows, rows
+        without values in those columns are returned as ()
+        """
+        self.first_col = start + 1
+        self.last_col = stop
+        self.data_rows = True
+        return self
+
+    def next_with_values(self):
+        """
+        return (rows skipped, row) for the next row with any cells with
+        values in the data columns. The rows skipped aren't converted
+        to values, only their cells are checked for value elements.
+        """
+        self._skipping = True
+        self._skipped = 0
+        row = next(self._rows)
+        return self._skipped, row
+
+    def _parse_rows(self):
+        max_row = self.max_row
+        counter = 1
+        idx = 0
+        shared_formulae = {}
+        column_index = {}
+        value = self.cells.value
+
+        src = self.archive.open(self.path)
+        for element in _iter_tag(src, ROW_TAG):
+            r = element.get('r')
+            idx = int(r) if r else idx + 1
+            if max_row is not None and idx > max_row:
+                break
+
+            # some rows are missing
+            while counter < idx and not self._skipping:
+                counter += 1
+                yield self._empty_row()
+
+            if self._skipping and counter <= idx:
+                if not self._has_values(element, column_index):
+                    continue
+                self._skipped += idx - counter
+                counter = idx
+                self._skipping = False
+
+            if counter == idx:
+                counter += 1
+                yield self._row(element, shared_formulae, column_index, value)
+
+        if max_row is not None and max_row < idx:
+            while counter <= max_row and not self._skipping:
+                counter += 1
+                yield self._empty_row()
+        src.close()
+
+    def _width(self, max_col):
+        last_col = max_col
+        if self.last_col is not None and (
+                max_col is None or self.last_col < max_col):
+            last_col = self.last_col
+        return max(last_col + 1 - self.first_col, 0)
+
+    def _empty_row(self):
+        if self.max_col is None:
+            return []
+        return (None,) * self._width(self.max_col)
+
+    def _row(self, element, shared_formulae, column_index, value):
+        if not len(element):
+            return ()
+        max_col = self.max_col
+        if max_col is None:
+            max_col = self._column(element[-1], len(element), column_index)
+
+        first_col = self.first_col
+        new_row = [None] * self._width(max_col)
+        last_col = first_col + len(new_row) - 1
+        empty = True
+        for n, cell in enumerate(element, 1):
+            if not len(cell):
+                continue  # formatting only, no value
+            column = self._column(cell, n, column_index)
+            if column > last_col:
+                break  # cells are stored in column order
+            if column >= first_col and cell.tag == CELL_TAG:
+                # shared formulae are only found from cells read, so
+                # those with their first cell outside the data columns
+                # are returned as "="
+                new_row[column - first_col] = value(cell, shared_formulae)
+                empty = False
+        if empty and self.data_rows:
+            return ()  # e.g. template rows with only status formulas
+        return tuple(new_row)
+
+    def _has_values(self, element, column_index):
+        """
+        True if row element has any cells with values in the data
+        columns, without reading the values
+        """
+        for n, cell in enumerate(element, 1):
+            if not len(cell):
+                continue  # formatting only, no value
+            column = self._column(cell, n, column_index)
+            if self.last_col is not None and column > self.last_col:
+                return False
+            if column >= self.first_col and cell.tag == CELL_TAG:
+                return True
+        return False
+
+    def _column(self, cell, n, column_index):
+        """
+        column number of cell, the nth cell in its row
+        """
+        coordinate = cell.get('r')
+        if not coordinate:
+            return n
+        letters = coordinate.rstrip('0123456789')
+        try:
+            return column_index[letters]
+        except KeyError:
+            column = column_index[letters] = column_index_from_string(letters)
+            return column
@@ -0,0 +1,99 @@
+"""
+Compiled resource definitions
+
+Resource definitions (chromo) are compiled once when they are loaded
+into ResourceSchema objects with the field lookups needed for reading
+and writing data precomputed, instead of scanning chromo['fields'] for
+every field, row or cell.
+"""
+
+from paste.deploy.converters import aslist
+
+
+class ResourceSchema(object):
+    """
+    Read-only compiled resource definition chromo. Other chromo keys
+    are available with schema[key] and schema.get(key, default), so a
+    schema may be used wherever a chromo is read.
+
+    fields - all fields in definition order
+    field_ids - datastore_ids of fields
+    field_by_id - {datastore_id: field}
+    template_fields - fields included in templates, in column order
+    template_ids - datastore_ids of template_fields
+    template_index - {datastore_id: 0-based position in template_fields}
+    primary_key - datastore_ids of the primary key, in key order
+    primary_key_set - frozenset of primary_key
+    primary_key_fields - primary key fields in definition order
+    choice_fields - {datastore_id: 'full' or True} for fields with choices
+    datastore_types - {datastore_id: datastore_type}
+    list_fields - datastore_ids of _text fields
+    """
+    __slots__ = (
+        'chromo', 'resource_name', 'fields', 'field_ids', 'field_by_id',
+        'template_fields', 'template_ids', 'template_index', 'primary_key',
+        'primary_key_set', 'primary_key_fields', 'choice_fields',
+        'datastore_types', 'list_fields')
+
+    def __init__(self, chromo):
+        fields = tuple(chromo['fields'])
+        template_fields = tuple(
+            f for f in fields if f.get('import_template_include', True))
+        primary_key = tuple(aslist(chromo.get('datastore_primary_key', [])))
+        primary_key_set = frozenset(primary_key)
+
+        values = {
+            'chromo': chromo,
+            'resource_name': chromo['resource_name'],
+            'fields': fields,
+            'field_ids': tuple(f['datastore_id'] for f in fields),
+            'field_by_id': dict((f['datastore_id'], f) for f in fields),
+            'template_fields': template_fields,
+            'template_ids': tuple(f['datastore_id'] for f in template_fields),
+            'template_index': dict(
+                (f['datastore_id'], i) for i, f in enumerate(template_fields)),
+            'primary_key': primary_key,
+            'primary_key_set': primary_key_set,
+            'primary_key_fields': tuple(
+                f for f in fields if f['datastore_id'] in primary_key_set),
+            'choice_fields': dict(
+                (f['datastore_id'],
+                    'full' if f.get('excel_full_text_choices') else True)
+                for f in fields if 'choices' in f or 'choices_file' in f),
+            'datastore_types': dict(
+                (f['datastore_id'], f.get('datastore_type')) for f in fields),
+            'list_fields': tuple(
+                f['datastore_id'] for f in fields
+                if f.get('datastore_type') == '_text'),
+            }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ResourceSchema is read-only')
+
+    def __getitem__(self, key):
+        return self.chromo[key]
+
+    def __contains__(self, key):
+        return key in self.chromo
+
+    def get(self, key, default=None):
+        return self.chromo.get(key, default)
+
+
+def compile_schemas(chromos):
+    """
+    return {resource_name: ResourceSchema} for {resource_name: chromo}
+    """
+    return dict(
+        (name, ResourceSchema(chromo)) for name, chromo in chromos.items())
+
+
+def resource_schema(chromo):
+    """
+    return chromo if it is already a ResourceSchema, otherwise compile it
+    """
+    if isinstance(chromo, ResourceSchema):
+        return chromo
+    return ResourceSchema(chromo)
@@ -28,7 +28,18 @@ def get_chromo(resource_name):
     """
     Get the resource definition (chromo) for the given resource name
     """
-    chromos = _get_plugin()._chromos
+    return _get_resource(_get_plugin()._chromos, resource_name)
+
+
+def get_schema(resource_name):
+    """
+    Get the compiled resource definition (ResourceSchema) for the
+    given resource name
+    """
+    return _get_resource(_get_plugin()._schemas, resource_name)
+
+
+def _get_resource(chromos, resource_name):
     try:
         return chromos[resource_name]
     except KeyError:
@@ -0,0 +1,236 @@
+"""
+Bounded in-memory and on-disk LRU cache for generated Excel templates.
+
+Generating a v3 template means building and saving a whole openpyxl
+workbook, so the saved .xlsx bytes are kept here keyed by everything
+that can change their content.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from logging import getLogger
+
+log = getLogger(__name__)
+
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_DISK_BYTES = 1024 * 1024 * 1024
+CACHE_FILE_SUFFIX = '.xlsx'
+
+
+class TemplateCache(object):
+    """
+    LRU cache of template bytes limited by total size in bytes.
+
+    Entries evicted from memory stay available from cache_dir (when set)
+    until the directory grows past max_disk_bytes.
+    """
+    def __init__(self, max_bytes=DEFAULT_MEMORY_BYTES, cache_dir=None,
+            max_disk_bytes=DEFAULT_DISK_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, key):
+        """
+        return cached bytes for key or None
+        """
+        digest = cache_key_digest(key)
+        with self._lock:
+            data = self._entries.pop(digest, None)
+            if data is not None:
+                self._entries[digest] = data  # most recently used
+                self.hits += 1
+                return data
+
+        data = self._disk_get(digest)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._memory_put(digest, data)
+        return data
+
+    def put(self, key, data):
+        """
+        store bytes data for key
+        """
+        digest = cache_key_digest(key)
+        with self._lock:
+            self._memory_put(digest, data)
+        self._disk_put(digest, data)
+
+    def get_or_build(self, key, build):
+        """
+        return cached bytes for key, calling build() to create them
+        on a miss
+        """
+        data = self.get(key)
+        if data is None:
+            data = build()
+            self.put(key, data)
+        log.debug('template cache %r', self.stats())
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _memory_put(self, digest, data):
+        old = self._entries.pop(digest, None)
+        if old is not None:
+            self._total_bytes -= len(old)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[digest] = data
+        self._total_bytes += len(data)
+        while self._total_bytes > self.max_bytes:
+            _digest, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= len(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, digest):
+        return os.path.join(self.cache_dir, digest + CACHE_FILE_SUFFIX)
+
+    def _disk_get(self, digest):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)  # most recently used
+        except (IOError, OSError):
+            return None
+        return data
+
+    def _disk_put(self, digest, data):
+        if not self.cache_dir or len(data) > self.max_disk_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, self._disk_path(digest))
+        except (IOError, OSError):
+            log.warning('unable to write template cache file', exc_info=True)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._disk_evict()
+
+    def _disk_evict(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(CACHE_FILE_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # removed by another process
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for _mtime, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+
+def cache_key_digest(key):
+    """
+    return a stable hex digest for a tuple of cache key parts
+    """
+    return hashlib.sha1(json.dumps(
+        key, default=unicode, ensure_ascii=True)).hexdigest()
+
+
+def geno_fingerprint(geno):
+    """
+    return a string that changes when the loaded geno, its choices files
+    or the template generation code change
+
+    The digest of the geno itself is stored in the geno as '_digest',
+    like the '_path' set on its resources when loaded, so it is only
+    calculated once for each loaded geno.
+    """
+    if '_digest' not in geno:
+        geno['_digest'] = hashlib.sha1(json.dumps(
+            geno, sort_keys=True, default=unicode)).hexdigest()
+    h = hashlib.sha1(geno['_digest'])
+
+    for chromo in geno['resources']:
+        for f in chromo['fields']:
+            if 'choices_file' not in f or '_path' not in chromo:
+                continue
+            h.update(_file_signature(
+                os.path.join(chromo['_path'], f['choices_file'])))
+
+    from ckanext.recombinant import write_excel, write_excel_v2
+    for m in (write_excel, write_excel_v2):
+        h.update(_file_signature(m.__file__))
+    return h.hexdigest()
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return '{0} missing\n'.format(path)
+    return '{0} {1} {2}\n'.format(path, st.st_mtime, st.st_size)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_template_cache():
+    """
+    return the TemplateCache configured by the recombinant.template_cache_*
+    ini settings
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            from pylons import config
+            _cache = TemplateCache(
+                max_bytes=int(config.get(
+                    'recombinant.template_cache_size',
+                    DEFAULT_MEMORY_BYTES)),
+                cache_dir=config.get('recombinant.template_cache_dir') or None,
+                max_disk_bytes=int(config.get(
+                    'recombinant.template_cache_dir_size',
+                    DEFAULT_DISK_BYTES)))
+        return _cache
@@ -0,0 +1,70 @@
+"""
+Stand-ins for the ckan and pylons modules imported by ckanext.recombinant
+
+install() registers them only when ckan isn't installed, e.g. in CI, so
+that tests of code that doesn't need a running site still run. Tests
+that need ckan's behaviour must replace what they use themselves.
+"""
+import sys
+import types
+
+
+class ValidationError(Exception):
+    def __init__(self, error_dict, error_summary=None, extra_msg=None):
+        super(ValidationError, self).__init__(error_dict)
+        self.error_dict = error_dict
+
+
+class Interface(object):
+    pass
+
+
+class Helpers(object):
+    def lang(self):
+        return 'en'
+
+
+def _(message):
+    return message
+
+
+def install():
+    try:
+        import ckan.plugins
+        import pylons
+        return
+    except ImportError:
+        pass
+
+    h = Helpers()
+    _module('ckan')
+    _module('ckan.plugins',
+        Interface=Interface,
+        ITranslation=type('ITranslation', (Interface,), {}),
+        PluginImplementations=lambda interface: [])
+    _module('ckan.plugins.toolkit', _=_, h=h)
+    _module('ckan.lib')
+    _module('ckan.lib.helpers', lang=h.lang)
+    _module('ckan.lib.base',
+        c=None, render=None, model=None, request=None, h=h,
+        response=None, abort=None)
+    _module('ckan.lib.cli', CkanCommand=object)
+    _module('ckan.logic',
+        ValidationError=ValidationError,
+        NotAuthorized=type('NotAuthorized', (Exception,), {}),
+        get_or_bust=lambda data_dict, key: data_dict[key])
+    _module('ckan.controllers')
+    _module('ckan.controllers.package', PackageController=object)
+    _module('pylons', config={}, c=None, translator=None)
+    _module('pylons.i18n', _=_, gettext=_)
+    _module('pylons.i18n.translation', set_lang=None)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _dot, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
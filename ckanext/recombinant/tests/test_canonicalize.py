@@ -3,7 +3,8 @@ from datetime import datetime, date
 
 from nose.tools import assert_raises, assert_equal
 
-from ckanext.recombinant.datatypes import canonicalize, BadExcelData
+from ckanext.recombinant.datatypes import (
+    canonicalize, canonicalizer, canonicalize_column, BadExcelData)
 
 def test_year():
     dt = 'year'
@@ -48,6 +49,10 @@ def test_month():
 def test_int():
     dt = 'int'
     assert_equal(canonicalize(2019, dt, False), '2019')
+    assert_equal(canonicalize(u'-2019', dt, False), u'-2019')
+    assert_equal(canonicalize(u'007', dt, False), u'7')
+    assert_equal(canonicalize(u'-0', dt, False), u'-0')
+    assert_equal(canonicalize(u'12\n', dt, False), u'12')
     assert_equal(canonicalize(42.0, dt, False), '42')
     assert_equal(canonicalize(42.25, dt, False), '42.25')
     assert_equal(canonicalize(0, dt, False), '0')
@@ -226,3 +231,32 @@ def test_choice_field():
     assert_equal(canonicalize(' C1: Value', 'text', False, False), ' C1: Value')
     assert_equal(canonicalize(' C1: Value', 'text', False, True), 'C1: Value')
     assert_equal(canonicalize(' C1: Value', 'text', False, 'full'), 'C1')
+
+def test_canonicalizer_reused_for_column():
+    canon = canonicalizer('int', False)
+    assert_equal(
+        [canon(v) for v in (42.0, None, '$1,000', ' ', 'x')],
+        ['42', None, '1000', None, 'x'])
+    canon = canonicalizer('text', True, 'full')
+    assert_equal([canon(v) for v in (' A\x01: b', None)], ['A', ''])
+    assert_raises(BadExcelData, canon, '=A1')
+
+def test_canonicalize_column():
+    from ckanext.recombinant import datatypes
+    values = [2019.0, None, -0.0, 42.25, 1e12, u' $1,000 ', u'']
+    expected = [canonicalize(v, 'year', False) for v in values]
+    assert_equal(
+        expected,
+        [u'2019', None, u'-0', u'42.25', u'1000000000000', u'1000', None])
+    assert_equal(canonicalize_column(values, 'year', False), expected)
+    assert_equal(canonicalize_column(values[:5], 'year', False), expected[:5])
+    numpy = datatypes.numpy
+    try:
+        datatypes.numpy = None
+        assert_equal(
+            canonicalize_column(values[:5], 'year', False), expected[:5])
+    finally:
+        datatypes.numpy = numpy
+    assert_equal(
+        canonicalize_column([datetime(2020, 11, 15), None], 'date', True),
+        [u'2020-11-15', u''])
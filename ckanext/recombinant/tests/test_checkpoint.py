@@ -0,0 +1,89 @@
+import os
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.recombinant.checkpoint import CheckpointJournal, merge_ranges
+
+
+def test_merge_ranges():
+    assert_equal(
+        merge_ranges([(5, 6), (1, 2), (3, 4), (9, 12), (10, 11)]),
+        [[1, 6], [9, 12]])
+
+
+def test_checkpoint_journal_resume():
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        journal = CheckpointJournal(path)
+        journal.dispatch('a.csv', 0, 'org', [2, 3], (30, 4))
+        journal.dispatch('a.csv', 1, 'other', [4, 5], (50, 6))
+        journal.dispatch('a.csv', 2, 'org', [6, 7], (70, 8))
+        journal.commit('a.csv', 1)
+        journal.commit('a.csv', 0)
+        assert_equal(journal.position('a.csv'), (50, 6))
+        journal.dispatch('b.csv', 0, 'org', [2], (10, 3))
+        journal.commit('b.csv', 0)
+        journal.finish('b.csv')
+        journal.close()
+        with open(path, 'ab') as f:
+            f.write('{"file": "a.csv", "org": "org", "ro')
+
+        journal = CheckpointJournal(path, resume=True)
+        assert_equal(journal.position('a.csv'), (50, 6))
+        assert not journal.complete('a.csv')
+        assert journal.complete('b.csv')
+        batches = [('org', ['f', 'g'], [6, 7], (70, 8))]
+        assert_equal(
+            list(journal.skip_committed('a.csv', batches)), batches)
+        journal.close()
+    finally:
+        os.remove(path)
+
+
+def test_checkpoint_journal_skip_committed():
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        journal = CheckpointJournal(path)
+        journal.dispatch('a.csv', 0, 'org', [2, 4], None)
+        journal.dispatch('a.csv', 1, 'other', [3, 5], None)
+        journal.commit('a.csv', 1)
+        journal.close()
+
+        journal = CheckpointJournal(path, resume=True)
+        assert_equal(journal.position('a.csv'), None)
+        assert_equal(
+            list(journal.skip_committed('a.csv', [
+                ('org', ['b', 'd'], [2, 4], None),
+                ('other', ['c', 'e'], [3, 5], None)])),
+            [('org', ['b', 'd'], [2, 4], None)])
+        journal.close()
+    finally:
+        os.remove(path)
+
+
+def test_checkpoint_journal_resume_twice():
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        journal = CheckpointJournal(path)
+        journal.dispatch('a.csv', 0, 'org', [2, 3], (30, 4))
+        journal.commit('a.csv', 0)
+        journal.close()
+        with open(path, 'ab') as f:
+            f.write('{"file": "a.csv", "org": "org", "ro')
+
+        journal = CheckpointJournal(path, resume=True)
+        journal.dispatch('a.csv', 0, 'org', [4, 5], (50, 6))
+        journal.commit('a.csv', 0)
+        journal.close()
+
+        journal = CheckpointJournal(path, resume=True)
+        assert_equal(journal.position('a.csv'), (50, 6))
+        journal.close()
+        with open(path, 'rb') as f:
+            assert_equal(len(f.readlines()), 2)
+    finally:
+        os.remove(path)
@@ -0,0 +1,213 @@
+import os
+import tempfile
+from collections import defaultdict
+
+from nose.tools import assert_equal, assert_raises
+
+import ckan_stubs
+ckan_stubs.install()
+
+from ckan.logic import ValidationError
+
+from ckanext.recombinant import commands, read_csv
+
+
+class FakeAction(object):
+    """
+    datastore_upsert that fails for records with a bad 'n', rolling back
+    the whole call like the datastore does
+    """
+    def __init__(self, bad, report_row=True):
+        self.bad = bad
+        self.report_row = report_row
+        self.calls = 0
+        self.loaded = []
+
+    def datastore_upsert(self, method, resource_id, records):
+        self.calls += 1
+        for i, r in enumerate(records):
+            if r['n'] in self.bad:
+                error = {'records': [u'bad {0}'.format(r['n'])]}
+                if self.report_row:
+                    error['_records_row'] = i
+                raise ValidationError(error)
+        self.loaded.extend(r['n'] for r in records)
+
+
+class FakeCKAN(object):
+    def __init__(self, action):
+        self.action = action
+
+
+def _upsert(count, bad, report_row):
+    action = FakeAction(bad, report_row)
+    records = [{'n': n} for n in range(count)]
+    rejects = commands._upsert_isolating_errors(
+        FakeCKAN(action), 'upsert', 'res-id', records,
+        range(2, count + 2))
+    return action, rejects
+
+
+def test_upsert_isolating_errors():
+    action, rejects = _upsert(1000, set([10, 500, 501, 999]), True)
+    assert_equal([(row, rec['n']) for row, error, rec in rejects],
+        [(12, 10), (502, 500), (503, 501), (1001, 999)])
+    assert_equal(rejects[0][1], [u'bad 10'])
+    assert_equal(action.loaded,
+        [n for n in range(1000) if n not in (10, 500, 501, 999)])
+    # each bad row costs O(log n) calls
+    assert action.calls <= 4 * 2 * 10, action.calls
+
+
+def test_upsert_isolating_errors_without_row():
+    action, rejects = _upsert(1024, set([3, 700]), False)
+    assert_equal([row for row, error, rec in rejects], [5, 702])
+    assert_equal(action.loaded,
+        [n for n in range(1024) if n not in (3, 700)])
+    assert action.calls <= 1 + 2 * 2 * 10, action.calls
+
+
+def test_upsert_isolating_errors_no_errors():
+    action, rejects = _upsert(100, set(), True)
+    assert_equal((action.calls, rejects), (1, []))
+
+
+def test_upsert_isolating_errors_batch_error():
+    class BatchErrorAction(object):
+        calls = 0
+
+        def datastore_upsert(self, method, resource_id, records):
+            self.calls += 1
+            raise ValidationError({'fields': [u'unknown field "x"']})
+
+    action = BatchErrorAction()
+    with assert_raises(ValidationError):
+        commands._upsert_isolating_errors(
+            FakeCKAN(action), 'upsert', 'res-id', [{'n': n} for n in range(8)],
+            range(2, 10))
+    assert_equal(action.calls, 1)
+
+
+class TestLoadBatchesParallel(object):
+    """
+    _load_batches_parallel with a fake _load_org_batch in the forked
+    workers, logging the batches loaded to a file
+    """
+    def setup(self):
+        fd, self.log = tempfile.mkstemp()
+        os.close(fd)
+        self.saved = dict((name, getattr(commands, name)) for name in [
+            '_load_org_batch', '_dispose_engines', 'get_schema',
+            'LocalCKAN'])
+        log = self.log
+
+        def load_org_batch(lc, chromo, resource_id, org_name, records, rows,
+                conn=None):
+            if org_name == 'crash':
+                os._exit(1)
+            if org_name == 'bad' and records[0] > 0:
+                return 1, []
+            with open(log, 'a') as f:
+                f.write('{0} {1} {2}\n'.format(org_name, os.getpid(),
+                    records[0]))
+            return 0, []
+        commands._load_org_batch = load_org_batch
+        commands._dispose_engines = lambda: None
+        commands.get_schema = lambda name: {}
+        commands.LocalCKAN = lambda: None
+
+    def teardown(self):
+        for name, value in self.saved.items():
+            setattr(commands, name, value)
+        os.remove(self.log)
+
+    def _loaded(self):
+        with open(self.log) as f:
+            return [line.split() for line in f]
+
+    def test_organizations_in_order(self):
+        batches = [('org{0}'.format(n % 5), [n], [n + 2], None)
+            for n in range(40)]
+        batches += [('bad', [0], [42], None), ('bad', [1], [43], None),
+            ('bad', [0], [44], None)]
+        errors = commands._load_batches_parallel(
+            'res', defaultdict(lambda: 'res-id'), iter(batches), 3,
+            commands.LoadStats())
+        assert_equal(errors, 1)
+
+        by_org = {}
+        for org_name, pid, n in self._loaded():
+            by_org.setdefault(org_name, []).append((int(n), pid))
+        assert_equal(sorted(by_org), ['bad', 'org0', 'org1', 'org2', 'org3',
+            'org4'])
+        for org_name, loaded in by_org.items():
+            # loaded in order by a single worker, nothing after a failure
+            expected = [0] if org_name == 'bad' else range(
+                int(org_name[3:]), 40, 5)
+            assert_equal([n for n, pid in loaded], expected)
+            assert_equal(len(set(pid for n, pid in loaded)), 1)
+
+    def test_worker_exit(self):
+        batches = [('crash', [n], [n + 2], None) for n in range(20)]
+        errors = commands._load_batches_parallel(
+            'res', defaultdict(lambda: 'res-id'), iter(batches), 2,
+            commands.LoadStats())
+        assert_equal(errors, 1)
+
+
+class TestLoadOneCsvFile(object):
+    """
+    _load_one_csv_file with the datasets of a fake site and a fake
+    _load_org_batch
+    """
+    def setup(self):
+        self.saved = dict((name, getattr(commands, name)) for name in [
+            '_load_org_batch', 'get_schema', 'LocalCKAN'])
+        self.open_csv = read_csv.open_csv
+        self.opened = []
+        self.loaded = []
+
+        def open_csv(csv_path):
+            self.opened.append(csv_path)
+            return self.open_csv(csv_path)
+
+        def load_org_batch(lc, chromo, resource_id, org_name, records, rows,
+                conn=None):
+            self.loaded.append((resource_id, [r['ref'] for r in records]))
+            return 0, []
+
+        class SiteAction(object):
+            def package_search(self, **kwargs):
+                return {'results': [{
+                    'organization': {'name': 'org'},
+                    'resources': [{'name': 'res', 'id': 'res-id'}]}]}
+
+            def recombinant_create(self, dataset_type, owner_org):
+                pass
+
+        read_csv.open_csv = open_csv
+        commands._load_org_batch = load_org_batch
+        commands.get_schema = lambda name: {
+            'resource_name': 'res',
+            'dataset_type': 'type',
+            'fields': [{'datastore_id': 'ref', 'datastore_type': 'text'}]}
+        commands.LocalCKAN = lambda: FakeCKAN(SiteAction())
+
+        fd, self.csv_path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'wb') as f:
+            f.write('ref,owner_org,owner_org_title\r\n'
+                'a,org,Org\r\nb,missing,Missing\r\n')
+
+    def teardown(self):
+        for name, value in self.saved.items():
+            setattr(commands, name, value)
+        read_csv.open_csv = self.open_csv
+        os.remove(self.csv_path)
+
+    def test_file_read_once(self):
+        command = commands.TableCommand.__new__(commands.TableCommand)
+        errors = command._load_one_csv_file(self.csv_path, resource_name='res')
+        # 'missing' has no dataset, even after recombinant_create
+        assert_equal(errors & 1, 1)
+        assert_equal(self.opened, [self.csv_path])
+        assert_equal(self.loaded, [('res-id', [u'a'])])
@@ -0,0 +1,92 @@
+from cStringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+import ckan_stubs
+ckan_stubs.install()
+
+from ckan.logic import ValidationError
+
+from ckanext.recombinant import controller
+from ckanext.recombinant.errors import BadExcelData
+from ckanext.recombinant.schema import ResourceSchema
+
+CHROMO = {
+    'resource_name': 'res',
+    'datastore_primary_key': ['ref'],
+    'fields': [
+        {'datastore_id': 'ref', 'datastore_type': 'text'},
+        ]}
+
+DATASET = {
+    'owner_org': 'org-id',
+    'organization': {'name': 'org'},
+    'resources': [{'name': 'res', 'id': 'res-id'}],
+    }
+
+
+class FakeAction(object):
+    """
+    datastore_upsert that rejects records with a bad 'ref' and keeps the
+    others unless called with dry_run, like the datastore does
+    """
+    def __init__(self, bad):
+        self.bad = bad
+        self.calls = []
+        self.loaded = []
+
+    def datastore_upsert(self, method, resource_id, records, dry_run):
+        self.calls.append((len(records), dry_run))
+        for i, r in enumerate(records):
+            if r['ref'] in self.bad:
+                raise ValidationError({
+                    'records': [u'rejected by trigger'],
+                    '_records_row': i})
+        if not dry_run:
+            self.loaded.extend(r['ref'] for r in records)
+
+
+class FakeCKAN(object):
+    def __init__(self, action):
+        self.action = action
+
+
+class TestProcessUploadFile(object):
+    def setup(self):
+        self.config = controller.config
+        self.get_schema = controller.get_schema
+        controller.config = {'recombinant.upload_chunk_size': '2'}
+        controller.get_schema = lambda name: ResourceSchema(CHROMO)
+
+    def teardown(self):
+        controller.config = self.config
+        controller.get_schema = self.get_schema
+
+    def _upload(self, action, dry_run=False):
+        f = StringIO('ref,owner_org\r\na,org\r\nb,org\r\nc,org\r\n')
+        return controller._process_upload_file(
+            FakeCKAN(action), DATASET, f, None, dry_run, filename='res.csv')
+
+    def test_all_chunks_written(self):
+        action = FakeAction(set())
+        self._upload(action)
+        assert_equal(action.loaded, [u'a', u'b', u'c'])
+        assert_equal(action.calls,
+            [(2, True), (1, True), (2, False), (1, False)])
+
+    def test_database_error_in_later_chunk(self):
+        action = FakeAction(set([u'c']))
+        with assert_raises(BadExcelData):
+            self._upload(action)
+        assert_equal(action.loaded, [])
+
+    def test_dry_run(self):
+        action = FakeAction(set())
+        self._upload(action, dry_run=True)
+        assert_equal(action.calls, [(2, True), (1, True)])
+
+
+def test_read_upload_without_resources():
+    f = StringIO('ref,owner_org\r\na,org\r\n')
+    with assert_raises(BadExcelData):
+        controller._read_upload(f, 'res.csv', {'resources': []}, None)
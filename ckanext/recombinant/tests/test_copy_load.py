@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Set RECOMBINANT_TEST_DSN to a PostgreSQL 9.5+ connection string, e.g.
+"dbname=recombinant_test", to run the copy_upsert tests against a
+database. They create and drop a table named copy_load_test.
+"""
+import os
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equal
+
+from ckanext.recombinant.copy_load import (
+    copy_upsert, copy_value, last_for_each_key, CopyStream)
+
+
+def test_copy_value():
+    assert_equal(copy_value(None), u'\\N')
+    assert_equal(copy_value(u'a\tb\\c\r\nd'), u'a\\tb\\\\c\\r\\nd')
+    assert_equal(copy_value([u'x', u'y "z"']), u'{"x","y \\\\"z\\\\""}')
+    assert_equal(copy_value(u''), u'')
+
+
+def test_copy_stream():
+    stream = CopyStream([{'a': u'é', 'b': None}, {'a': u'2'}], ['a', 'b'])
+    data = b''.join(iter(lambda: stream.read(3), b''))
+    assert_equal(data, u'é\t\\N\n2\t\\N\n'.encode('utf-8'))
+
+
+def test_last_for_each_key():
+    records = [{'k': u'1', 'v': 1}, {'k': u'2', 'v': 2}, {'k': u'1', 'v': 3}]
+    assert_equal(last_for_each_key(records, ['k']), records[1:])
+
+
+class TestCopyUpsert(object):
+    def setup(self):
+        dsn = os.environ.get('RECOMBINANT_TEST_DSN')
+        if not dsn:
+            raise SkipTest('RECOMBINANT_TEST_DSN not set')
+        import psycopg2
+        self.conn = psycopg2.connect(dsn)
+        cur = self.conn.cursor()
+        cur.execute('DROP TABLE IF EXISTS copy_load_test')
+        cur.execute(
+            'CREATE TABLE copy_load_test (_id serial, _full_text tsvector, '
+            'k text PRIMARY KEY, n int, tags text[], touched int)')
+        cur.execute(
+            'CREATE OR REPLACE FUNCTION copy_load_test_touch() '
+            'RETURNS trigger AS $$ BEGIN NEW.touched := 1; RETURN NEW; END; '
+            '$$ LANGUAGE plpgsql')
+        cur.execute(
+            'CREATE TRIGGER copy_load_test_touch BEFORE INSERT OR UPDATE '
+            'ON copy_load_test FOR EACH ROW '
+            'EXECUTE PROCEDURE copy_load_test_touch()')
+        self.conn.commit()
+
+    def teardown(self):
+        cur = self.conn.cursor()
+        cur.execute('DROP TABLE copy_load_test')
+        cur.execute('DROP FUNCTION copy_load_test_touch()')
+        self.conn.commit()
+        self.conn.close()
+
+    def test_upsert(self):
+        copy_upsert(self.conn, 'copy_load_test', ['k', 'n', 'tags'], ['k'], [
+            {'k': u'a', 'n': u'1', 'tags': [u'x']},
+            {'k': u'b', 'n': None, 'tags': []}])
+        copy_upsert(self.conn, 'copy_load_test', ['k', 'n', 'tags'], ['k'], [
+            {'k': u'b', 'n': u'2', 'tags': [u'y', u'z']},
+            {'k': u'c', 'n': u'3', 'tags': None},
+            {'k': u'c', 'n': u'4', 'tags': None}])
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT k, n, tags, touched, _full_text IS NOT NULL '
+            'FROM copy_load_test ORDER BY k')
+        assert_equal(cur.fetchall(), [
+            ('a', 1, ['x'], 1, True),
+            ('b', 2, ['y', 'z'], 1, True),
+            ('c', 4, None, 1, True)])
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import os
+import bz2
+import gzip
+import codecs
+import tempfile
+from cStringIO import StringIO
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.recombinant.errors import BadExcelData
+from ckanext.recombinant.read_csv import (
+    upload_format, read_csv_upload, read_ndjson_upload,
+    csv_data_batch, OrgPartition, csv_resource_name)
+
+
+CHROMO = {
+    'resource_name': 'res',
+    'datastore_primary_key': ['ref'],
+    'fields': [
+        {'datastore_id': 'ref', 'datastore_type': 'text'},
+        {'datastore_id': 'kind', 'datastore_type': '_text'},
+        {'datastore_id': 'hidden', 'datastore_type': 'text',
+            'import_template_include': False},
+        {'datastore_id': 'amount', 'datastore_type': 'money'},
+        ]}
+
+
+def test_upload_format():
+    assert_equal(upload_format(StringIO('PK\x03\x04...')), 'xlsx')
+    assert_equal(upload_format(StringIO(codecs.BOM_UTF8 + 'ref,kind')), 'csv')
+    assert_equal(upload_format(StringIO('\n {"ref": "a"}\n')), 'ndjson')
+
+
+def test_read_csv_upload():
+    f = StringIO(codecs.BOM_UTF8 + (
+        u'amount,ref,kind,hidden,owner_org,owner_org_title\r\n'
+        u'1.50,a,"x,y",h,org,Org\r\n'
+        u',,,,,\r\n'
+        u'2,é,,,org,Org\r\n').encode('utf-8'))
+    [(name, org, columns, rows)] = read_csv_upload(f, CHROMO)
+    assert_equal((name, org, columns), ('res', 'org', ['ref', 'kind', 'amount']))
+    assert_equal(list(rows), [
+        (2, [u'a', u'x,y', u'1.50']),
+        (4, [u'é', u'', u'2'])])
+
+
+def test_read_csv_upload_columns_and_org():
+    f = StringIO('ref,amount,owner_org\r\na,1,org\r\n')
+    [(name, org, columns, rows)] = read_csv_upload(f, CHROMO)
+    assert_equal(columns, ['ref', 'amount'])
+
+    f = StringIO('ref,kind,amount,owner_org\r\na,,1,org\r\nb,,2,other\r\n')
+    [(name, org, columns, rows)] = read_csv_upload(f, CHROMO)
+    with assert_raises(BadExcelData):
+        list(rows)
+
+
+def test_read_ndjson_upload():
+    f = StringIO(
+        '{"ref": "a", "kind": ["x", "y"], "amount": 1.5, "owner_org": "org"}\n'
+        '\n'
+        '{"ref": "b", "owner_org": "org"}\n')
+    [(name, org, columns, rows)] = read_ndjson_upload(f, CHROMO)
+    assert_equal((name, org, columns), ('res', 'org', ['ref', 'kind', 'amount']))
+    assert_equal(list(rows), [
+        (1, [u'a', u'x,y', 1.5]),
+        (3, [u'b', None, None])])
+
+    f = StringIO('{"ref": "a", "owner_org": "org", "typo": 1}\n')
+    with assert_raises(BadExcelData):
+        list(read_ndjson_upload(f, CHROMO))
+
+
+def test_csv_data_batch_unsorted():
+    f = tempfile.NamedTemporaryFile(suffix='.csv')
+    f.write('ref,amount,owner_org,owner_org_title\r\n'
+        'a,1,org,Org\r\nb,,other,Other\r\nc,3,org,Org\r\n'
+        'd,4,third,Third\r\ne,5,other,Other\r\nf,6,org,Org\r\n')
+    f.flush()
+    batches = csv_data_batch(f.name, CHROMO, strict=False, positions=True,
+        buffer_rows=2)
+    assert_equal(
+        [(org, [r['ref'] for r in records], rows)
+            for org, records, rows, position in batches],
+        [(u'org', [u'a'], [2]),
+            (u'other', [u'b', u'e'], [3, 6]),
+            (u'org', [u'c', u'f'], [4, 7]),
+            (u'third', [u'd'], [5])])
+
+    first = next(csv_data_batch(f.name, CHROMO, strict=False))
+    assert_equal(first,
+        (u'org', [{u'ref': u'a', u'kind': None, u'amount': u'1'}]))
+
+
+def test_csv_data_batch_start():
+    f = tempfile.NamedTemporaryFile(suffix='.csv')
+    f.write(codecs.BOM_UTF8 + 'ref,amount,owner_org,owner_org_title\r\n'
+        '"a\nb",1,org,Org\r\nc,2,org,Org\r\nd,,other,Other\r\n')
+    f.flush()
+    batches = list(csv_data_batch(f.name, CHROMO, strict=False,
+        positions=True))
+    assert_equal([rows for org, records, rows, position in batches],
+        [[2, 3], [4]])
+    position = batches[0][3]
+    assert_equal(
+        list(csv_data_batch(f.name, CHROMO, strict=False, positions=True,
+            start=position)),
+        batches[1:])
+
+
+def test_csv_data_batch_compressed():
+    data = codecs.BOM_UTF8 + 'ref,amount,owner_org,owner_org_title\r\n' \
+        'a,1,org,Org\r\nb,2,other,Other\r\n'
+    for suffix, opener in [('.csv.gz', gzip.open), ('.csv.bz2', bz2.BZ2File)]:
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            f = opener(path, 'wb')
+            f.write(data)
+            f.close()
+            batches = list(csv_data_batch(path, CHROMO, strict=False,
+                positions=True))
+            assert_equal([(org, rows) for org, r, rows, p in batches],
+                [(u'org', [2]), (u'other', [3])])
+            assert_equal(
+                list(csv_data_batch(path, CHROMO, strict=False,
+                    positions=True, start=batches[0][3])),
+                batches[1:])
+        finally:
+            os.remove(path)
+
+
+def test_csv_resource_name():
+    assert_equal(csv_resource_name('/data/ati.csv'), 'ati')
+    assert_equal(csv_resource_name('ati.csv.xz'), 'ati')
+    assert_equal(csv_resource_name('ati.json.gz'), None)
+    assert_equal(csv_resource_name('-'), None)
+
+
+def test_org_partition():
+    partition = OrgPartition(buffer_rows=3, max_open_files=1)
+    for n in range(10):
+        partition.add(u'org{0}'.format(n % 3), n, {u'n': n})
+    assert_equal(
+        [(org, rows) for org, records, rows in partition.batches()],
+        [(u'org0', [0, 3, 6, 9]), (u'org1', [1, 4, 7]), (u'org2', [2, 5, 8])])
+    partition.close()
+    assert not os.path.exists(partition.spill_dir)
@@ -0,0 +1,113 @@
+from cStringIO import StringIO
+from datetime import datetime
+
+import openpyxl
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.recombinant.errors import BadExcelData
+from ckanext.recombinant.read_excel import (
+    get_record_chunks, read_excel)
+from ckanext.recombinant.read_xlsx import read_xlsx
+from ckanext.recombinant import read_xlsx as read_xlsx_module
+
+FIELDS = [
+    {'datastore_id': 'a', 'datastore_type': 'text'},
+    {'datastore_id': 'b', 'datastore_type': 'int'},
+    ]
+
+
+def test_record_chunks_keep_row_numbers():
+    rows = ((n, [u'x%d' % n, float(n)]) for n in range(6, 11))
+    chunks = list(get_record_chunks(rows, FIELDS, set(['a']), {}, 2))
+    assert_equal([len(c) for c in chunks], [2, 2, 1])
+    assert_equal(chunks[2], [(10, {'a': u'x10', 'b': u'10'})])
+
+def test_record_chunks_error_row():
+    rows = [(6, [u'x', 1.0]), (7, [u'y', 2.0]), (8, [u'z', u'=A1'])]
+    chunks = get_record_chunks(rows, FIELDS, set(['a']), {}, 2)
+    assert_equal(len(next(chunks)), 2)
+    with assert_raises(BadExcelData) as cm:
+        next(chunks)
+    assert cm.exception.message.startswith(u'Row 8:')
+
+def test_read_xlsx_matches_read_excel():
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'res'
+    sheet.append([None, None, u'Title'])
+    sheet.append([None, None, u'A', u'B', u'C'])
+    sheet.append([u'v3', u'org', u'a', u'b', u'c'])
+    sheet.append([])
+    sheet.append([u'e.g.', None, u'x', 1])
+    sheet.append([u'=IF(e1!A6>0,1,"")', u'=r1!B6', u'x_x000D_', 2.5,
+        datetime(2019, 1, 2)])
+    sheet.append([u'=A7', None, u' '])
+    sheet.append([None, None, u'=TRUE()', True, 7])
+    book.create_sheet('reference')
+    book.create_sheet('e1').append([u'never read'])
+    data = StringIO()
+    book.save(data)
+
+    def contents(reader):
+        return [(s, o, n, list(r)) for s, o, n, r in reader(data)]
+
+    expected = contents(read_excel)
+    assert_equal(expected[0][3][0], (6, [u'x\r', 2.5, datetime(2019, 1, 2)]))
+    assert_equal([r[0] for r in expected[0][3]], [6, 8])
+    assert_equal(contents(read_xlsx), expected)
+
+def test_skip_after_blank_rows():
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'res'
+    sheet.append([None, None, u'Title'])
+    sheet.append([None, None, u'A'])
+    sheet.append([u'v3', u'org', u'a'])
+    sheet.append([])
+    sheet.append([u'e.g.', None, u'x'])
+    sheet.append([u'=A6', None, u'1'])
+    for r in range(7, 60):
+        # formatting and status formulas copied below the data
+        sheet.cell(row=r, column=1).value = u'=A%d' % r
+        sheet.cell(row=r, column=3).number_format = '0.00'
+    sheet.cell(row=20, column=3).value = u' '
+    sheet.cell(row=40, column=3).value = u'2'
+    data = StringIO()
+    book.save(data)
+
+    converted = []
+    row = read_xlsx_module._SheetRows._row
+    def counting_row(self, element, *args):
+        converted.append(element.get('r'))
+        return row(self, element, *args)
+
+    read_xlsx_module._SheetRows._row = counting_row
+    try:
+        [(sheet, org, names, rows)] = read_xlsx(data, 3)
+        assert_equal(list(rows), [(6, [u'1']), (40, [u'2'])])
+    finally:
+        read_xlsx_module._SheetRows._row = row
+    assert_equal(converted,
+        ['1', '2', '3', '5', '6', '7', '8', '9', '20', '40', '41', '42', '43'])
+
+    [(sheet, org, names, rows)] = read_excel(data, blank_rows=3)
+    assert_equal([r[0] for r in rows], [6, 40])
+
+def test_blank_header_rows():
+    blank = openpyxl.Workbook()
+    sheet = blank.active
+    sheet.title = 'res'
+    sheet.append([None, None, u'Title'])
+    sheet.append([None, None, u'A'])
+    sheet.row_dimensions[3].height = 20  # row without cells
+    sheet.row_dimensions[5].height = 20
+    short = openpyxl.Workbook()
+    short.active.title = 'res'
+    short.active.append([None, None, u'Title'])
+
+    for book in blank, short:
+        data = StringIO()
+        book.save(data)
+        for reader in read_excel, read_xlsx:
+            with assert_raises(BadExcelData):
+                next(reader(data))
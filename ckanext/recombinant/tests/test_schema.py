@@ -0,0 +1,39 @@
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.recombinant.schema import ResourceSchema, resource_schema
+
+
+CHROMO = {
+    'resource_name': 'res',
+    'datastore_primary_key': ['c', 'a'],
+    'fields': [
+        {'datastore_id': 'a', 'datastore_type': 'text'},
+        {'datastore_id': 'x', 'datastore_type': '_text',
+            'import_template_include': False, 'choices': {}},
+        {'datastore_id': 'b', 'datastore_type': 'int',
+            'choices_file': 'b.json', 'excel_full_text_choices': True},
+        {'datastore_id': 'c', 'datastore_type': 'date'},
+        ]}
+
+
+def test_precomputed_lookups():
+    schema = ResourceSchema(CHROMO)
+    assert_equal(schema.template_ids, ('a', 'b', 'c'))
+    assert_equal(schema.template_index, {'a': 0, 'b': 1, 'c': 2})
+    assert_equal(schema.primary_key, ('c', 'a'))
+    assert_equal(
+        [f['datastore_id'] for f in schema.primary_key_fields], ['a', 'c'])
+    assert_equal(schema.choice_fields, {'x': True, 'b': 'full'})
+    assert_equal(schema.list_fields, ('x',))
+    assert_equal(schema.datastore_types['c'], 'date')
+
+def test_chromo_access_and_read_only():
+    schema = resource_schema(CHROMO)
+    assert resource_schema(schema) is schema
+    assert_equal(schema['resource_name'], 'res')
+    assert_equal(schema.get('excel_data_num_rows', 2000), 2000)
+    assert 'datastore_primary_key' in schema
+    with assert_raises(AttributeError):
+        schema.fields = ()
+    with assert_raises(AttributeError):
+        schema.other = 1
@@ -0,0 +1,78 @@
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.recombinant.template_cache import (
+    TemplateCache, geno_fingerprint)
+
+
+def test_hit_miss_counters():
+    cache = TemplateCache(max_bytes=100)
+    assert_equal(cache.get(('a', 'en')), None)
+    cache.put(('a', 'en'), 'x' * 10)
+    assert_equal(cache.get(('a', 'en')), 'x' * 10)
+    assert_equal(cache.get(('a', 'fr')), None)
+    stats = cache.stats()
+    assert_equal(stats['hits'], 1)
+    assert_equal(stats['misses'], 2)
+    assert_equal(stats['bytes'], 10)
+
+def test_evict_least_recently_used_by_size():
+    cache = TemplateCache(max_bytes=25)
+    cache.put(('a',), 'a' * 10)
+    cache.put(('b',), 'b' * 10)
+    cache.get(('a',))
+    cache.put(('c',), 'c' * 10)
+    assert_equal(cache.get(('b',)), None)
+    assert_equal(cache.get(('a',)), 'a' * 10)
+    assert_equal(cache.get(('c',)), 'c' * 10)
+    assert_equal(cache.stats()['evictions'], 1)
+    assert_equal(cache.stats()['bytes'], 20)
+
+def test_oversize_entries_not_kept_in_memory():
+    cache = TemplateCache(max_bytes=5)
+    cache.put(('a',), 'a' * 10)
+    assert_equal(cache.get(('a',)), None)
+
+def test_get_or_build():
+    cache = TemplateCache(max_bytes=100)
+    built = []
+    def build():
+        built.append(1)
+        return 'data'
+    assert_equal(cache.get_or_build(('k',), build), 'data')
+    assert_equal(cache.get_or_build(('k',), build), 'data')
+    assert_equal(len(built), 1)
+
+def test_disk_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = TemplateCache(max_bytes=100, cache_dir=cache_dir)
+        cache.put(('a',), 'a' * 10)
+
+        cache = TemplateCache(max_bytes=100, cache_dir=cache_dir)
+        assert_equal(cache.get(('a',)), 'a' * 10)
+        assert_equal(cache.stats()['disk_hits'], 1)
+        assert_equal(cache.get(('a',)), 'a' * 10)
+        assert_equal(cache.stats()['hits'], 1)
+
+        cache = TemplateCache(
+            max_bytes=100, cache_dir=cache_dir, max_disk_bytes=15)
+        cache.put(('b',), 'b' * 10)
+        cache.clear()
+        assert_equal(cache.get(('a',)), None)
+        assert_equal(cache.get(('b',)), 'b' * 10)
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_geno_fingerprint():
+    geno = {'dataset_type': 'a', 'resources': []}
+    fingerprint = geno_fingerprint(geno)
+    assert '_digest' in geno
+    assert_equal(geno_fingerprint(geno), fingerprint)
+    other = {'dataset_type': 'b', 'resources': []}
+    assert geno_fingerprint(other) != fingerprint
+    assert_equal(
+        geno_fingerprint({'dataset_type': 'a', 'resources': []}),
+        fingerprint)
@@ -0,0 +1,128 @@
+import hashlib
+
+from nose.tools import assert_equal, assert_in
+
+from ckanext.recombinant.schema import ResourceSchema
+from ckanext.recombinant.upload_diff import (
+    RecordDiff, normalize_value, value_text)
+
+
+CHROMO = {
+    'resource_name': 'res',
+    'datastore_primary_key': ['ref'],
+    'fields': [
+        {'datastore_id': 'ref', 'datastore_type': 'text'},
+        {'datastore_id': 'amount', 'datastore_type': 'numeric'},
+        {'datastore_id': 'when', 'datastore_type': 'date'},
+        ]}
+COLUMN_TYPES = {'ref': 'text', 'amount': 'numeric', 'when': 'date'}
+
+
+def test_normalize_value():
+    assert_equal(normalize_value(u'1.50', 'numeric'), u'1.5')
+    assert_equal(normalize_value(1.5, 'numeric'), u'1.5')
+    assert_equal(normalize_value(u'10', 'int'), normalize_value(10, 'int'))
+    assert_equal(normalize_value(u'100.0', 'numeric'), u'100')
+    assert_equal(normalize_value(u'n/a', 'int'), u'n/a')
+    assert_equal(normalize_value(u'Y', 'bool'), True)
+    assert_equal(normalize_value(u'2017-01-02T00:00:00', 'date'),
+        u'2017-01-02')
+    assert_equal(normalize_value(u'2017-01-02 10:00:00', 'timestamp'),
+        u'2017-01-02T10:00:00')
+    assert_equal(normalize_value([u'a', 1], '_text'), [u'a', u'1'])
+    assert_equal(normalize_value(None, 'text'), None)
+
+
+def test_changed_records():
+    diff = RecordDiff(ResourceSchema(CHROMO), COLUMN_TYPES)
+    diff.changed([
+        (1, {'ref': u'a', 'amount': 1, 'when': u'2017-01-02T00:00:00'}),
+        (2, {'ref': u'b', 'amount': 2, 'when': None}),
+        ])
+    diff.new = 0
+
+    records = [
+        (3, {'ref': u'a', 'amount': u'1.00', 'when': u'2017-01-02'}),
+        (4, {'ref': u'b', 'amount': u'3', 'when': None}),
+        (5, {'ref': u'c', 'amount': u'4', 'when': None}),
+        ]
+    assert_equal([n for n, r in diff.changed(records)], [4, 5])
+    assert_equal((diff.new, diff.updated, diff.unchanged), (1, 1, 1))
+
+
+def test_repeated_key_compares_with_earlier_record():
+    diff = RecordDiff(ResourceSchema(CHROMO), COLUMN_TYPES)
+    records = [
+        (1, {'ref': u'a', 'amount': u'1', 'when': None}),
+        (2, {'ref': u'a', 'amount': u'1', 'when': None}),
+        (3, {'ref': u'a', 'amount': u'2', 'when': None}),
+        ]
+    assert_equal([n for n, r in diff.changed(records)], [1, 3])
+    assert_equal((diff.new, diff.updated, diff.unchanged), (1, 1, 1))
+
+
+def test_value_text():
+    assert_equal(value_text(True), u'true')
+    assert_equal(value_text(None), None)
+    assert_equal(value_text([u'a', u'b c', u'', u'x"y', None]),
+        u'{a,"b c","","x\\"y",NULL}')
+
+
+def _pg_digest(texts):
+    """
+    the digest the database calculates, from values as PostgreSQL
+    would output them
+    """
+    return hashlib.md5(','.join(
+        hashlib.md5(t.encode('utf-8')).hexdigest() if t is not None else ''
+        for t in texts)).hexdigest()
+
+
+class FakeAction(object):
+    def __init__(self, pages):
+        self.pages = pages
+        self.sql = []
+
+    def datastore_search(self, resource_id, limit):
+        assert_equal(limit, 0)
+        return {'fields': [
+            {'id': k, 'type': v} for k, v in COLUMN_TYPES.items()]}
+
+    def datastore_search_sql(self, sql):
+        self.sql.append(sql)
+        return {'records': self.pages.pop(0)}
+
+
+class FakeCKAN(object):
+    def __init__(self, action):
+        self.action = action
+
+
+def test_from_datastore():
+    action = FakeAction([
+        [
+            {'_id': 1, 'ref': u'a',
+                '_digest': _pg_digest([u'a', u'1.5', u'2017-01-02'])},
+            {'_id': 4, 'ref': u'b',
+                '_digest': _pg_digest([u'b', u'2', None])},
+        ],
+        [
+            {'_id': 7, 'ref': u'c',
+                '_digest': _pg_digest([u'c', u'30', None])},
+        ]])
+    diff = RecordDiff.from_datastore(
+        FakeCKAN(action), 'res-id', ResourceSchema(CHROMO), page_size=2)
+
+    assert_equal(len(action.sql), 2)
+    assert_in(u'FROM "res-id" WHERE _id > 0 ', action.sql[0])
+    assert_in(u'WHERE _id > 4 ', action.sql[1])
+    assert_in(u'SELECT _id, "ref", md5(', action.sql[0])
+
+    records = [
+        (1, {'ref': u'a', 'amount': u'1.50', 'when': u'2017-01-02'}),
+        (2, {'ref': u'b', 'amount': u'3', 'when': None}),
+        (3, {'ref': u'c', 'amount': u'3E+1', 'when': None}),
+        (4, {'ref': u'd', 'amount': u'4', 'when': None}),
+        ]
+    assert_equal([n for n, r in diff.changed(records)], [2, 4])
+    assert_equal((diff.new, diff.updated, diff.unchanged), (1, 1, 2))
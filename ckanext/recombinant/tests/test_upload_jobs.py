@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+
+from nose.tools import assert_equal
+
+from ckanext.recombinant.upload_jobs import UploadJobs
+
+
+class TestUploadJobs(object):
+    def setup(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.ran = []
+        self.jobs = UploadJobs(
+            self.spool_dir,
+            enqueue=lambda func, args: self.ran.append((func, args)))
+
+    def teardown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_submit_spools_upload_and_queues_job(self):
+        job_id = self.jobs.submit(StringIO('xlsx'), 'run', user='u')
+        assert_equal(self.ran, [('run', [job_id])])
+        with open(self.jobs.upload_path(job_id), 'rb') as f:
+            assert_equal(f.read(), 'xlsx')
+        job = self.jobs.get(job_id)
+        assert_equal(job['status'], 'queued')
+        assert_equal(job['user'], 'u')
+        assert_equal(self.jobs.get('../' + job_id), None)
+
+    def test_spooled_upload_suffix_neutral(self):
+        job_id = self.jobs.submit(
+            StringIO('ref\r\na\r\n'), 'run', filename='res.csv')
+        assert not self.jobs.upload_path(job_id).endswith(
+            ('.xlsx', '.csv'))
+        assert_equal(self.jobs.get(job_id)['filename'], 'res.csv')
+
+    def test_progress_saved_to_state(self):
+        job_id = self.jobs.submit(StringIO('xlsx'), 'run')
+        progress = self.jobs.progress(job_id)
+        progress.start()
+        progress.sheet('res')
+        assert_equal(
+            [len(c) for c in progress.count_parsed([[1, 2], [3]])], [2, 1])
+        progress.upserted([1, 2])
+        job = self.jobs.get(job_id)
+        assert_equal(
+            (job['status'], job['sheet'], job['rows_parsed'],
+                job['rows_upserted']),
+            ('running', 'res', 3, 2))
+        progress.fail(u'Row 7: bad')
+        job = self.jobs.get(job_id)
+        assert_equal((job['status'], job['errors']), ('error', [u'Row 7: bad']))
+        assert not os.path.exists(self.jobs.upload_path(job_id))
+
+    def test_expire_removes_stale_files(self):
+        job_id = self.jobs.submit(StringIO('xlsx'), 'run')
+        stale = os.path.join(self.spool_dir, 'tmpdead.tmp')
+        open(stale, 'wb').close()
+        other = os.path.join(self.spool_dir, 'notes.txt')
+        open(other, 'wb').close()
+        old = os.stat(stale).st_mtime - self.jobs.expiry_seconds - 1
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            os.utime(path, (old, old))
+        self.jobs.expire()
+        assert_equal(os.listdir(self.spool_dir), ['notes.txt'])
+        assert_equal(self.jobs.get(job_id), None)
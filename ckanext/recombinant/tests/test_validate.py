@@ -0,0 +1,108 @@
+from nose.tools import assert_equal, assert_raises
+
+import ckan_stubs
+ckan_stubs.install()
+
+from ckanext.recombinant.errors import BadExcelData
+from ckanext.recombinant.schema import ResourceSchema
+from ckanext.recombinant.validate import RecordValidator
+
+
+CHROMO = {
+    'resource_name': 'res',
+    'datastore_primary_key': ['ref'],
+    'year_min': '2000',
+    'year_max': '2018+2',
+    'fields': [
+        {'datastore_id': 'ref', 'datastore_type': 'text'},
+        {'datastore_id': 'year', 'datastore_type': 'year'},
+        {'datastore_id': 'amount', 'datastore_type': 'money',
+            'excel_required': True},
+        {'datastore_id': 'when', 'datastore_type': 'date'},
+        {'datastore_id': 'kind', 'datastore_type': '_text',
+            'choices': {'a': 'A', 'b': 'B'}},
+        {'datastore_id': 'quarter', 'datastore_type': 'int',
+            'choices': {1: 'Q1', 2: 'Q2'}},
+        {'datastore_id': 'note', 'datastore_type': 'text',
+            'excel_required': True,
+            'excel_required_formula': '{kind}="a"'},
+        ]}
+
+
+def _errors(validator):
+    try:
+        validator.raise_errors()
+    except BadExcelData as e:
+        return e.errors
+    return []
+
+
+def test_valid_records():
+    validator = RecordValidator(ResourceSchema(CHROMO), 'res')
+    validator.check([
+        (4, {'ref': u'x', 'year': u'2020', 'amount': u'1.50',
+            'when': u'2017-02-28', 'kind': [u'a', u'b'], 'quarter': u'2'}),
+        (5, {'ref': u'y', 'year': None, 'amount': u'0',
+            'when': None, 'kind': []}),
+        (6, {}),
+        (7, {'ref': u'z', 'amount': u'1', 'when': u'2017/02/01'}),
+        (8, {'ref': u'w', 'amount': u'1', 'when': u'Feb 1 2017'}),
+        ])
+    assert_equal(_errors(validator), [])
+
+
+def test_all_errors_reported():
+    validator = RecordValidator(ResourceSchema(CHROMO), 'res')
+    validator.check([
+        (4, {'ref': u'', 'year': u'2021', 'amount': u'1.50',
+            'when': u'2017-02-30', 'kind': [u'a']}),
+        (5, {'ref': u'y', 'year': u'20x', 'amount': None,
+            'when': u'2017-02-01', 'kind': [u'c'], 'quarter': u'5'}),
+        ])
+    validator.check([
+        (6, {'ref': u'y', 'year': None, 'amount': u'lots',
+            'when': None, 'kind': []}),
+        ])
+    assert_equal(_errors(validator), [
+        u'Sheet res Row 4: ref: Missing value',
+        u'Sheet res Row 4: year: Value must be between 2000 and 2020',
+        u'Sheet res Row 4: when: Invalid date, use YYYY-MM-DD',
+        u'Sheet res Row 5: year: Invalid integer',
+        u'Sheet res Row 5: amount: Missing value',
+        u'Sheet res Row 5: kind: Invalid choice: "c"',
+        u'Sheet res Row 5: quarter: Invalid choice: "5"',
+        u'Sheet res Row 6: amount: Invalid number',
+        u'Sheet res Row 6: ref: Duplicate primary key, same as row 5',
+        ])
+
+
+def test_postgres_input_syntax():
+    chromo = {
+        'resource_name': 'res',
+        'fields': [
+            {'datastore_id': 'n', 'datastore_type': 'numeric'},
+            {'datastore_id': 'b', 'datastore_type': 'boolean'},
+            ]}
+    validator = RecordValidator(ResourceSchema(chromo), 'res')
+    validator.check([
+        (4, {'n': u'NaN', 'b': u't'}),
+        (5, {'n': u' 1.5 ', 'b': u' Yes '}),
+        (6, {'n': u'-0', 'b': u'of'}),
+        (7, {'n': u'1e3', 'b': u'FAL'}),
+        (8, {'n': u'1,5', 'b': u'o'}),
+        (9, {'n': u'one', 'b': u'nope'}),
+        ])
+    assert_equal(_errors(validator), [
+        u'Sheet res Row 8: n: Invalid number',
+        u'Sheet res Row 8: b: Invalid true/false value',
+        u'Sheet res Row 9: n: Invalid number',
+        u'Sheet res Row 9: b: Invalid true/false value',
+        ])
+
+
+def test_max_errors():
+    validator = RecordValidator(ResourceSchema(CHROMO), 'res', max_errors=2)
+    records = [(n, {'ref': u'', 'amount': u'1'}) for n in range(4, 10)]
+    with assert_raises(BadExcelData) as cm:
+        validator.check(records)
+    assert_equal(len(cm.exception.errors), 3)
@@ -0,0 +1,261 @@
+import re
+import zipfile
+from cStringIO import StringIO
+
+import openpyxl
+from nose.tools import assert_equal, assert_raises
+
+import ckan_stubs
+ckan_stubs.install()
+
+import pylons
+from ckanext.recombinant import tables, write_excel
+from ckanext.recombinant.errors import RecombinantException
+from ckanext.recombinant.schema import compile_schemas
+from ckanext.recombinant.template_cache import TemplateCache
+from ckanext.recombinant.write_excel import (
+    _calc_formula_columns, _excel_e_key_formulas, _multi_choice_error_formula,
+    _excel_table_columns, _data_cell_style, excel_template,
+    write_excel_template)
+
+
+def test_relative_formulas_shared():
+    columns = _calc_formula_columns([
+        (3, "=NOT('res'!C{num}=\"\")*(COUNTIF(reference!$C$5:$C$9,"
+            "TRIM('res'!C{num}))=0)"),
+        (4, "=SUMPRODUCT(--(TRIM('res'!D$6:D{num})=TRIM('res'!D{num})))>1"),
+        ], 2000)
+    assert_equal(columns[0][2], 0)
+    assert_equal(columns[1][2], 1)
+
+def test_row_number_formulas_not_shared():
+    columns = _calc_formula_columns([
+        (3, "='res'!C{num}>{num}"),
+        (4, "='res'!D{num}>reference!C5"),
+        (5, "='res'!E{num}=\"\""),
+        ], 2000)
+    assert_equal([si for (_c, _f, si) in columns], [None, None, 0])
+
+def test_duplicate_key_helper_columns():
+    chromo = {
+        'resource_name': 'res',
+        'datastore_primary_key': ['a', 'c'],
+        'excel_data_num_rows': 100,
+        'fields': [
+            {'datastore_id': 'a'},
+            {'datastore_id': 'b'},
+            {'datastore_id': 'x', 'import_template_include': False},
+            {'datastore_id': 'c'},
+            ]}
+    key, dup = _excel_e_key_formulas(chromo)
+    assert_equal(key, (
+        6, "=TRIM('res'!C{num})&CHAR(31)&TRIM('res'!E{num})"))
+    assert_equal(dup[0], 7)
+    assert 'F$6:F$105,0)<ROW()-5' in dup[1]
+    assert_equal(
+        [si for (_c, _f, si) in _calc_formula_columns([key, dup], 100)],
+        [0, 1])
+
+def test_multi_choice_formula_shared():
+    fmla = _multi_choice_error_formula(
+        'choices!$A$1:$A$500', 'SEARCH("old",{cell})')
+    assert fmla.startswith('IF((LEN(SUBSTITUTE({cell}," ",""))')
+    assert ',SEARCH("old",{cell}),OR(' in fmla
+    fmla = "=NOT('res'!C{num}=\"\")*(" + fmla.replace(
+        '{cell}', "'res'!C{num}") + ")"
+    assert_equal(_calc_formula_columns([(3, fmla)], 2000)[0][2], 0)
+
+def test_table_calculated_columns():
+    chromo = {
+        'resource_name': 'res',
+        'datastore_primary_key': ['a'],
+        'fields': [
+            {'datastore_id': 'a', 'datastore_type': 'text'},
+            {'datastore_id': 'b', 'datastore_type': 'int',
+                'excel_required': True},
+            ]}
+    names, formulas = _excel_table_columns(chromo, {}, {}, 'reco1')
+    assert_equal(names, [
+        u'~status', u'~type here', 'a', 'b', u'~e a', u'~e b', u'~r a',
+        u'~r b', u'~error', u'~required', u'~has data', u'~key',
+        u'~duplicate'])
+    assert_equal(sorted(formulas), [1, 2, 5, 6, 7, 8, 9, 10, 11, 12, 13])
+    assert_equal(formulas[5], (
+        '=NOT(reco1[[#This Row],[a]]="")*(reco1[[#This Row],[~duplicate]])'))
+    assert_equal(formulas[8], (
+        '=reco1[[#This Row],[~has data]]*(reco1[[#This Row],[b]]="")'))
+    assert_equal(formulas[12], '=TRIM(reco1[[#This Row],[a]])')
+    assert 'MATCH(TRUE,INDEX(reco1[[#This Row],[~e a]:[~e b]]<>0,),)+2' in (
+        formulas[9])
+    assert ',reco1[[~key]],0)<ROW()-5' in formulas[13]
+
+def test_table_row_number_formulas():
+    chromo = {
+        'resource_name': 'res',
+        'fields': [
+            {'datastore_id': 'a', 'datastore_type': 'text',
+                'excel_error_formula': 'AND({default_formula},{num}>7)'},
+            {'datastore_id': 'b', 'datastore_type': 'text',
+                'excel_required_formula': 'MOD({num},2)=0'},
+            ]}
+    names, formulas = _excel_table_columns(chromo, {}, {}, 'reco1')
+    assert_equal(formulas[5],
+        '=NOT(reco1[[#This Row],[a]]="")*(AND((FALSE()),ROW()>7))')
+    assert_equal(formulas[8], '=reco1[[#This Row],[~has data]]*'
+        '(reco1[[#This Row],[b]]="")*(MOD(ROW(),2)=0)')
+
+    chromo['fields'][0]['excel_error_formula'] = '{cell}<>$C{num}'
+    with assert_raises(RecombinantException):
+        _excel_table_columns(chromo, {}, {}, 'reco1')
+
+def test_data_cell_styles_shared():
+    book = openpyxl.Workbook()
+    text = _data_cell_style(book, '@')
+    assert_equal(_data_cell_style(book, '@'), text)
+    assert _data_cell_style(book, 'yyyy-mm-dd') != text
+    assert_equal(len(book.named_styles), 3)
+
+
+def test_template_cache_key_write_only():
+    geno = {'dataset_type': 'a', 'resources': []}
+    cache = TemplateCache()
+    saved = []
+    def save_excel_template(dataset_type, org, out):
+        saved.append(pylons.config['recombinant.template_write_only'])
+        out.write(saved[-1])
+    patched = dict(
+        get_geno=lambda dataset_type: geno,
+        get_template_cache=lambda: cache,
+        save_excel_template=save_excel_template,
+        patch_template_org=lambda skeleton, geno, org: skeleton)
+    original = dict((k, getattr(write_excel, k)) for k in patched)
+    config = pylons.config
+    try:
+        for k, v in patched.items():
+            setattr(write_excel, k, v)
+        for write_only in ('false', 'true', 'false', 'true'):
+            pylons.config = {'recombinant.template_write_only': write_only}
+            assert_equal(
+                write_excel.excel_template_bytes('a', 'en', None),
+                write_only)
+    finally:
+        pylons.config = config
+        for k, v in original.items():
+            setattr(write_excel, k, v)
+    assert_equal(saved, ['false', 'true'])
+
+
+class FakePlugin(object):
+    def __init__(self, genos):
+        self._genos = genos
+        self._chromos = dict(
+            (c['resource_name'], c)
+            for g in genos.values() for c in g['resources'])
+        self._schemas = compile_schemas(self._chromos)
+
+
+def _sheet_protection(f):
+    archive = zipfile.ZipFile(f)
+    return [
+        re.search(r'<sheetProtection [^>]*>', archive.read(name)).group()
+        for name in sorted(archive.namelist())
+        if name.startswith('xl/worksheets/sheet')]
+
+
+def _sheet_summary(sheet):
+    cells = {}
+    for row in sheet.iter_rows():
+        for c in row:
+            style = (c.number_format, c.font.b, c.fill.fgColor.rgb,
+                c.alignment.wrap_text, c.protection.locked)
+            if c.value is not None or c.has_style:
+                cells[c.coordinate] = (c.value, style)
+    return {
+        'title': sheet.title,
+        'state': sheet.sheet_state,
+        'freeze_panes': sheet.freeze_panes,
+        'merged': sorted(str(r) for r in sheet.merged_cells.ranges),
+        'widths': dict((k, d.width)
+            for k, d in sheet.column_dimensions.items() if d.width),
+        'heights': dict((k, d.height)
+            for k, d in sheet.row_dimensions.items() if d.height),
+        'hidden_rows': sorted(k
+            for k, d in sheet.row_dimensions.items() if d.hidden),
+        'validations': sorted(
+            (str(v.sqref), v.type, v.formula1)
+            for v in sheet.data_validations.dataValidation),
+        'formatting': sorted(
+            (str(r.sqref), [rule.formula for rule in r.rules])
+            for r in sheet.conditional_formatting),
+        'cells': cells,
+        }
+
+
+class TestWriteExcelTemplate(object):
+    geno = {
+        'dataset_type': 'ds',
+        'template_version': 3,
+        'title': 'Dataset',
+        'resources': [{
+            'resource_name': 'res',
+            'title': 'Resource',
+            'datastore_primary_key': ['ref', 'year'],
+            'excel_data_num_rows': 20,
+            'fields': [
+                {'datastore_id': 'ref', 'label': 'Reference',
+                    'datastore_type': 'text', 'excel_required': True},
+                {'datastore_id': 'year', 'label': 'Year',
+                    'datastore_type': 'year'},
+                {'datastore_id': 'amount', 'label': 'Amount',
+                    'datastore_type': 'money',
+                    'excel_required_formula': '{ref}<>""'},
+                {'datastore_id': 'kind', 'label': 'Kind',
+                    'datastore_type': '_text',
+                    'choices': {'a': 'A', 'b': 'B'}},
+                {'datastore_id': 'quarter', 'label': 'Quarter',
+                    'datastore_type': 'int', 'excel_full_text_choices': True,
+                    'choices': {'1': 'Q1', '2': 'Q2'}},
+                {'datastore_id': 'when', 'label': 'When',
+                    'datastore_type': 'date'},
+                {'datastore_id': 'hidden', 'datastore_type': 'text',
+                    'import_template_include': False},
+                ],
+            'examples': {'record': {'ref': 'x', 'year': 2018}},
+            }],
+        }
+
+    def setup(self):
+        self._get_plugin = tables._get_plugin
+        plugin = FakePlugin({'ds': self.geno})
+        tables._get_plugin = lambda: plugin
+
+    def teardown(self):
+        tables._get_plugin = self._get_plugin
+
+    def test_same_as_excel_template(self):
+        org = {'name': 'org', 'title': 'Organization'}
+        expected = StringIO()
+        excel_template('ds', org).save(expected)
+        out = StringIO()
+        write_excel_template('ds', org, out)
+
+        # openpyxl doesn't read sheet protection back, compare the xml
+        assert_equal(_sheet_protection(out), _sheet_protection(expected))
+        assert 'sheet="1"' in _sheet_protection(out)[0]
+
+        expected = openpyxl.load_workbook(expected)
+        book = openpyxl.load_workbook(out)
+        assert_equal(book.sheetnames, expected.sheetnames)
+        for sheet, expected_sheet in zip(book, expected):
+            assert_equal(_sheet_summary(sheet), _sheet_summary(expected_sheet))
+
+    def test_v4_code_row_validation(self):
+        geno = dict(self.geno, template_version=4)
+        tables._get_plugin = lambda: FakePlugin({'ds': geno})
+        sheet = excel_template('ds', {'name': 'org', 'title': 'Org'})['res']
+        [v] = [v for v in sheet.data_validations.dataValidation
+            if v.type == 'custom']
+        assert_equal((str(v.sqref), v.formula1), ('A3:H3', 'FALSE'))
+        assert_equal(
+            [c.value for c in sheet[3]][:8],
+            ['v4', 'org', 'ref', 'year', 'amount', 'kind', 'quarter', 'when'])
@@ -0,0 +1,53 @@
+# -*- coding: UTF-8 -*-
+import zipfile
+from cStringIO import StringIO
+
+import openpyxl
+from nose.tools import assert_equal
+
+from ckanext.recombinant.xlsx_patch import replace_in_parts
+
+
+def _skeleton():
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = 'data'
+    sheet['C1'] = u'Title \N{em dash} {{org-title}}'
+    sheet['B3'] = u'{{org-name}}'
+    other = book.create_sheet('e1')
+    for i in range(1, 200):
+        other.cell(row=i, column=3).value = '=A{0}+1'.format(i)
+    blob = StringIO()
+    book.save(blob)
+    return blob.getvalue()
+
+def test_replace_org_values():
+    data = replace_in_parts(
+        _skeleton(),
+        ['xl/worksheets/sheet1.xml'],
+        [(u'{{org-name}}', u'tbs-sct'),
+         (u'{{org-title}}', u'Treasury Board <&> Secretariat')])
+    book = openpyxl.load_workbook(StringIO(data))
+    assert_equal(book['data']['B3'].value, u'tbs-sct')
+    assert_equal(
+        book['data']['C1'].value,
+        u'Title \N{em dash} Treasury Board <&> Secretariat')
+    assert_equal(book['e1']['C10'].value, '=A10+1')
+
+def test_other_parts_copied_unchanged():
+    skeleton = _skeleton()
+    data = replace_in_parts(
+        skeleton,
+        ['xl/worksheets/sheet1.xml'],
+        [(u'{{org-name}}', u'tbs-sct')])
+    src = zipfile.ZipFile(StringIO(skeleton))
+    dst = zipfile.ZipFile(StringIO(data))
+    assert_equal(src.namelist(), dst.namelist())
+    for name in src.namelist():
+        if name == 'xl/worksheets/sheet1.xml':
+            continue
+        assert_equal(src.getinfo(name).CRC, dst.getinfo(name).CRC)
+        assert_equal(
+            src.getinfo(name).compress_size,
+            dst.getinfo(name).compress_size)
+        assert_equal(src.read(name), dst.read(name))
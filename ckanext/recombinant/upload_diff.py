@@ -0,0 +1,189 @@
+"""
+Incremental uploads: uploaded records are compared with the rows already
+in the datastore so that only new and changed rows are sent to
+datastore_upsert.
+"""
+
+import hashlib
+import re
+from decimal import Decimal, InvalidOperation
+
+DIFF_PAGE_SIZE = 10000
+NUMERIC_TYPES = frozenset([
+    'int', 'int4', 'int8', 'bigint', 'smallint', 'numeric', 'float8'])
+TRUE_VALUES = frozenset([u'true', u't', u'yes', u'y', u'on', u'1'])
+FALSE_VALUES = frozenset([u'false', u'f', u'no', u'n', u'off', u'0'])
+MIDNIGHT_RE = re.compile(u'[T ]00:00:00$')
+ARRAY_QUOTE_RE = re.compile(u'[{}",\\\\\\s]')
+
+
+class RecordDiff(object):
+    """
+    Digests of existing rows' template field values keyed by primary
+    key, and counts of the uploaded records found new, updated or
+    unchanged by changed()
+    """
+    def __init__(self, schema, column_types, digests=None):
+        self.field_ids = schema.template_ids
+        self.key_index = [
+            schema.template_ids.index(k) for k in schema.primary_key]
+        self.column_types = [
+            column_types.get(fid, 'text') for fid in self.field_ids]
+        self.digests = digests if digests is not None else {}
+        self.new = 0
+        self.updated = 0
+        self.unchanged = 0
+
+    @classmethod
+    def from_datastore(cls, lc, resource_id, schema,
+            page_size=DIFF_PAGE_SIZE):
+        """
+        Read the primary key and a digest of each existing row in
+        resource_id with lc.action.datastore_search_sql, one page at a
+        time in _id order. The digests are calculated by the database so
+        the rows themselves are never transferred.
+        """
+        result = lc.action.datastore_search(
+            resource_id=resource_id, limit=0)
+        diff = cls(schema, dict(
+            (f['id'], f['type']) for f in result['fields']))
+        key_ids = [diff.field_ids[i] for i in diff.key_index]
+        sql = (
+            u'SELECT _id, {keys}, md5({digest}) AS _digest '
+            u'FROM {table} WHERE _id > {{last_id}} '
+            u'ORDER BY _id LIMIT {limit}').format(
+                keys=u', '.join(quote_identifier(k) for k in key_ids),
+                digest=u" || ',' || ".join(
+                    u"coalesce(md5({0}), '')".format(text_sql(fid, t))
+                    for fid, t in zip(diff.field_ids, diff.column_types)),
+                table=quote_identifier(resource_id),
+                limit=page_size)
+        last_id = 0
+        while True:
+            result = lc.action.datastore_search_sql(
+                sql=sql.format(last_id=last_id))
+            for record in result['records']:
+                key = tuple(
+                    normalize_value(record.get(k), diff.column_types[i])
+                    for k, i in zip(key_ids, diff.key_index))
+                diff.digests[key] = record['_digest']
+                last_id = record['_id']
+            if len(result['records']) < page_size:
+                return diff
+
+    def changed(self, records):
+        """
+        Return the records, a list of (row number, record), that are
+        new or differ from the existing rows
+        """
+        out = []
+        for n, record in records:
+            key, digest = self._key_digest(
+                [record.get(fid) for fid in self.field_ids])
+            old = self.digests.get(key)
+            if old == digest:
+                self.unchanged += 1
+                continue
+            if old is None:
+                self.new += 1
+            else:
+                self.updated += 1
+            # later records with the same key compare with this one
+            self.digests[key] = digest
+            out.append((n, record))
+        return out
+
+    def changed_chunks(self, chunks):
+        """
+        Generator of changed() for each chunk of records, skipping chunks
+        with no changes
+        """
+        for records in chunks:
+            records = self.changed(records)
+            if records:
+                yield records
+
+    def _key_digest(self, values):
+        values = [
+            normalize_value(v, t) for v, t in zip(values, self.column_types)]
+        key = tuple(values[i] for i in self.key_index)
+        return key, hashlib.md5(u','.join(
+            hashlib.md5(text.encode('utf-8')).hexdigest()
+            if text is not None else u''
+            for text in (value_text(v) for v in values))).hexdigest()
+
+
+def normalize_value(value, column_type):
+    """
+    Return value from an uploaded record or a datastore row as it would
+    compare once stored in a column_type column. Values that can't be
+    normalized are returned as-is so that they compare as changed.
+    """
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [normalize_value(v, 'text') for v in value]
+    if isinstance(value, bool):
+        return value
+    if column_type in NUMERIC_TYPES:
+        try:
+            return u'{0:f}'.format(Decimal(unicode(value)).normalize())
+        except InvalidOperation:
+            return value
+    if column_type == 'bool':
+        text = unicode(value).strip().lower()
+        if text in TRUE_VALUES:
+            return True
+        if text in FALSE_VALUES:
+            return False
+        return value
+    if column_type == 'date':
+        return MIDNIGHT_RE.sub(u'', unicode(value))
+    if column_type == 'timestamp':
+        return unicode(value).replace(u' ', u'T')
+    return unicode(value)
+
+
+def value_text(value):
+    """
+    Return a value from normalize_value as text_sql() renders it in the
+    database, or None for NULL
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, list):
+        return u'{%s}' % u','.join(_array_element(v) for v in value)
+    return unicode(value)
+
+
+def _array_element(value):
+    if value is None:
+        return u'NULL'
+    if (not value or value.upper() == u'NULL'
+            or ARRAY_QUOTE_RE.search(value)):
+        return u'"%s"' % value.replace(u'\\', u'\\\\').replace(
+            u'"', u'\\"')
+    return value
+
+
+def text_sql(field_id, column_type):
+    """
+    Return an SQL expression for field_id's value as text, normalized
+    like normalize_value() so that equal values give equal digests
+    """
+    column = quote_identifier(field_id)
+    if column_type == 'text':
+        return column
+    if column_type == 'numeric':
+        # trim_scale() only exists in PostgreSQL 13 and later
+        return (u"regexp_replace(regexp_replace({0}::text, "
+            u"'(\\.[0-9]*[1-9])0+$', '\\1'), '\\.0+$', '')").format(column)
+    if column_type == 'timestamp':
+        return u"replace({0}::text, ' ', 'T')".format(column)
+    return u'{0}::text'.format(column)
+
+
+def quote_identifier(name):
+    return u'"%s"' % name.replace(u'"', u'""')
@@ -0,0 +1,230 @@
+"""
+Background processing for uploaded Excel files.
+
+With recombinant.upload_async enabled the upload is spooled to disk and
+processed by a job instead of the web request. Job state is kept in a
+json file next to the spooled upload so that any web worker process can
+report progress on it.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import importlib
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+
+log = getLogger(__name__)
+
+DEFAULT_UPLOAD_WORKERS = 2
+DEFAULT_JOB_EXPIRY_SECONDS = 24 * 60 * 60
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+STATE_FILE_SUFFIX = '.json'
+UPLOAD_FILE_SUFFIX = '.upload'
+TEMP_FILE_SUFFIX = '.tmp'
+
+QUEUED, RUNNING, COMPLETE, FAILED = 'queued', 'running', 'complete', 'error'
+
+
+class UploadJobs(object):
+    """
+    Spooled uploads and job state files in spool_dir.
+
+    enqueue(func, args) is called to run func(*args) in the background,
+    by default on a pool of worker threads in this process. Any queue
+    with that signature may be used, e.g. ckan.lib.jobs.enqueue.
+    """
+    def __init__(self, spool_dir, enqueue=None,
+            workers=DEFAULT_UPLOAD_WORKERS,
+            expiry_seconds=DEFAULT_JOB_EXPIRY_SECONDS):
+        self.spool_dir = spool_dir
+        self.expiry_seconds = expiry_seconds
+        self._enqueue = enqueue
+        self._workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(spool_dir):
+            try:
+                os.makedirs(spool_dir)
+            except OSError:
+                if not os.path.isdir(spool_dir):
+                    raise
+
+    def submit(self, upload_file, run, **state):
+        """
+        spool upload_file, a file object, and queue run(job_id) to
+        process it. state is stored with the job for run to use.
+
+        :return: job_id
+        """
+        self.expire()
+        job_id = uuid.uuid4().hex
+        with open(self.upload_path(job_id), 'wb') as f:
+            shutil.copyfileobj(upload_file, f)
+        state.update(
+            id=job_id,
+            status=QUEUED,
+            created=time.time(),
+            sheet=None,
+            rows_parsed=0,
+            rows_upserted=0,
+            counts=None,
+            errors=[])
+        self._write_state(job_id, state)
+        self.enqueue(run, [job_id])
+        return job_id
+
+    def enqueue(self, func, args):
+        if self._enqueue is not None:
+            return self._enqueue(func, args)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self._workers)
+        self._pool.apply_async(func, args)
+
+    def get(self, job_id):
+        """
+        return the state dict for job_id or None
+        """
+        if not JOB_ID_RE.match(job_id or ''):
+            return None
+        try:
+            with open(self._state_path(job_id)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def progress(self, job_id):
+        """
+        return an UploadProgress for updating job_id's state
+        """
+        return UploadProgress(self, self.get(job_id))
+
+    def upload_path(self, job_id):
+        """
+        path of the spooled upload for job_id. Uploads may be Excel,
+        csv or JSON files so the suffix doesn't name a format, the
+        original filename is kept in the job state.
+        """
+        return os.path.join(self.spool_dir, job_id + UPLOAD_FILE_SUFFIX)
+
+    def expire(self):
+        """
+        remove state, upload and temporary files older than
+        expiry_seconds, including those left by jobs that died
+        """
+        cutoff = time.time() - self.expiry_seconds
+        for name in os.listdir(self.spool_dir):
+            if not name.endswith(
+                    (STATE_FILE_SUFFIX, UPLOAD_FILE_SUFFIX, TEMP_FILE_SUFFIX)):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass  # removed by another process
+
+    def _state_path(self, job_id):
+        return os.path.join(self.spool_dir, job_id + STATE_FILE_SUFFIX)
+
+    def _write_state(self, job_id, state):
+        fd, tmp = tempfile.mkstemp(
+            dir=self.spool_dir, suffix=TEMP_FILE_SUFFIX)
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(state, f)
+        os.rename(tmp, self._state_path(job_id))
+
+
+class UploadProgress(object):
+    """
+    Progress of one upload job, saved to its state file as it changes.
+
+    Pass to _process_upload_file as its progress parameter.
+    """
+    def __init__(self, jobs, state):
+        self.jobs = jobs
+        self.state = state
+
+    def start(self):
+        self.state['status'] = RUNNING
+        self._save()
+
+    def sheet(self, sheet_name):
+        self.state['sheet'] = sheet_name
+        self._save()
+
+    def count_parsed(self, chunks):
+        """
+        pass through a generator of record chunks, counting parsed rows
+        """
+        for records in chunks:
+            self.state['rows_parsed'] += len(records)
+            self._save()
+            yield records
+
+    def upserted(self, records):
+        self.state['rows_upserted'] += len(records)
+        self._save()
+
+    def complete(self, counts=None):
+        """
+        counts: new, updated and unchanged rows for incremental uploads
+        """
+        self.state['status'] = COMPLETE
+        self.state['counts'] = counts
+        self._finish()
+
+    def fail(self, *errors):
+        self.state['status'] = FAILED
+        self.state['errors'].extend(errors)
+        self._finish()
+
+    def _finish(self):
+        self._save()
+        try:
+            os.remove(self.jobs.upload_path(self.state['id']))
+        except OSError:
+            pass
+
+    def _save(self):
+        self.jobs._write_state(self.state['id'], self.state)
+
+
+def upload_async():
+    """
+    True when uploads should be processed in the background
+    """
+    from pylons import config
+    from paste.deploy.converters import asbool
+    return asbool(config.get('recombinant.upload_async', False))
+
+
+_jobs = None
+_jobs_lock = threading.Lock()
+
+def get_upload_jobs():
+    """
+    return the UploadJobs configured by the recombinant.upload_* ini
+    settings
+    """
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            from pylons import config
+            enqueue = config.get('recombinant.upload_queue')
+            if enqueue:
+                module, name = enqueue.split(':')
+                enqueue = getattr(importlib.import_module(module), name)
+            _jobs = UploadJobs(
+                spool_dir=config.get('recombinant.upload_spool_dir') or
+                    os.path.join(tempfile.gettempdir(), 'recombinant-uploads'),
+                enqueue=enqueue,
+                workers=int(config.get(
+                    'recombinant.upload_workers', DEFAULT_UPLOAD_WORKERS)))
+        return _jobs
@@ -0,0 +1,216 @@
+"""
+Local validation of uploaded records
+
+Records are checked against the resource definition in Python before
+any are sent to the datastore: datastore types, choices, required and
+primary key fields, primary keys repeated within the upload and the
+year_min/year_max range. All errors found are reported together, up to
+a limit, instead of only the first error postgres raises.
+
+Type checks only report values postgres would also reject, following
+its input syntax for each type, e.g. NaN is a valid number and "t",
+"yes" or "of" valid true/false values. Dates are checked only when
+written as YYYY-MM-DD, other date formats are left to postgres.
+Choices, required fields, repeated primary keys and the year range are
+rules of the resource definition that postgres doesn't check.
+"""
+
+import re
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from pylons.i18n import _
+
+from ckanext.recombinant.errors import BadExcelData
+from ckanext.recombinant.helpers import _read_choices_file
+from ckanext.recombinant.write_excel import DEFAULT_YEAR_MIN, DEFAULT_YEAR_MAX
+
+DEFAULT_MAX_ERRORS = 100
+
+INT_RE = re.compile(u'^[+-]?[0-9]+$')
+DATE_RE = re.compile(u'^\\s*([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})(?![0-9])')
+# postgres boolean input: true, yes, on, 1, false, no, off, 0 or any
+# unique prefix of them, ignoring case and surrounding whitespace
+BOOLEAN_RE = re.compile(
+    u'^\\s*(t(r(ue?)?)?|y(es?)?|on|1|f(a(l(se?)?)?)?|no?|off?|0)\\s*\\Z',
+    re.IGNORECASE)
+YEAR_BOUND_RE = re.compile(r'^\s*([0-9]+)\s*(?:([+-])\s*([0-9]+)\s*)?$')
+INT_RANGES = {
+    'int': (-2 ** 31, 2 ** 31 - 1),
+    'year': (-2 ** 31, 2 ** 31 - 1),
+    'month': (-2 ** 31, 2 ** 31 - 1),
+    'bigint': (-2 ** 63, 2 ** 63 - 1),
+    }
+
+
+class RecordValidator(object):
+    """
+    Checks compiled once from schema for validating the records of one
+    sheet, a chunk at a time. Errors are collected in self.errors and
+    BadExcelData is raised once max_errors have been found.
+    """
+    def __init__(self, schema, sheet_name, max_errors=DEFAULT_MAX_ERRORS):
+        self.sheet_name = sheet_name
+        self.max_errors = max_errors
+        self.errors = []
+        self.primary_key = schema.primary_key
+        self.key_rows = {}
+
+        year_range = (
+            _year_bound(schema.get('year_min', DEFAULT_YEAR_MIN)),
+            _year_bound(schema.get('year_max', DEFAULT_YEAR_MAX)))
+        self.checks = []
+        for f in schema.template_fields:
+            fid = f['datastore_id']
+            # excel_required_formula makes a field only conditionally
+            # required, it can't be checked here. Primary key fields are
+            # always required by the datastore
+            required = fid in schema.primary_key_set or bool(
+                f.get('excel_required')
+                and not f.get('excel_required_formula'))
+            check = _type_check(f['datastore_type'], year_range)
+            choices = _field_choices(schema, f)
+            if choices is not None:
+                check = _choice_check(check, choices)
+            if required or check:
+                self.checks.append((fid, required, check))
+
+    def check(self, records):
+        """
+        Validate records, a list of (row number, record)
+        """
+        for n, record in records:
+            if not record:
+                continue
+            for fid, required, check in self.checks:
+                value = record.get(fid)
+                if value is None or value == u'' or value == []:
+                    if required:
+                        self._error(n, fid, _(u'Missing value'))
+                    continue
+                if check:
+                    error = check(value)
+                    if error:
+                        self._error(n, fid, error)
+            key = tuple(record.get(k) for k in self.primary_key)
+            if key and all(key):
+                first = self.key_rows.setdefault(key, n)
+                if first != n:
+                    self._error(n, u', '.join(self.primary_key), _(
+                        u'Duplicate primary key, same as row {0}').format(
+                            first))
+
+    def checked_chunks(self, chunks):
+        """
+        Generator of chunks of records, passed through after check()
+        """
+        for records in chunks:
+            self.check(records)
+            yield records
+
+    def raise_errors(self):
+        """
+        raise BadExcelData with all the errors found, if any
+        """
+        if self.errors:
+            raise BadExcelData(self.errors[0], self.errors)
+
+    def _error(self, n, fid, message):
+        self.errors.append(
+            _(u'Sheet {0} Row {1}:').format(self.sheet_name, n)
+            + u' ' + fid + u': ' + message)
+        if len(self.errors) >= self.max_errors:
+            self.errors.append(_(
+                u'Validation stopped after {0} errors').format(
+                    self.max_errors))
+            self.raise_errors()
+
+
+def _year_bound(bound):
+    """
+    year_min and year_max are numbers or Excel expressions like "2018-50",
+    return the number or None for expressions that can't be evaluated
+    """
+    if isinstance(bound, (int, long)):
+        return bound
+    m = YEAR_BOUND_RE.match(unicode(bound))
+    if not m:
+        return None
+    year, op, offset = m.groups()
+    if not op:
+        return int(year)
+    return int(year) + int(offset) if op == '+' else int(year) - int(offset)
+
+
+def _field_choices(schema, f):
+    """
+    return the set of choice codes for field f as unicode, the way
+    they are read from uploaded cells, or None
+    """
+    if 'choices' in f:
+        return frozenset(unicode(k) for k in f['choices'])
+    if 'choices_file' in f and '_path' in schema:
+        return frozenset(unicode(k) for k in _read_choices_file(schema, f))
+
+
+def _type_check(datastore_type, year_range):
+    """
+    return check(value) -> error message or None for canonicalized
+    values of datastore_type, or None if there is nothing to check
+    """
+    if datastore_type in INT_RANGES:
+        low, high = INT_RANGES[datastore_type]
+        if datastore_type == 'year':
+            low = year_range[0] if year_range[0] is not None else low
+            high = year_range[1] if year_range[1] is not None else high
+
+        def check_int(value):
+            if not INT_RE.match(value):
+                return _(u'Invalid integer')
+            if not low <= int(value) <= high:
+                return _(u'Value must be between {0} and {1}').format(
+                    low, high)
+        return check_int
+
+    if datastore_type in ('numeric', 'money'):
+        def check_numeric(value):
+            # NaN is accepted by postgres, and Infinity by postgres 14+
+            try:
+                Decimal(value)
+            except InvalidOperation:
+                return _(u'Invalid number')
+        return check_numeric
+
+    if datastore_type in ('date', 'timestamp'):
+        def check_date(value):
+            # postgres accepts many other date formats, depending on its
+            # DateStyle, so only impossible YYYY-MM-DD dates are caught
+            m = DATE_RE.match(value)
+            if not m:
+                return
+            try:
+                date(*map(int, m.groups()))
+            except ValueError:
+                if datastore_type == 'date':
+                    return _(u'Invalid date, use YYYY-MM-DD')
+                return _(u'Invalid date and time, use YYYY-MM-DD HH:MM:SS')
+        return check_date
+
+    if datastore_type == 'boolean':
+        def check_boolean(value):
+            if not BOOLEAN_RE.match(value):
+                return _(u'Invalid true/false value')
+        return check_boolean
+
+
+def _choice_check(check, choices):
+    """
+    return check(value) for a choice field, including the type check
+    """
+    def check_choice(value):
+        for v in value if isinstance(value, list) else [value]:
+            if v not in choices:
+                return _(u'Invalid choice: "{0}"').format(v)
+        if check:
+            return check(value)
+    return check_choice
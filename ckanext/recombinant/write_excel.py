@@ -1,27 +1,38 @@
 # coding: utf-8
 """
-Excel v3 template and data-dictionary generation code
+Excel v3 and v4 template and data-dictionary generation code
 """
 
+import re
 import textwrap
 import string
 import openpyxl
-from openpyxl.utils import get_column_letter
+from openpyxl.utils import get_column_letter, range_boundaries
 from openpyxl.formatting.rule import FormulaRule
+from openpyxl.formula.translate import Translator
 from openpyxl.styles import NamedStyle
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.worksheet.table import Table, TableColumn, TableFormula
 
-from ckanext.recombinant.tables import get_geno
+from ckanext.recombinant.tables import get_geno, get_schema
+from ckanext.recombinant.schema import resource_schema
 from ckanext.recombinant.errors import RecombinantException
 from ckanext.recombinant.datatypes import datastore_type
 from ckanext.recombinant.helpers import (
     recombinant_choice_fields, recombinant_language_text)
 from ckanext.recombinant.write_excel_v2 import (
     _populate_excel_sheet_v2, _populate_reference_sheet_v2)
+from ckanext.recombinant.template_cache import (
+    get_template_cache, geno_fingerprint)
+from ckanext.recombinant.xlsx_patch import replace_in_parts
 
 from ckan.plugins.toolkit import _, h
+from paste.deploy.converters import asbool
 
+from copy import copy
 from datetime import datetime
 from decimal import Decimal
+from cStringIO import StringIO
 
 HEADER_ROW, HEADER_HEIGHT = 1, 27
 CHEADINGS_ROW, CHEADINGS_HEIGHT = 2, 22
@@ -58,6 +69,14 @@ REF_VALUE_WIDTH = 114
 REF_CHOICE_HEADING_HEIGHT = 24
 REF_EDGE_RANGE = 'A1:A2'
 
+CHOICES_SHEET = 'choices'
+SORTED_CHOICES_MIN = 100  # binary search choice lists at least this long
+SORTED_CHOICE_KEY_RE = re.compile(r'^[0-9A-Za-z]+( [0-9A-Za-z]+)*$')
+MULTI_CHOICE_TOKENS = 3  # _text choices checked one by one
+
+TABLE_NAME = 'reco{rnum}'  # v4 data entry table
+SHEET_MAX_ROW = 1048576
+
 DEFAULT_YEAR_MIN, DEFAULT_YEAR_MAX = '2018-50', '2018+50'
 
 DEFAULT_EDGE_STYLE = {
@@ -94,11 +113,17 @@ REF_PAPER_STYLE = {
 TYPE_HERE_STYLE = {
     'Font': {'bold': True, 'size': 16}}
 
+# stand-in organization for org-independent template skeletons
+SKELETON_ORG = {
+    'name': u'{{recombinant-org-name}}',
+    'title': u'{{recombinant-org-title}}',
+    }
+
 
 def excel_template(dataset_type, org):
     """
     return an openpyxl.Workbook object containing the sheet and header fields
-    for passed dataset_type and org. Supports version 2 and 3 templates.
+    for passed dataset_type and org. Supports version 2, 3 and 4 templates.
     """
     geno = get_geno(dataset_type)
     version = geno.get('template_version', 2)
@@ -108,9 +133,13 @@ def excel_template(dataset_type, org):
     refs = []
     choice_ranges = []
 
-    if version == 3:
+    if version != 2:
         _build_styles(book, geno)
-    for rnum, chromo in enumerate(geno['resources'], 1):
+        sorted_ranges, key_lists = _sorted_choice_ranges(geno)
+        schemas = [get_schema(r['resource_name']) for r in geno['resources']]
+    else:
+        schemas = geno['resources']
+    for rnum, chromo in enumerate(schemas, 1):
         if version == 2:
             _populate_excel_sheet_v2(sheet, chromo, org, refs)
         elif version == 3:
@@ -119,11 +148,15 @@ def excel_template(dataset_type, org):
             sheet.protection.enabled = True
             sheet.protection.formatRows = False
             sheet.protection.formatColumns = False
+        else:
+            _populate_excel_sheet_v4(
+                book, sheet, geno, chromo, org, refs, rnum,
+                sorted_ranges.get(chromo['resource_name'], {}))
         sheet = book.create_sheet()
 
     if version == 2:
         _populate_reference_sheet_v2(sheet, chromo, refs)
-    elif version == 3:
+    else:
         _populate_reference_sheet(sheet, geno, refs)
     sheet.title = 'reference'
     sheet.protection.enabled = True
@@ -131,10 +164,23 @@ def excel_template(dataset_type, org):
     if version == 2:
         return book
 
-    for i, (chromo, cranges) in enumerate(
-            zip(geno['resources'], choice_ranges), 1):
+    if key_lists:
         sheet = book.create_sheet()
-        _populate_excel_e_sheet(sheet, chromo, cranges)
+        _populate_choices_sheet(sheet, key_lists)
+        sheet.title = CHOICES_SHEET
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+    if version == 4:
+        return book  # checks are calculated columns on the data sheets
+
+    for i, (chromo, cranges) in enumerate(zip(schemas, choice_ranges), 1):
+        sheet = book.create_sheet()
+        _populate_excel_e_sheet(
+            sheet,
+            chromo,
+            cranges,
+            sorted_ranges.get(chromo['resource_name'], {}))
         sheet.title = 'e{i}'.format(i=i)
         sheet.protection.enabled = True
         sheet.sheet_state = 'hidden'
@@ -147,22 +193,189 @@ def excel_template(dataset_type, org):
     return book
 
 
+def save_excel_template(dataset_type, org, out, record_data=None):
+    """
+    write the .xlsx template for dataset_type and org to file-like out.
+
+    record_data - optional {resource_name: records} to fill in the data
+        entry sheets, as with append_data
+
+    When the recombinant.template_write_only option is set version 3
+    templates are streamed with write_excel_template instead of being
+    built in memory.
+    """
+    from pylons import config
+    geno = get_geno(dataset_type)
+    if geno.get('template_version', 2) == 3 and asbool(
+            config.get('recombinant.template_write_only', False)):
+        return write_excel_template(dataset_type, org, out, record_data)
+
+    book = excel_template(dataset_type, org)
+    for chromo in geno['resources']:
+        if record_data and chromo['resource_name'] in record_data:
+            append_data(
+                book,
+                record_data[chromo['resource_name']],
+                get_schema(chromo['resource_name']))
+    book.save(out)
+
+
+def write_excel_template(dataset_type, org, out, record_data=None):
+    """
+    write the same template as excel_template(dataset_type, org) to
+    file-like out using an openpyxl write-only workbook.
+
+    Rows are written in order and not kept in memory, so memory use
+    doesn't grow with excel_data_num_rows. Supports version 3 templates.
+
+    record_data - optional {resource_name: records} to fill in the data
+        entry sheets, as with append_data
+    """
+    geno = get_geno(dataset_type)
+    record_data = record_data or {}
+    if geno.get('template_version', 2) != 3:
+        raise RecombinantException(
+            'write_excel_template requires a version 3 template')
+
+    book = openpyxl.Workbook(write_only=True)
+    refs = []
+    choice_ranges = []
+    sorted_ranges, key_lists = _sorted_choice_ranges(geno)
+
+    _build_styles(book, geno)
+    schemas = [get_schema(r['resource_name']) for r in geno['resources']]
+    for rnum, chromo in enumerate(schemas, 1):
+        sheet = book.create_sheet(chromo['resource_name'])
+        columns, cranges, cheadings_height = _excel_sheet_columns(
+            book, geno, chromo, refs, rnum)
+        choice_ranges.append(cranges)
+        _write_excel_sheet(
+            sheet, geno, chromo, org, rnum, columns, cheadings_height,
+            record_data.get(chromo['resource_name'], ()))
+        sheet.protection.enabled = True
+        sheet.protection.formatRows = False
+        sheet.protection.formatColumns = False
+
+    sheet = book.create_sheet('reference')
+    _write_reference_sheet(sheet, geno, refs)
+    sheet.protection.enabled = True
+
+    if key_lists:
+        sheet = book.create_sheet(CHOICES_SHEET)
+        _write_choices_sheet(sheet, key_lists)
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+    for i, (chromo, cranges) in enumerate(zip(schemas, choice_ranges), 1):
+        sheet = book.create_sheet('e{i}'.format(i=i))
+        _write_calc_sheet(
+            sheet,
+            chromo,
+            _excel_e_formulas(
+                chromo,
+                cranges,
+                sorted_ranges.get(chromo['resource_name'], {})),
+            helpers=_excel_e_key_formulas(chromo))
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+        sheet = book.create_sheet('r{i}'.format(i=i))
+        _write_calc_sheet(
+            sheet, chromo, _excel_r_formulas(chromo), has_data=True)
+        sheet.protection.enabled = True
+        sheet.sheet_state = 'hidden'
+
+    book.save(out)
+
+
+def excel_template_bytes(dataset_type, lang, org):
+    """
+    return the saved .xlsx file contents of excel_template(dataset_type, org)
+    for the current language lang.
+
+    Templates are built once per dataset type and language with
+    SKELETON_ORG and cached while the geno and its choices files are
+    unchanged, then patched with the real org name and title.
+    """
+    from pylons import config
+    geno = get_geno(dataset_type)
+    key = (
+        dataset_type,
+        lang,
+        asbool(config.get('recombinant.template_write_only', False)),
+        geno_fingerprint(geno))
+
+    def build():
+        blob = StringIO()
+        save_excel_template(dataset_type, SKELETON_ORG, blob)
+        return blob.getvalue()
+
+    skeleton = get_template_cache().get_or_build(key, build)
+    return patch_template_org(skeleton, geno, org)
+
+
+def patch_template_org(skeleton, geno, org):
+    """
+    return skeleton template contents with the SKELETON_ORG placeholders
+    replaced by the name and title of org
+    """
+    org_title = org['title']
+    if geno.get('template_version', 2) != 2:
+        org_title = org_title_lang_hack(org_title)
+
+    # org values only appear on the data entry sheets, which are
+    # written first
+    return replace_in_parts(
+        skeleton,
+        ['xl/worksheets/sheet{0}.xml'.format(n)
+            for n in range(1, len(geno['resources']) + 1)],
+        [
+            (SKELETON_ORG['name'], org['name']),
+            (SKELETON_ORG['title'], org_title),
+        ])
+
+
 def append_data(book, record_data, chromo):
 
     """
     fills rows of an openpyxl.Workbook with selected data from a datastore resource
     """
     sheet = book[chromo['resource_name']]
+    columns = [
+        (col_num, field['datastore_id'], field['datastore_type'])
+        for col_num, field in template_cols_fields(chromo)]
     current_row = DATA_FIRST_ROW
     for record in record_data:
-        for col_num, field in template_cols_fields(chromo):
-            item = datastore_type_format(record[field['datastore_id']], field['datastore_type'])
+        for col_num, fid, ftype in columns:
+            item = datastore_type_format(record[fid], ftype)
             sheet.cell(row=current_row, column=col_num).value = item
         current_row += 1
 
+    if sheet._tables:
+        _extend_data_table(sheet, sheet._tables[0], current_row - 1)
     return book
 
 
+def _extend_data_table(sheet, table, last_row):
+    """
+    grow the v4 data entry table on sheet to end at last_row, copying
+    the styles and calculated column formulas of its first row
+    """
+    min_col, min_row, max_col, max_row = range_boundaries(table.ref)
+    if last_row <= max_row:
+        return
+    for col_num in xrange(min_col, max_col + 1):
+        src = sheet.cell(row=min_row, column=col_num)
+        for row in xrange(max_row + 1, last_row + 1):
+            dst = sheet.cell(row=row, column=col_num)
+            dst._style = copy(src._style)
+            if src.data_type == 'f':
+                dst.value = src.value
+    table.ref = '{0}{1}:{2}{3}'.format(
+        get_column_letter(min_col), min_row,
+        get_column_letter(max_col), last_row)
+
+
 def datastore_type_format(value, datastore_type):
 
     numeric_types = ['money', 'year', 'int', 'bigint', 'numeric']
@@ -288,114 +501,293 @@ def _populate_excel_sheet(book, sheet, geno, chromo, org, refs, resource_num):
     """
     sheet.title = chromo['resource_name']
 
-    cranges = {}
     data_num_rows = chromo.get('excel_data_num_rows', DEFAULT_DATA_NUM_ROWS)
-
-    required_style = dict(
-        dict(DEFAULT_EDGE_STYLE, **geno.get('excel_edge_style', {})),
-        **geno.get('excel_required_style', {}))
-    error_style = dict(
-        DEFAULT_ERROR_STYLE, **geno.get('excel_error_style', {}))
-    header_style = dict(
-        DEFAULT_HEADER_STYLE, **geno.get('excel_header_style', {}))
-    cheadings_style = dict(
-        DEFAULT_CHEADING_STYLE,
-        **geno.get('excel_column_heading_style', {}))
-    example_style = dict(
-        DEFAULT_EXAMPLE_STYLE, **geno.get('excel_example_style', {}))
+    columns, cranges, cheadings_height = _excel_sheet_columns(
+        book, geno, chromo, refs, resource_num)
 
     # create rows so we can set all heights
     for i in xrange(1, DATA_FIRST_ROW + data_num_rows):
         sheet.cell(row=i, column=1).value = None
 
-    sheet.merge_cells(EXAMPLE_MERGE)
-    fill_cell(sheet, EXAMPLE_ROW, 1, _('e.g.'), 'reco_example')
+    _fill_header_rows(sheet, geno, chromo, org, columns, cheadings_height, 'v3')
 
     fill_cell(
         sheet,
         DATA_FIRST_ROW,
         RPAD_COL_NUM,
-        u'=IF(r{rnum}!{col}{row},"","▶")'.format(
-            rnum=resource_num,
-            col=RPAD_COL,
-            row=DATA_FIRST_ROW),
+        _type_here_formula(resource_num),
+        TYPE_HERE_STYLE)
+
+    for col in columns:
+        cells = sheet[col['validation_range']]
+        cells[0][0].style = col['style']
+        for (c,) in cells[1:]:
+            # copy instead of looking up the named style for every cell
+            c._style = copy(cells[0][0]._style)
+
+        if col['validation']:
+            sheet.add_data_validation(col['validation'])
+
+    _add_conditional_formatting(
+        sheet,
+        columns[-1]['letter'],
+        resource_num,
+        dict(DEFAULT_ERROR_STYLE, **geno.get('excel_error_style', {})),
+        _required_style(geno),
+        data_num_rows)
+
+    for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
+        sheet.row_dimensions[i].height = chromo.get(
+            'excel_data_height', DEFAULT_DATA_HEIGHT)
+
+        # jump to first error/required cell in row
+        sheet.cell(row=i, column=RSTATUS_COL_NUM).value = (
+            _row_status_formula(resource_num, i))
+
+    return cranges
+
+
+def _populate_excel_sheet_v4(
+        book, sheet, geno, chromo, org, refs, resource_num, sorted_ranges):
+    """
+    Format openpyxl sheet for the resource definition chromo and org.
+    (Version 4)
+
+    The data entry rows are an Excel table starting with a single row.
+    The checks from the v3 e/r sheets are hidden calculated columns of
+    the table, so formulas and styles are stored once per column and
+    Excel extends them as the table grows. The sheet can't be
+    protected because Excel won't add rows to a table on a protected
+    sheet, so the hidden code row has a data validation that refuses
+    typed values instead. Pasted values get past it, but the upload
+    still checks the organization and column ids on that row.
+
+    refs - list of rows to add to reference sheet, modified
+        in place from this function
+    resource_num - 1-based index of resource
+    sorted_ranges - {datastore_id: sorted_key_range} for choice fields
+        validated with a binary search, from _sorted_choice_ranges
+    """
+    sheet.title = chromo['resource_name']
+
+    columns, cranges, cheadings_height = _excel_sheet_columns(
+        book, geno, chromo, refs, resource_num,
+        SHEET_MAX_ROW - DATA_FIRST_ROW + 1)
+    table = TABLE_NAME.format(rnum=resource_num)
+    names, formulas = _excel_table_columns(
+        chromo, cranges, sorted_ranges, table)
+    count = len(columns)
+
+    for col in columns:
+        e_col = get_column_letter(col['num'] + count)
+        r_col = get_column_letter(col['num'] + 2 * count)
+        col['cstatus'] = (
+            '=IF({e}{row}>0,HYPERLINK("#{col}"&{e}{row},""),'
+            'IF({r}{row}>0,HYPERLINK("#{col}"&{r}{row},""),""))'.format(
+                e=e_col, r=r_col, col=col['letter'], row=CSTATUS_ROW))
+
+    _fill_header_rows(sheet, geno, chromo, org, columns, cheadings_height, 'v4')
+
+    for col in columns:
+        fill_cell(sheet, DATA_FIRST_ROW, col['num'], None, col['style'])
+        dim = sheet.column_dimensions[col['letter']]
+        dim.number_format = col['xl_format']
+        dim.alignment = openpyxl.styles.Alignment(wrap_text=True)
+
+        if col['validation']:
+            sheet.add_data_validation(col['validation'])
+
+    v = openpyxl.worksheet.datavalidation.DataValidation(
+        type='custom', formula1='FALSE', showErrorMessage=True)
+    v.errorTitle = u'Template code'
+    v.error = u'This row identifies the template and can\'t be changed'
+    v.add('A{row}:{col}{row}'.format(
+        row=CODE_ROW, col=get_column_letter(DATA_FIRST_COL_NUM + count - 1)))
+    sheet.add_data_validation(v)
+
+    for col_num in xrange(DATA_FIRST_COL_NUM + count, len(names) + 1):
+        sheet.column_dimensions[get_column_letter(col_num)].hidden = True
+
+    for col_num in xrange(
+            DATA_FIRST_COL_NUM + count, DATA_FIRST_COL_NUM + 3 * count):
+        if col_num in formulas:
+            # first error/required row in column
+            sheet.cell(row=CSTATUS_ROW, column=col_num).value = (
+                '=IFERROR(MATCH(TRUE,INDEX({rng}<>0,),)+{row0},0)'.format(
+                    rng=_table_column_ref(table, names[col_num - 1]),
+                    row0=DATA_FIRST_ROW - 1))
+
+    for col_num, fmla in formulas.items():
+        sheet.cell(row=DATA_FIRST_ROW, column=col_num).value = fmla
+    apply_style(
+        sheet.cell(row=DATA_FIRST_ROW, column=RPAD_COL_NUM),
         TYPE_HERE_STYLE)
 
+    sheet.add_table(Table(
+        displayName=table,
+        ref='A{row}:{col}{row}'.format(
+            row=DATA_FIRST_ROW, col=get_column_letter(len(names))),
+        headerRowCount=0,
+        tableColumns=[
+            TableColumn(
+                id=i,
+                name=name,
+                calculatedColumnFormula=TableFormula(
+                    attr_text=formulas[i][1:]) if i in formulas else None)
+            for i, name in enumerate(names, 1)]))
+
+    _add_table_conditional_formatting(
+        sheet,
+        count,
+        dict(DEFAULT_ERROR_STYLE, **geno.get('excel_error_style', {})),
+        _required_style(geno))
+
+    sheet.sheet_format.defaultRowHeight = chromo.get(
+        'excel_data_height', DEFAULT_DATA_HEIGHT)
+    sheet.sheet_format.customHeight = True
+
+
+def _fill_header_rows(
+        sheet, geno, chromo, org, columns, cheadings_height, version):
+    """
+    Fill and format the header rows above the data entry rows,
+    shared by version 3 and 4 templates
+
+    columns - from _excel_sheet_columns
+    version - template version code stored on the code row
+    """
+    sheet.merge_cells(EXAMPLE_MERGE)
+    fill_cell(sheet, EXAMPLE_ROW, 1, _('e.g.'), 'reco_example')
+
     fill_cell(
         sheet,
         HEADER_ROW,
         DATA_FIRST_COL_NUM,
-        recombinant_language_text(chromo['title'])
-            + u' \N{em dash} ' + org_title_lang_hack(org['title']),
+        _header_text(chromo, org),
         'reco_header')
 
-    sheet.cell(row=CODE_ROW, column=1).value = 'v3'  # template version
+    sheet.cell(row=CODE_ROW, column=1).value = version  # template version
     # allow only upload to this org
     sheet.cell(row=CODE_ROW, column=2).value = org['name']
 
-    cheadings_dimensions = sheet.row_dimensions[CHEADINGS_ROW]
-
-    choice_fields = dict(
-        (f['datastore_id'], f['choices'])
-        for f in recombinant_choice_fields(chromo['resource_name']))
+    sheet.row_dimensions[CHEADINGS_ROW].height = cheadings_height
 
-    for col_num, field in template_cols_fields(chromo):
-        field_heading = recombinant_language_text(
-            field.get('excel_heading', field['label'])).strip()
-        cheadings_dimensions.height = max(
-            cheadings_dimensions.height,
-            field_heading.count('\n') * LINE_HEIGHT + CHEADINGS_HEIGHT)
-
-        col_heading_style = 'reco_cheading'
-        if 'excel_column_heading_style' in field:
-            # use geno column heading style as base, just override keys
-            col_heading_style = dict(
-                dict(
-                    DEFAULT_CHEADING_STYLE,
-                    **geno.get('excel_column_heading_style', {})),
-                **field['excel_column_heading_style'])
+    for col in columns:
+        col_num = col['num']
+        if not isinstance(col['heading_style'], basestring):
             apply_style(sheet.cell(
-                row=HEADER_ROW, column=col_num), col_heading_style)
+                row=HEADER_ROW, column=col_num), col['heading_style'])
             apply_style(sheet.cell(
-                row=CSTATUS_ROW, column=col_num), col_heading_style)
+                row=CSTATUS_ROW, column=col_num), col['heading_style'])
 
         fill_cell(
             sheet,
             CHEADINGS_ROW,
             col_num,
-            field_heading,
-            col_heading_style)
-
-        reference_row1 = len(refs) + REF_FIRST_ROW
+            col['heading'],
+            col['heading_style'])
 
         # match against db columns
-        sheet.cell(row=CODE_ROW, column=col_num).value = field['datastore_id']
+        sheet.cell(row=CODE_ROW, column=col_num).value = (
+            col['field']['datastore_id'])
 
-        example = chromo['examples']['record'].get(field['datastore_id'], '')
         fill_cell(
             sheet,
             EXAMPLE_ROW,
             col_num,
-            u','.join(example) if isinstance(example, list) else example,
+            col['example'],
             'reco_example')
 
-        col_letter = get_column_letter(col_num)
-
         # jump to first error/required cell in column
         fill_cell(
             sheet,
             CSTATUS_ROW,
             col_num,
-            '=IF(e{rnum}!{col}{row}>0,HYPERLINK("#{col}"&e{rnum}!{col}{row},"")'
-                ',IF(r{rnum}!{col}{row}>0,HYPERLINK("#{col}"&r{rnum}!{col}{row},""),""))'
-                .format(rnum=resource_num, col=col_letter, row=CSTATUS_ROW),
-            col_heading_style)
+            col['cstatus'],
+            col['heading_style'])
+
+        sheet.column_dimensions[col['letter']].width = col['width']
+
+        ex_cell = sheet.cell(row=EXAMPLE_ROW, column=col_num)
+        ex_cell.number_format = col['xl_format']
+        ex_cell.alignment = openpyxl.styles.Alignment(wrap_text=True)
+
+        sheet.cell(row=CHEADINGS_ROW, column=col_num).hyperlink = (
+            col['heading_link'])
+
+    sheet.row_dimensions[HEADER_ROW].height = HEADER_HEIGHT
+    sheet.row_dimensions[CODE_ROW].hidden = True
+    sheet.row_dimensions[CSTATUS_ROW].height = CSTATUS_HEIGHT
+    sheet.row_dimensions[EXAMPLE_ROW].height = chromo.get(
+        'excel_example_height', DEFAULT_EXAMPLE_HEIGHT)
+
+    sheet.column_dimensions[RSTATUS_COL].width = RSTATUS_WIDTH
+    sheet.column_dimensions[RPAD_COL].width = RPAD_WIDTH
+
+    sheet.freeze_panes = sheet[FREEZE_PANES]
+
+    for row, style in _row_styles(geno):
+        apply_style(sheet.row_dimensions[row], style)
+    for (c,) in sheet[EDGE_RANGE]:
+        c.style = 'reco_edge'
+
+    # trying to set the active cell (not working yet)
+    select = "{col}{row}".format(col=DATA_FIRST_COL, row=DATA_FIRST_ROW)
+    sheet.sheet_view.selection[0].activeCell = select
+    sheet.sheet_view.selection[0].sqref = select
+
+
+def _excel_sheet_columns(
+        book, geno, chromo, refs, resource_num, data_num_rows=None):
+    """
+    Collect the content and formatting of each template column on the
+    data entry sheet for resource definition chromo. (Version 3)
+
+    Column styles are added to book and refs is modified in place
+    as in _populate_excel_sheet. data_num_rows defaults to the
+    resource's excel_data_num_rows.
+
+    returns (columns, cranges, cheadings_height) where columns is a
+    list of dicts in column order and cranges is a dict of
+    {datastore_id: reference_key_range}
+    """
+    schema = resource_schema(chromo)
+    columns = []
+    cranges = {}
+    cheadings_height = CHEADINGS_HEIGHT
+    if data_num_rows is None:
+        data_num_rows = chromo.get(
+            'excel_data_num_rows', DEFAULT_DATA_NUM_ROWS)
+
+    choice_fields = dict(
+        (f['datastore_id'], f['choices'])
+        for f in recombinant_choice_fields(chromo['resource_name']))
+
+    for col_num, field in template_cols_fields(schema):
+        field_heading = recombinant_language_text(
+            field.get('excel_heading', field['label'])).strip()
+        cheadings_height = max(
+            cheadings_height,
+            field_heading.count('\n') * LINE_HEIGHT + CHEADINGS_HEIGHT)
+
+        col_heading_style = 'reco_cheading'
+        if 'excel_column_heading_style' in field:
+            # use geno column heading style as base, just override keys
+            col_heading_style = dict(
+                dict(
+                    DEFAULT_CHEADING_STYLE,
+                    **geno.get('excel_column_heading_style', {})),
+                **field['excel_column_heading_style'])
+
+        reference_row1 = len(refs) + REF_FIRST_ROW
+
+        example = chromo['examples']['record'].get(field['datastore_id'], '')
+        col_letter = get_column_letter(col_num)
 
-        col = sheet.column_dimensions[col_letter]
         if 'excel_column_width' in field:
-            col.width = field['excel_column_width']
+            width = field['excel_column_width']
         else:
-            col.width = max(estimate_width(field_heading), CHEADINGS_MIN_WIDTH)
+            width = max(estimate_width(field_heading), CHEADINGS_MIN_WIDTH)
 
         validation_range = '{col}{row1}:{col}{rowN}'.format(
             col=col_letter,
@@ -403,21 +795,29 @@ def _populate_excel_sheet(book, sheet, geno, chromo, org, refs, resource_num):
             rowN=DATA_FIRST_ROW + data_num_rows - 1)
 
         xl_format = datastore_type[field['datastore_type']].xl_format
-        alignment = openpyxl.styles.Alignment(wrap_text=True)
-        col_style = NamedStyle(
-            name='reco_{0}{1}'.format(resource_num, col_letter),
-            number_format=xl_format,
-            alignment=alignment,
-            protection=openpyxl.styles.Protection(locked=False))
-        book.add_named_style(col_style)
-        for (c,) in sheet[validation_range]:
-            c.style = col_style.name
-        ex_cell = sheet.cell(row=EXAMPLE_ROW, column=col_num)
-        ex_cell.number_format = xl_format
-        ex_cell.alignment = alignment
+
+        col = {
+            'num': col_num,
+            'letter': col_letter,
+            'field': field,
+            'heading': field_heading,
+            'heading_style': col_heading_style,
+            'example': (
+                u','.join(example) if isinstance(example, list) else example),
+            'cstatus': (
+                '=IF(e{rnum}!{col}{row}>0,HYPERLINK("#{col}"&e{rnum}!{col}{row},"")'
+                ',IF(r{rnum}!{col}{row}>0,HYPERLINK("#{col}"&r{rnum}!{col}{row},""),""))'
+                .format(rnum=resource_num, col=col_letter, row=CSTATUS_ROW)),
+            'width': width,
+            'validation_range': validation_range,
+            'xl_format': xl_format,
+            'style': _data_cell_style(book, xl_format),
+            'validation': None,
+            }
+        columns.append(col)
 
         _append_field_ref_rows(refs, field, "#'{sheet}'!{col}{row}".format(
-            sheet=sheet.title, col=col_letter, row=CHEADINGS_ROW))
+            sheet=chromo['resource_name'], col=col_letter, row=CHEADINGS_ROW))
 
         if field['datastore_id'] in choice_fields:
             full_text_choices = (
@@ -432,11 +832,11 @@ def _populate_excel_sheet(book, sheet, geno, chromo, org, refs, resource_num):
 
             if full_text_choices:
                 if 'excel_column_width' not in field:
-                    col.width = max(col.width, max_choice_width)
+                    col['width'] = max(col['width'], max_choice_width)
                 # expand example
                 for ck, cv in choice_fields[field['datastore_id']]:
                     if ck == example:
-                        ex_cell.value = u"{0}: {1}".format(ck, cv)
+                        col['example'] = u"{0}: {1}".format(ck, cv)
                         break
 
             choice_range = 'reference!${col}${ref1}:${col}${refN}'.format(
@@ -446,14 +846,11 @@ def _populate_excel_sheet(book, sheet, geno, chromo, org, refs, resource_num):
                 choice_keys = set(
                     key for (_i, key, _i, _i) in string.Formatter().parse(user_choice_range)
                     if key != 'range' and key != 'range_top')
-                choice_values = {}
-                if choice_keys:
-                    choice_values = {
-                        f['datastore_id']: "{col}{num}".format(
-                            col=get_column_letter(cn),
-                            num=DATA_FIRST_ROW)
-                        for cn, f in template_cols_fields(chromo)
-                        if f['datastore_id'] in choice_keys}
+                choice_values = _template_cell_refs(
+                    schema,
+                    choice_keys,
+                    lambda cn: "{col}{num}".format(
+                        col=get_column_letter(cn), num=DATA_FIRST_ROW))
                 user_choice_range = user_choice_range.format(
                     range=choice_range,
                     range_top=choice_range.split(':')[0],
@@ -474,59 +871,359 @@ def _populate_excel_sheet(book, sheet, geno, chromo, org, refs, resource_num):
                 else:
                     v.error = (u'Please enter one of the valid keys shown on '
                         'sheet "reference" rows {0}-{1}'.format(ref1, refN))
-                sheet.add_data_validation(v)
                 v.add(validation_range)
+                col['validation'] = v
 
-        sheet.cell(row=CHEADINGS_ROW, column=col_num).hyperlink = (
+        col['heading_link'] = (
             '#reference!{colA}{row1}:{colZ}{rowN}'.format(
                 colA=REF_FIELD_NUM_COL,
                 row1=reference_row1,
                 colZ=REF_VALUE_COL,
                 rowN=len(refs) + REF_FIRST_ROW - 2))
 
+    return columns, cranges, cheadings_height
+
+
+def _data_cell_style(book, xl_format):
+    """
+    return the name of the style for data entry cells with number format
+    xl_format, adding it to book the first time it's used so all the
+    columns with the same format share one style
+    """
+    name = 'reco_data ' + xl_format
+    if name not in book.named_styles:
+        book.add_named_style(NamedStyle(
+            name=name,
+            number_format=xl_format,
+            alignment=openpyxl.styles.Alignment(wrap_text=True),
+            protection=openpyxl.styles.Protection(locked=False)))
+    return name
+
+
+def _header_text(chromo, org):
+    return (recombinant_language_text(chromo['title'])
+        + u' \N{em dash} ' + org_title_lang_hack(org['title']))
+
+
+def _type_here_formula(resource_num):
+    return u'=IF(r{rnum}!{col}{row},"","▶")'.format(
+        rnum=resource_num,
+        col=RPAD_COL,
+        row=DATA_FIRST_ROW)
+
+
+def _row_status_formula(resource_num, row):
+    return (
+        '=IF(e{rnum}!{col}{row}>0,'
+            'HYPERLINK("#"&ADDRESS({row},e{rnum}!{col}{row}),""),'
+            'IF(r{rnum}!{col}{row}>0,'
+                'HYPERLINK("#"&ADDRESS({row},r{rnum}!{col}{row}),""),""))'
+        .format(rnum=resource_num, col=RSTATUS_COL, row=row))
+
+
+def _required_style(geno):
+    return dict(
+        dict(DEFAULT_EDGE_STYLE, **geno.get('excel_edge_style', {})),
+        **geno.get('excel_required_style', {}))
+
+
+def _row_styles(geno):
+    """
+    return [(row, style)] for the header rows of the data entry sheet
+    """
+    header_style = dict(
+        DEFAULT_HEADER_STYLE, **geno.get('excel_header_style', {}))
+    cheadings_style = dict(
+        DEFAULT_CHEADING_STYLE,
+        **geno.get('excel_column_heading_style', {}))
+    example_style = dict(
+        DEFAULT_EXAMPLE_STYLE, **geno.get('excel_example_style', {}))
+    return [
+        (HEADER_ROW, header_style),
+        (CHEADINGS_ROW, cheadings_style),
+        (CSTATUS_ROW, cheadings_style),
+        (EXAMPLE_ROW, example_style),
+        ]
+
+
+def _write_excel_sheet(sheet, geno, chromo, org, resource_num, columns,
+        cheadings_height, records):
+    """
+    Stream the data entry sheet to write-only worksheet sheet,
+    equivalent to _populate_excel_sheet. (Version 3)
+
+    columns, cheadings_height - from _excel_sheet_columns
+    records - datastore records to fill in the data rows
+    """
+    data_num_rows = chromo.get('excel_data_num_rows', DEFAULT_DATA_NUM_ROWS)
+    data_height = chromo.get('excel_data_height', DEFAULT_DATA_HEIGHT)
+
+    # worksheet properties are written before the first row
+    for col in columns:
+        sheet.column_dimensions[col['letter']].width = col['width']
+        if col['validation']:
+            sheet.data_validations.append(col['validation'])
+    sheet.column_dimensions[RSTATUS_COL].width = RSTATUS_WIDTH
+    sheet.column_dimensions[RPAD_COL].width = RPAD_WIDTH
+
+    sheet.freeze_panes = FREEZE_PANES
+    select = "{col}{row}".format(col=DATA_FIRST_COL, row=DATA_FIRST_ROW)
+    sheet.sheet_view.selection[0].activeCell = select
+    sheet.sheet_view.selection[0].sqref = select
+
+    sheet.merged_cells.add(EXAMPLE_MERGE)
     _add_conditional_formatting(
         sheet,
-        col_letter,
+        columns[-1]['letter'],
         resource_num,
-        error_style,
-        required_style,
+        dict(DEFAULT_ERROR_STYLE, **geno.get('excel_error_style', {})),
+        _required_style(geno),
         data_num_rows)
 
-    sheet.row_dimensions[HEADER_ROW].height = HEADER_HEIGHT
-    sheet.row_dimensions[CODE_ROW].hidden = True
-    sheet.row_dimensions[CSTATUS_ROW].height = CSTATUS_HEIGHT
-    sheet.row_dimensions[EXAMPLE_ROW].height = chromo.get(
-        'excel_example_height', DEFAULT_EXAMPLE_HEIGHT)
-    for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
-        sheet.row_dimensions[i].height = chromo.get(
-            'excel_data_height', DEFAULT_DATA_HEIGHT)
-
-        # jump to first error/required cell in row
-        sheet.cell(row=i, column=RSTATUS_COL_NUM).value = (
-            '=IF(e{rnum}!{col}{row}>0,'
-                'HYPERLINK("#"&ADDRESS({row},e{rnum}!{col}{row}),""),'
-                'IF(r{rnum}!{col}{row}>0,'
-                    'HYPERLINK("#"&ADDRESS({row},r{rnum}!{col}{row}),""),""))'
-            .format(rnum=resource_num, col=RSTATUS_COL, row=i))
+    row_styles = dict(_row_styles(geno))
+    edge = lambda value=None: streaming_cell(sheet, value, 'reco_edge')
+
+    cells = {RSTATUS_COL_NUM: edge()}
+    for col in columns:
+        if not isinstance(col['heading_style'], basestring):
+            cells[col['num']] = streaming_cell(
+                sheet, None, col['heading_style'])
+    header = streaming_cell(
+        sheet, _header_text(chromo, org), 'reco_header')
+    if not isinstance(columns[0]['heading_style'], basestring):
+        apply_style(header, columns[0]['heading_style'])
+    cells[DATA_FIRST_COL_NUM] = header
+    append_streaming_row(
+        sheet, HEADER_ROW, cells,
+        height=HEADER_HEIGHT, style=row_styles[HEADER_ROW])
+
+    cells = {RSTATUS_COL_NUM: edge()}
+    for col in columns:
+        c = streaming_cell(sheet, col['heading'], col['heading_style'])
+        c.hyperlink = col['heading_link']
+        cells[col['num']] = c
+    append_streaming_row(
+        sheet, CHEADINGS_ROW, cells,
+        height=cheadings_height, style=row_styles[CHEADINGS_ROW])
+
+    cells = {
+        RSTATUS_COL_NUM: edge('v3'),  # template version
+        # allow only upload to this org
+        RPAD_COL_NUM: org['name'],
+        }
+    for col in columns:
+        # match against db columns
+        cells[col['num']] = col['field']['datastore_id']
+    append_streaming_row(sheet, CODE_ROW, cells, hidden=True)
 
+    cells = {RSTATUS_COL_NUM: edge()}
+    for col in columns:
+        # jump to first error/required cell in column
+        cells[col['num']] = streaming_cell(
+            sheet, col['cstatus'], col['heading_style'])
+    append_streaming_row(
+        sheet, CSTATUS_ROW, cells,
+        height=CSTATUS_HEIGHT, style=row_styles[CSTATUS_ROW])
+
+    cells = {RSTATUS_COL_NUM: streaming_cell(sheet, _('e.g.'), 'reco_example')}
+    for col in columns:
+        c = streaming_cell(sheet, col['example'], 'reco_example')
+        c.number_format = col['xl_format']
+        c.alignment = openpyxl.styles.Alignment(wrap_text=True)
+        cells[col['num']] = c
+    append_streaming_row(
+        sheet, EXAMPLE_ROW, cells,
+        height=chromo.get('excel_example_height', DEFAULT_EXAMPLE_HEIGHT),
+        style=row_styles[EXAMPLE_ROW])
+
+    col_styles = dict(
+        (col['num'], streaming_cell(sheet, None, col['style'])._style)
+        for col in columns)
+    records = iter(records)
+    for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
+        record = next(records, None)
+        cells = {
+            # jump to first error/required cell in row
+            RSTATUS_COL_NUM: _row_status_formula(resource_num, i)
+            }
+        if i == DATA_FIRST_ROW:
+            cells[RPAD_COL_NUM] = streaming_cell(
+                sheet, _type_here_formula(resource_num), TYPE_HERE_STYLE)
+        for col in columns:
+            c = WriteOnlyCell(sheet)
+            c._style = copy(col_styles[col['num']])
+            if record is not None:
+                c.value = datastore_type_format(
+                    record[col['field']['datastore_id']],
+                    col['field']['datastore_type'])
+            cells[col['num']] = c
+        append_streaming_row(sheet, i, cells, height=data_height)
+
+    # records beyond the formatted rows, as with append_data
+    for i, record in enumerate(records, DATA_FIRST_ROW + data_num_rows):
+        append_streaming_row(sheet, i, dict(
+            (col['num'], datastore_type_format(
+                record[col['field']['datastore_id']],
+                col['field']['datastore_type']))
+            for col in columns))
+
+
+def _write_reference_sheet(sheet, geno, refs):
+    """
+    Stream the reference sheet to write-only worksheet sheet,
+    equivalent to _populate_reference_sheet
+    """
     sheet.column_dimensions[RSTATUS_COL].width = RSTATUS_WIDTH
     sheet.column_dimensions[RPAD_COL].width = RPAD_WIDTH
+    sheet.column_dimensions[REF_KEY_COL].width = REF_KEY_WIDTH
+    sheet.column_dimensions[REF_VALUE_COL].width = REF_VALUE_WIDTH
 
-    sheet.freeze_panes = sheet[FREEZE_PANES]
+    append_streaming_row(
+        sheet,
+        REF_HEADER1_ROW,
+        {
+            REF_FIELD_NUM_COL_NUM: streaming_cell(sheet, None, 'reco_edge'),
+            REF_KEY_COL_NUM: streaming_cell(
+                sheet, recombinant_language_text(geno['title']),
+                'reco_header'),
+        },
+        height=REF_HEADER1_HEIGHT,
+        style=dict(DEFAULT_HEADER_STYLE, **geno.get('excel_header_style', {})))
+    append_streaming_row(
+        sheet,
+        REF_HEADER2_ROW,
+        {
+            REF_FIELD_NUM_COL_NUM: streaming_cell(sheet, None, 'reco_edge'),
+            REF_KEY_COL_NUM: streaming_cell(
+                sheet, _('Reference'), 'reco_header2'),
+        },
+        height=REF_HEADER2_HEIGHT,
+        style=dict(
+            DEFAULT_REF_HEADER2_STYLE, **geno.get('excel_header_style', {})))
+
+    for ref in _reference_sheet_rows(refs):
+        row_number = ref['row']
+        cells = dict(
+            (cnum, WriteOnlyCell(sheet, cval))
+            for cnum, cval in enumerate(ref['values'], REF_KEY_COL_NUM))
+
+        if ref['field_number']:
+            sheet.merged_cells.add(REF_FIELD_NUM_MERGE.format(row=row_number))
+            sheet.merged_cells.add(
+                REF_FIELD_TITLE_MERGE.format(row=row_number))
+            cells[REF_FIELD_NUM_COL_NUM] = streaming_cell(
+                sheet, ref['field_number'], 'reco_ref_number')
+            if ref['link']:
+                cells[REF_KEY_COL_NUM].hyperlink = ref['link']
+
+        for cnum, cstyle in ref['styles']:
+            if cnum not in cells:
+                cells[cnum] = WriteOnlyCell(sheet)
+            cells[cnum].style = cstyle
+
+        append_streaming_row(
+            sheet, row_number, cells,
+            height=ref['height'], style=REF_PAPER_STYLE)
+
+
+def _write_calc_sheet(sheet, chromo, formulas, has_data=False, helpers=()):
+    """
+    Stream an "error" or "required" calculation sheet to write-only
+    worksheet sheet, equivalent to _populate_excel_e_sheet and
+    _populate_excel_r_sheet
+
+    formulas - from _excel_e_formulas or _excel_r_formulas
+    has_data - True to include the has data column of the "required" sheet
+    helpers - additional [(col_num, formula)] without a column status,
+        e.g. from _excel_e_key_formulas
+    """
+    data_num_rows = chromo.get('excel_data_num_rows', DEFAULT_DATA_NUM_ROWS)
 
-    apply_style(sheet.row_dimensions[HEADER_ROW], header_style)
-    apply_style(sheet.row_dimensions[CHEADINGS_ROW], cheadings_style)
-    apply_style(sheet.row_dimensions[CSTATUS_ROW], cheadings_style)
-    apply_style(sheet.row_dimensions[EXAMPLE_ROW], example_style)
-    for (c,) in sheet[EDGE_RANGE]:
-        c.style = 'reco_edge'
+    for i in xrange(1, DATA_FIRST_ROW):
+        cells = {}
+        if i == CSTATUS_ROW:
+            cells = dict(
+                (col_num, _column_status_formula(col_num, data_num_rows))
+                for col_num, fmla in formulas)
+        append_streaming_row(sheet, i, cells)
+
+    if not formulas:
+        return
+
+    last_col_num = formulas[-1][0]
+    formulas = list(formulas)
+    if has_data:
+        formulas.append((
+            RPAD_COL_NUM, _has_data_formula(chromo, last_col_num, '{num}')))
+    formulas.append((
+        RSTATUS_COL_NUM, _calc_row_status_formula(last_col_num, '{num}')))
+    formulas.extend(helpers)
+    columns = _calc_formula_columns(formulas, data_num_rows)
 
-    # trying to set the active cell (not working yet)
-    select = "{col}{row}".format(col=DATA_FIRST_COL, row=DATA_FIRST_ROW)
-    sheet.sheet_view.selection[0].activeCell = select
-    sheet.sheet_view.selection[0].sqref = select
+    for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
+        cells = {}
+        for col_num, fmla, si in columns:
+            c = WriteOnlyCell(sheet)
+            _set_calc_formula(
+                sheet, c, col_num, i, fmla, si, data_num_rows)
+            cells[col_num] = c
+        append_streaming_row(sheet, i, cells)
+        # row already written, don't keep it around
+        sheet.formula_attributes.clear()
+
+
+def _write_choices_sheet(sheet, key_lists):
+    """
+    Stream the hidden sheet of sorted choice keys to write-only
+    worksheet sheet, equivalent to _populate_choices_sheet
+    """
+    for row in xrange(max(len(keys) for keys in key_lists)):
+        sheet.append([
+            keys[row] if row < len(keys) else None for keys in key_lists])
 
-    return cranges
+
+def streaming_cell(sheet, value, style):
+    """
+    return a WriteOnlyCell for write-only worksheet sheet, like fill_cell
+
+    :param value: value to store (unicode, int, date, ..)
+    :param style: style name as string or dict for apply_style
+    """
+    if isinstance(value, basestring):
+        value = value.replace(u'\n', u'\r\n')
+    c = WriteOnlyCell(sheet, value)
+    if isinstance(style, basestring):
+        c.style = style
+    else:
+        apply_style(c, style)
+    return c
+
+
+def append_streaming_row(sheet, row, cells, height=None, style=None,
+        hidden=False):
+    """
+    append the next row to write-only worksheet sheet
+
+    :param row: 1-based number of the row being appended
+    :param cells: dict of {column number: value or WriteOnlyCell}
+    :param height: row height or None
+    :param style: row style dict for apply_style or None
+    :param hidden: True to hide this row
+    """
+    dim = None
+    if height or style or hidden:
+        dim = sheet.row_dimensions[row]
+        if height:
+            dim.height = height
+        if style:
+            apply_style(dim, style)
+        if hidden:
+            dim.hidden = True
+
+    sheet.append([cells.get(n) for n in xrange(1, max(cells or [0]) + 1)])
+    if dim is not None:
+        # row already written, don't keep it around
+        del sheet.row_dimensions[row]
 
 
 def _append_field_ref_rows(refs, field, link):
@@ -568,8 +1265,6 @@ def _append_field_choices_rows(refs, choices, full_text_choices):
     return estimate_width_from_length(max_length)
 
 def _populate_reference_sheet(sheet, geno, refs):
-    field_count = 1
-
     header1_style = dict(DEFAULT_HEADER_STYLE, **geno.get('excel_header_style', {}))
     header2_style = dict(DEFAULT_REF_HEADER2_STYLE, **geno.get('excel_header_style', {}))
     fill_cell(
@@ -591,55 +1286,29 @@ def _populate_reference_sheet(sheet, geno, refs):
     sheet.row_dimensions[REF_HEADER1_ROW].height = REF_HEADER1_HEIGHT
     sheet.row_dimensions[REF_HEADER2_ROW].height = REF_HEADER2_HEIGHT
 
+    for ref in _reference_sheet_rows(refs):
+        row_number = ref['row']
+        for cnum, cval in enumerate(ref['values'], REF_KEY_COL_NUM):
+            sheet.cell(row=row_number, column=cnum).value = cval
 
-    for row_number, (style, ref_line) in enumerate(refs, REF_FIRST_ROW - 1):
-        link = None
-        if len(ref_line) == 2:
-            value = wrap_text_to_width(ref_line[1], REF_VALUE_WIDTH).strip()
-            ref_line = [ref_line[0], value]
-        elif len(ref_line) == 1 and isinstance(ref_line[0], tuple):
-            link, value = ref_line[0]
-            value = value.strip()
-            ref_line = [value]
-
-        for cnum, cval in enumerate(ref_line, REF_KEY_COL_NUM):
-            sheet.cell(row=row_number, column=cnum).value = (
-                cval.strip().replace('\n', '\r\n'))
-
-        if len(ref_line) == 2:
-            sheet.row_dimensions[row_number].height = LINE_HEIGHT + (
-                value.count('\n') * LINE_HEIGHT)
-
-        key_cell = sheet.cell(row=row_number, column=REF_KEY_COL_NUM)
-        value_cell = sheet.cell(row=row_number, column=REF_VALUE_COL_NUM)
+        if ref['height']:
+            sheet.row_dimensions[row_number].height = ref['height']
 
-        if style == 'title':
+        if ref['field_number']:
             sheet.merge_cells(REF_FIELD_NUM_MERGE.format(row=row_number))
             sheet.merge_cells(REF_FIELD_TITLE_MERGE.format(row=row_number))
             fill_cell(
                 sheet,
                 row_number,
                 REF_FIELD_NUM_COL_NUM,
-                field_count,
+                ref['field_number'],
                 'reco_ref_number')
             title_cell = sheet.cell(row=row_number, column=REF_KEY_COL_NUM)
-            if link:
-                title_cell.hyperlink = link
-            title_cell.style = 'reco_ref_title'
-            sheet.row_dimensions[row_number].height = REF_FIELD_TITLE_HEIGHT
-            field_count += 1
-        elif style == 'choice':
-            pad_cell = sheet.cell(row=row_number, column=REF_KEY_COL_NUM - 1)
-            pad_cell.style = 'reco_example'
-            key_cell.style = 'reco_example'
-            value_cell.style = 'reco_example'
-        elif style == 'attr':
-            key_cell.style = 'reco_ref_attr'
-            value_cell.style = 'reco_ref_value'
-        elif style == 'choice heading':
-            key_cell.style = 'reco_ref_attr'
-            value_cell.style = 'reco_ref_value'
-            sheet.row_dimensions[row_number].height = REF_CHOICE_HEADING_HEIGHT
+            if ref['link']:
+                title_cell.hyperlink = ref['link']
+
+        for cnum, cstyle in ref['styles']:
+            sheet.cell(row=row_number, column=cnum).style = cstyle
 
         apply_style(sheet.row_dimensions[row_number], REF_PAPER_STYLE)
 
@@ -650,7 +1319,60 @@ def _populate_reference_sheet(sheet, geno, refs):
     sheet.column_dimensions[REF_VALUE_COL].width = REF_VALUE_WIDTH
 
 
-def _populate_excel_e_sheet(sheet, chromo, cranges):
+def _reference_sheet_rows(refs):
+    """
+    Generate the rows of the reference sheet below the headers
+    from refs, in row order.
+
+    yields dicts with row number, cell values starting at REF_KEY_COL,
+    row height (or None), cell styles as [(column, style name)],
+    title link and field number (for field title rows)
+    """
+    field_count = 1
+
+    for row_number, (style, ref_line) in enumerate(refs, REF_FIRST_ROW - 1):
+        link = None
+        height = None
+        field_number = None
+        styles = []
+        if len(ref_line) == 2:
+            value = wrap_text_to_width(ref_line[1], REF_VALUE_WIDTH).strip()
+            ref_line = [ref_line[0], value]
+            height = LINE_HEIGHT + (value.count('\n') * LINE_HEIGHT)
+        elif len(ref_line) == 1 and isinstance(ref_line[0], tuple):
+            link, value = ref_line[0]
+            value = value.strip()
+            ref_line = [value]
+
+        if style == 'title':
+            styles = [(REF_KEY_COL_NUM, 'reco_ref_title')]
+            height = REF_FIELD_TITLE_HEIGHT
+            field_number = field_count
+            field_count += 1
+        elif style == 'choice':
+            styles = [
+                (REF_KEY_COL_NUM - 1, 'reco_example'),
+                (REF_KEY_COL_NUM, 'reco_example'),
+                (REF_VALUE_COL_NUM, 'reco_example')]
+        elif style in ('attr', 'choice heading'):
+            styles = [
+                (REF_KEY_COL_NUM, 'reco_ref_attr'),
+                (REF_VALUE_COL_NUM, 'reco_ref_value')]
+            if style == 'choice heading':
+                height = REF_CHOICE_HEADING_HEIGHT
+
+        yield {
+            'row': row_number,
+            'values': [
+                cval.strip().replace('\n', '\r\n') for cval in ref_line],
+            'height': height,
+            'styles': styles,
+            'link': link,
+            'field_number': field_number,
+            }
+
+
+def _populate_excel_e_sheet(sheet, chromo, cranges, sorted_ranges=None):
     """
     Populate the "error" calculation excel worksheet
 
@@ -660,13 +1382,47 @@ def _populate_excel_e_sheet(sheet, chromo, cranges):
     Other cells are 1 for error, 0 or blank for no error or no value
     in the corresponding cell on the data entry sheet.
     """
-    col = None
     data_num_rows = chromo.get('excel_data_num_rows', DEFAULT_DATA_NUM_ROWS)
+    formulas = _excel_e_formulas(chromo, cranges, sorted_ranges)
+
+    for col_num, fmla in formulas:
+        sheet.cell(row=CSTATUS_ROW, column=col_num).value = (
+            _column_status_formula(col_num, data_num_rows))
 
-    for col_num, field in template_cols_fields(chromo):
-        pk_field = field['datastore_id'] in chromo['datastore_primary_key']
+    if not formulas:
+        return  # no errors to report on!
+
+    _fill_calc_formulas(sheet, formulas + [(
+        RSTATUS_COL_NUM,
+        _calc_row_status_formula(formulas[-1][0], '{num}'))]
+        + _excel_e_key_formulas(chromo),
+        data_num_rows)
+
+
+def _excel_e_formulas(
+        chromo, cranges, sorted_ranges=None, data_ref=None, calc_ref=None):
+    """
+    return [(col_num, formula)] for the "error" calculation worksheet
+    where formula contains {num} to be replaced with the row number
+
+    cranges - {datastore_id: reference_key_range}
+    sorted_ranges - {datastore_id: sorted_key_range} for choice fields
+        validated with a binary search, from _sorted_choice_ranges
+    data_ref, calc_ref - functions returning the reference to a data
+        entry or calculation sheet column for the current row,
+        default _sheet_cell_ref(chromo) and _calc_cell_ref
+    """
+    formulas = []
+    sorted_ranges = sorted_ranges or {}
+    schema = resource_schema(chromo)
+    data_ref = data_ref or _sheet_cell_ref(chromo)
+    calc_ref = calc_ref or _calc_cell_ref
+
+    for col_num, field in template_cols_fields(schema):
+        pk_field = field['datastore_id'] in schema.primary_key_set
 
         crange = cranges.get(field['datastore_id'])
+        srange = sorted_ranges.get(field['datastore_id'])
         fmla = None
         if field['datastore_type'] == 'date':
             fmla = 'NOT(ISNUMBER({cell}+0))'
@@ -691,14 +1447,23 @@ def _populate_excel_e_sheet(sheet, chromo, cranges):
                 'LEN(SUBSTITUTE({{cell}}," ",""))+1-SUMPRODUCT(--ISNUMBER('
                 'SEARCH(","&{r}&",",SUBSTITUTE(","&{{cell}}&","," ",""))),'
                 'LEN({r})+1)').format(r=crange)
+            if srange:
+                fmla = _multi_choice_error_formula(srange, fmla)
         elif crange and field.get('excel_full_text_choices', False):
             # 'code:text'-style choices, accept 'code' and 'code:anything'
-            fmla = (
-                'COUNTIF({r},TRIM(LEFT({{cell}},FIND(":",{{cell}}&":")-1))&":*")=0'
-                ).format(r=crange)
+            if srange:
+                fmla = _choice_error_formula(
+                    srange, 'TRIM(LEFT({cell},FIND(":",{cell}&":")-1))')
+            else:
+                fmla = (
+                    'COUNTIF({r},TRIM(LEFT({{cell}},FIND(":",{{cell}}&":")-1))&":*")=0'
+                    ).format(r=crange)
         elif crange:
             # single choice
-            fmla = 'COUNTIF({r},TRIM({{cell}}))=0'.format(r=crange)
+            if srange:
+                fmla = _choice_error_formula(srange, 'TRIM({cell})')
+            else:
+                fmla = 'COUNTIF({r},TRIM({{cell}}))=0'.format(r=crange)
 
         user_fmla = field.get('excel_error_formula')
         if user_fmla:
@@ -712,15 +1477,7 @@ def _populate_excel_e_sheet(sheet, chromo, cranges):
 
         if pk_field:
             # repeated primary (composite) keys are errors
-            pk_fmla = 'SUMPRODUCT(' + ','.join(
-                "--(TRIM('{sheet}'!{col}{top}:{col}{{num}})"
-                "=TRIM('{sheet}'!{col}{{num}}))".format(
-                    sheet=chromo['resource_name'],
-                    col=get_column_letter(cn),
-                    top=DATA_FIRST_ROW)
-                for cn, f in template_cols_fields(chromo)
-                if f['datastore_id'] in chromo['datastore_primary_key']
-                ) +')>1'
+            pk_fmla = calc_ref(_e_key_col_num(schema) + 1)
             fmla = ('OR(' + fmla + ',' + pk_fmla + ')') if fmla else pk_fmla
 
         if not fmla:
@@ -729,46 +1486,164 @@ def _populate_excel_e_sheet(sheet, chromo, cranges):
         fmla_keys = set(
             key for (_i, key, _i, _i) in string.Formatter().parse(fmla)
             if key != 'cell' and key != 'default_formula')
-        if fmla_keys:
-            fmla_values = {
-                f['datastore_id']: "'{sheet}'!{col}{{num}}".format(
-                    sheet=chromo['resource_name'],
-                    col=get_column_letter(cn))
-                for cn, f in template_cols_fields(chromo)
-                if f['datastore_id'] in fmla_keys}
+        fmla_values = _template_cell_refs(schema, fmla_keys, data_ref)
 
-        col = get_column_letter(col_num)
-        cell = "'{sheet}'!{col}{{num}}".format(
-            sheet=chromo['resource_name'],
-            col=col)
+        cell = data_ref(col_num)
         fmla = '=NOT({cell}="")*(' + fmla + ')'
-        for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
-            try:
-                sheet.cell(row=i, column=col_num).value = fmla.format(
-                    cell=cell,
-                    num='{num}',
-                    **fmla_values).format(num=i)
-            except KeyError:
-                assert 0, (fmla, fmla_values)
+        try:
+            formulas.append((col_num, fmla.format(
+                cell=cell,
+                num='{num}',
+                **fmla_values)))
+        except KeyError:
+            assert 0, (fmla, fmla_values)
 
-        sheet.cell(row=CSTATUS_ROW, column=col_num).value = (
-            '=IFERROR(MATCH(TRUE,INDEX({col}{row1}:{col}{rowN}<>0,),)+{row0},0)'
-            .format(
-                col=col,
-                row1=DATA_FIRST_ROW,
-                row0=DATA_FIRST_ROW - 1,
-                rowN=DATA_FIRST_ROW + data_num_rows - 1))
+    return formulas
 
-    if col is None:
-        return  # no errors to report on!
 
-    for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
-        sheet.cell(row=i, column=RSTATUS_COL_NUM).value = (
-            '=IFERROR(MATCH(TRUE,INDEX({colA}{row}:{colZ}{row}<>0,),)+{col0},0)'.format(
-                colA=DATA_FIRST_COL,
-                col0=DATA_FIRST_COL_NUM - 1,
-                colZ=col,
-                row=i))
+def _choice_error_formula(srange, value):
+    """
+    return a formula that is TRUE when value is not one of the keys in
+    sorted key range srange, using an approximate MATCH (binary search)
+    """
+    return (
+        'IFERROR(INDEX(' + srange + ',MATCH(' + value + ',' + srange +
+        ',1))<>' + value + ',TRUE)')
+
+
+def _multi_choice_error_formula(srange, default_formula):
+    """
+    return a formula that is TRUE when any of the comma-separated
+    values in {cell} is not one of the keys in sorted key range srange.
+
+    The first MULTI_CHOICE_TOKENS values are looked up individually,
+    longer lists use default_formula
+    """
+    text = 'SUBSTITUTE({cell}," ","")'
+    count = '(LEN(' + text + ')-LEN(SUBSTITUTE(' + text + ',",",""))+1)'
+    # pad separators to the length of the value so each token can be
+    # extracted with a fixed-width MID
+    padded = 'SUBSTITUTE(' + text + ',",",REPT(" ",LEN(' + text + ')))'
+    checks = []
+    for k in range(MULTI_CHOICE_TOKENS):
+        token = 'TRIM(MID({p},{k}*LEN({t})+1,LEN({t})))'.replace(
+            '{p}', padded).replace('{k}', str(k)).replace('{t}', text)
+        check = _choice_error_formula(srange, token)
+        if k:
+            check = 'IF({0}>{1},{2},FALSE)'.replace('{0}', count).replace(
+                '{1}', str(k)).replace('{2}', check)
+        checks.append(check)
+    return 'IF({0}>{1},{2},OR({3}))'.replace('{0}', count).replace(
+        '{1}', str(MULTI_CHOICE_TOKENS)).replace(
+        '{2}', default_formula).replace('{3}', ','.join(checks))
+
+
+def _sorted_choice_ranges(geno):
+    """
+    Choice fields with long lists of keys are validated with a binary
+    search over the keys sorted the way Excel compares text, stored
+    on the hidden choices sheet. Only keys of letters, digits and
+    single spaces are used because Excel's collation of other
+    characters differs from a simple sort.
+
+    return (sorted_ranges, key_lists) where sorted_ranges is
+    {resource_name: {datastore_id: sorted_key_range}} and key_lists
+    is the sorted keys for each column of the choices sheet
+    """
+    sorted_ranges = {}
+    key_lists = []
+    for chromo in geno['resources']:
+        template_index = resource_schema(chromo).template_index
+        for f in recombinant_choice_fields(chromo['resource_name']):
+            if f['datastore_id'] not in template_index:
+                continue
+            keys = [unicode(k) for k, _v in f['choices']]
+            if len(keys) < SORTED_CHOICES_MIN or not all(
+                    SORTED_CHOICE_KEY_RE.match(k) for k in keys):
+                continue
+            key_lists.append(sorted(keys, key=lambda k: k.lower()))
+            sorted_ranges.setdefault(chromo['resource_name'], {})[
+                f['datastore_id']] = '{sheet}!${col}$1:${col}${rowN}'.format(
+                    sheet=CHOICES_SHEET,
+                    col=get_column_letter(len(key_lists)),
+                    rowN=len(keys))
+    return sorted_ranges, key_lists
+
+
+def _populate_choices_sheet(sheet, key_lists):
+    """
+    Populate the hidden sheet of sorted choice keys, one column per list
+    """
+    for col_num, keys in enumerate(key_lists, 1):
+        for row, key in enumerate(keys, 1):
+            sheet.cell(row=row, column=col_num).value = key
+
+
+def _e_key_col_num(chromo):
+    """
+    return the column number of the first helper column after the
+    template columns on the "error" calculation worksheet
+    """
+    return DATA_FIRST_COL_NUM + len(resource_schema(chromo).template_fields)
+
+
+def _excel_e_key_formulas(chromo):
+    """
+    return [(col_num, formula)] for the helper columns used to find
+    repeated primary keys on the "error" calculation worksheet:
+
+    key column - trimmed primary key values joined with CHAR(31)
+    duplicate column - TRUE when the key appears on an earlier row
+
+    Every row uses an exact MATCH against the same key range so Excel
+    can reuse its lookup index, instead of comparing with all the rows
+    above (quadratic on recalculation). Keys too long for MATCH are
+    compared with the rows above.
+    """
+    schema = resource_schema(chromo)
+    pk_cols = [
+        get_column_letter(cn) for cn, f in template_cols_fields(schema)
+        if f['datastore_id'] in schema.primary_key_set]
+    if not pk_cols:
+        return []
+
+    data_num_rows = chromo.get('excel_data_num_rows', DEFAULT_DATA_NUM_ROWS)
+    key_col_num = _e_key_col_num(schema)
+    key_col = get_column_letter(key_col_num)
+    key_fmla = '=' + '&CHAR(31)&'.join(
+        "TRIM('{sheet}'!{col}{{num}})".format(
+            sheet=chromo['resource_name'], col=col)
+        for col in pk_cols)
+    dup_fmla = _duplicate_key_formula(
+        key_col + '{num}',
+        '{key}${row1}:{key}{{num}}'.format(key=key_col, row1=DATA_FIRST_ROW),
+        '{key}${row1}:{key}${rowN}'.format(
+            key=key_col,
+            row1=DATA_FIRST_ROW,
+            rowN=DATA_FIRST_ROW + data_num_rows - 1))
+    return [(key_col_num, key_fmla), (key_col_num + 1, dup_fmla)]
+
+
+def _duplicate_key_formula(key, keys_above, keys):
+    """
+    return a formula that is TRUE when key appears in keys on an
+    earlier row
+
+    keys_above - range from the first key to key
+    keys - range of all the keys, starting on DATA_FIRST_ROW
+    """
+    return (
+        '=IFERROR(IF(LEN({key})>255,'
+            'SUMPRODUCT(--({above}={key}))>1,'
+            # escape wildcards in the lookup value
+            'MATCH(SUBSTITUTE(SUBSTITUTE(SUBSTITUTE('
+                '{key},"~","~~"),"*","~*"),"?","~?"),'
+                '{keys},0)<ROW()-{row0}),FALSE)'
+        ).format(
+            key=key,
+            above=keys_above,
+            keys=keys,
+            row0=DATA_FIRST_ROW - 1)
 
 
 def _populate_excel_r_sheet(sheet, chromo):
@@ -784,12 +1659,38 @@ def _populate_excel_r_sheet(sheet, chromo):
     no value or not required fields in the corresponding cell on the
     data entry sheet
     """
-    col = None
     data_num_rows = chromo.get('excel_data_num_rows', DEFAULT_DATA_NUM_ROWS)
+    formulas = _excel_r_formulas(chromo)
+
+    for col_num, fmla in formulas:
+        sheet.cell(row=CSTATUS_ROW, column=col_num).value = (
+            _column_status_formula(col_num, data_num_rows))
+
+    if not formulas:
+        return  # no required columns
+
+    _fill_calc_formulas(sheet, formulas + [
+        (RPAD_COL_NUM, _has_data_formula(chromo, formulas[-1][0], '{num}')),
+        (RSTATUS_COL_NUM,
+            _calc_row_status_formula(formulas[-1][0], '{num}'))],
+        data_num_rows)
+
+
+def _excel_r_formulas(chromo, data_ref=None, calc_ref=None):
+    """
+    return [(col_num, formula)] for the "required" calculation worksheet
+    where formula contains {num} to be replaced with the row number
 
-    for col_num, field in template_cols_fields(chromo):
+    data_ref, calc_ref - as for _excel_e_formulas
+    """
+    formulas = []
+    schema = resource_schema(chromo)
+    data_ref = data_ref or _sheet_cell_ref(chromo)
+    calc_ref = calc_ref or _calc_cell_ref
+
+    for col_num, field in template_cols_fields(schema):
         fmla = field.get('excel_required_formula')
-        pk_field = field['datastore_id'] in chromo['datastore_primary_key']
+        pk_field = field['datastore_id'] in schema.primary_key_set
 
         if fmla:
             fmla = '={has_data}*({cell}="")*(' + fmla +')'
@@ -798,56 +1699,246 @@ def _populate_excel_r_sheet(sheet, chromo):
         else:
             continue
 
-        col = get_column_letter(col_num)
-        cell = "'{sheet}'!{col}{{num}}".format(
-            sheet=chromo['resource_name'],
-            col=col)
+        cell = data_ref(col_num)
 
         fmla_keys = set(
             key for (_i, key, _i, _i) in string.Formatter().parse(fmla)
             if key != 'cell' and key != 'has_data')
-        fmla_values = {}
-        if fmla_keys:
-            fmla_values = {
-                f['datastore_id']: "'{sheet}'!{col}{{num}}".format(
-                    sheet=chromo['resource_name'],
-                    col=get_column_letter(cn))
-                for cn, f in template_cols_fields(chromo)
-                if f['datastore_id'] in fmla_keys}
+        fmla_values = _template_cell_refs(schema, fmla_keys, data_ref)
+
+        formulas.append((col_num, fmla.format(
+            cell=cell,
+            has_data=calc_ref(RPAD_COL_NUM),
+            num='{num}',
+            **fmla_values)))
+
+    return formulas
+
+
+def _excel_table_columns(chromo, cranges, sorted_ranges, table):
+    """
+    return (names, formulas) for the v4 data entry table, names is the
+    list of table column names starting with column A and formulas is
+    {col_num: formula} for the calculated columns
+
+    The template columns are followed by hidden "error" and "required"
+    columns in the same order, with the checks from the v3 e/r sheets,
+    then the row status, has data and primary key helper columns.
+    """
+    schema = resource_schema(chromo)
+    fields = schema.template_fields
+    count = len(fields)
+    pk_cols = [
+        cn for cn, f in template_cols_fields(schema)
+        if f['datastore_id'] in schema.primary_key_set]
+    names = [u'~status', u'~type here'] + [
+        f['datastore_id'] for f in fields] + [
+        u'~e ' + f['datastore_id'] for f in fields] + [
+        u'~r ' + f['datastore_id'] for f in fields] + [
+        u'~error', u'~required', u'~has data']
+    if pk_cols:
+        names.extend([u'~key', u'~duplicate'])
+    error_col = DATA_FIRST_COL_NUM + 3 * count
+
+    def this_row(col_num):
+        return _table_column_ref(table, names[col_num - 1], True)
+
+    def this_row_span(col_num):
+        return u'{0}[[#This Row],[{1}]:[{2}]]'.format(
+            table,
+            _table_name_escape(names[col_num - 1]),
+            _table_name_escape(names[col_num + count - 2]))
+
+    calc_cols = {
+        RPAD_COL_NUM: error_col + 2,
+        _e_key_col_num(schema) + 1: error_col + 4,
+        }
+
+    def calc_ref(col_num):
+        return this_row(calc_cols[col_num])
+
+    formulas = {}
+    for col_num, fmla in _excel_e_formulas(
+            schema, cranges, sorted_ranges, this_row, calc_ref):
+        formulas[col_num + count] = _table_row_formula(schema, fmla)
+    for col_num, fmla in _excel_r_formulas(schema, this_row, calc_ref):
+        formulas[col_num + 2 * count] = _table_row_formula(schema, fmla)
+
+    for col_num, first in (
+            (error_col, DATA_FIRST_COL_NUM + count),
+            (error_col + 1, DATA_FIRST_COL_NUM + 2 * count)):
+        formulas[col_num] = (
+            '=IFERROR(MATCH(TRUE,INDEX({span}<>0,),)+{col0},0)'.format(
+                span=this_row_span(first),
+                col0=DATA_FIRST_COL_NUM - 1))
+    formulas[error_col + 2] = '=SUMPRODUCT(LEN({span}))>0'.format(
+        span=this_row_span(DATA_FIRST_COL_NUM))
+    formulas[RSTATUS_COL_NUM] = (
+        '=IF({e}>0,HYPERLINK("#"&ADDRESS(ROW(),{e}),""),'
+        'IF({r}>0,HYPERLINK("#"&ADDRESS(ROW(),{r}),""),""))'.format(
+            e=this_row(error_col), r=this_row(error_col + 1)))
+    formulas[RPAD_COL_NUM] = u'=IF({0},"","▶")'.format(
+        this_row(error_col + 2))
+
+    if pk_cols:
+        formulas[error_col + 3] = '=' + '&CHAR(31)&'.join(
+            'TRIM({0})'.format(this_row(cn)) for cn in pk_cols)
+        keys = _table_column_ref(table, names[error_col + 2])
+        formulas[error_col + 4] = _duplicate_key_formula(
+            this_row(error_col + 3),
+            u'INDEX({0},1):{1}'.format(keys, this_row(error_col + 3)),
+            keys)
+    return names, formulas
+
+
+def _table_row_formula(chromo, fmla):
+    """
+    return calculation sheet formula fmla for a v4 calculated column,
+    with {num} used as a row number replaced by ROW(). A reference like
+    C{num} is to a calculation sheet column, which v4 templates don't
+    have, so it raises RecombinantException.
+    """
+    if re.search(r'[A-Za-z$]\{num\}', fmla):
+        raise RecombinantException(
+            '{0}: formulas for template_version 4 can only use {{num}} '
+            'as a row number: {1}'.format(chromo['resource_name'], fmla))
+    return fmla.replace('{num}', 'ROW()')
+
+
+def _table_column_ref(table, name, this_row=False):
+    """
+    return a structured reference to table column name, or to its cell
+    on the current row
+    """
+    if this_row:
+        return u'{0}[[#This Row],[{1}]]'.format(
+            table, _table_name_escape(name))
+    return u'{0}[[{1}]]'.format(table, _table_name_escape(name))
+
+
+def _table_name_escape(name):
+    return re.sub(r"([\[\]#'])", r"'\1", name)
 
+
+def _sheet_cell_ref(chromo):
+    """
+    return a function giving the reference to a data entry sheet
+    column on row {num} from the calculation sheets
+    """
+    def data_ref(col_num):
+        return "'{sheet}'!{col}{{num}}".format(
+            sheet=chromo['resource_name'],
+            col=get_column_letter(col_num))
+    return data_ref
+
+
+def _calc_cell_ref(col_num):
+    """
+    return the reference to a calculation sheet column on row {num}
+    """
+    return get_column_letter(col_num) + '{num}'
+
+
+def _column_status_formula(col_num, data_num_rows):
+    return (
+        '=IFERROR(MATCH(TRUE,INDEX({col}{row1}:{col}{rowN}<>0,),)+{row0},0)'
+        .format(
+            col=get_column_letter(col_num),
+            row1=DATA_FIRST_ROW,
+            row0=DATA_FIRST_ROW - 1,
+            rowN=DATA_FIRST_ROW + data_num_rows - 1))
+
+
+def _calc_row_status_formula(last_col_num, row):
+    return (
+        '=IFERROR(MATCH(TRUE,INDEX({colA}{row}:{colZ}{row}<>0,),)+{col0},0)'
+        .format(
+            colA=DATA_FIRST_COL,
+            col0=DATA_FIRST_COL_NUM - 1,
+            colZ=get_column_letter(last_col_num),
+            row=row))
+
+
+def _has_data_formula(chromo, last_col_num, row):
+    return "=SUMPRODUCT(LEN('{sheet}'!{colA}{row}:{colZ}{row}))>0".format(
+        sheet=chromo['resource_name'],
+        colA=DATA_FIRST_COL,
+        colZ=get_column_letter(last_col_num),
+        row=row)
+
+
+def _fill_calc_formulas(sheet, formulas, data_num_rows):
+    """
+    fill the data rows of a calculation sheet with [(col_num, formula)]
+    where formula contains {num} to be replaced with the row number
+    """
+    for col_num, fmla, si in _calc_formula_columns(formulas, data_num_rows):
         for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
-            sheet.cell(row=i, column=col_num).value = fmla.format(
-                cell=cell,
-                has_data='{col}{{num}}'.format(col=RPAD_COL),
-                **fmla_values).format(num=i)
+            _set_calc_formula(
+                sheet,
+                sheet.cell(row=i, column=col_num),
+                col_num,
+                i,
+                fmla,
+                si,
+                data_num_rows)
 
-        sheet.cell(row=CSTATUS_ROW, column=col_num).value = (
-            '=IFERROR(MATCH(TRUE,INDEX({col}{row1}:{col}{rowN}<>0,),)+{row0},0)'
-            .format(
-                col=col,
-                row1=DATA_FIRST_ROW,
-                row0=DATA_FIRST_ROW - 1,
-                rowN=DATA_FIRST_ROW + data_num_rows - 1))
 
-    if col is None:
-        return  # no required columns
+def _calc_formula_columns(formulas, data_num_rows):
+    """
+    return [(col_num, formula, si)] for [(col_num, formula)] where si
+    is the shared formula index for the column or None when the formula
+    can't be stored as a shared formula.
+
+    A shared formula is stored once in the first data row and
+    Excel adjusts its relative references for the rows below, so it
+    can only be used when that gives the same formulas we would
+    otherwise write for each row (e.g. not for user formulas that
+    use {num} as a number or unanchored references to other cells).
+    """
+    columns = []
+    si = 0
+    for col_num, fmla in formulas:
+        col = get_column_letter(col_num)
+        master = Translator(
+            fmla.format(num=DATA_FIRST_ROW),
+            col + str(DATA_FIRST_ROW))
+        for i in (DATA_FIRST_ROW + 1, DATA_FIRST_ROW + data_num_rows - 1):
+            if master.translate_formula(col + str(i)) != fmla.format(num=i):
+                columns.append((col_num, fmla, None))
+                break
+        else:
+            columns.append((col_num, fmla, si))
+            si += 1
+    return columns
 
-    for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
-        sheet.cell(row=i, column=RPAD_COL_NUM).value = (
-            "=SUMPRODUCT(LEN('{sheet}'!{colA}{row}:{colZ}{row}))>0".format(
-                sheet=chromo['resource_name'],
-                colA=DATA_FIRST_COL,
-                colZ=col,
-                row=i))
 
-    for i in xrange(DATA_FIRST_ROW, DATA_FIRST_ROW + data_num_rows):
-        sheet.cell(row=i, column=RSTATUS_COL_NUM).value = (
-            '=IFERROR(MATCH(TRUE,INDEX({colA}{row}:{colZ}{row}<>0,),)+{col0},0)'
-            .format(
-                colA=DATA_FIRST_COL,
-                col0=DATA_FIRST_COL_NUM - 1,
-                colZ=col,
-                row=i))
+def _set_calc_formula(sheet, cell, col_num, row, fmla, si, data_num_rows):
+    """
+    set cell in a data row of a calculation sheet to formula fmla,
+    stored as shared formula si unless si is None
+    """
+    if si is None:
+        cell.value = fmla.format(num=row)
+        return
+
+    col = get_column_letter(col_num)
+    if row == DATA_FIRST_ROW:
+        cell.value = fmla.format(num=row)
+        sheet.formula_attributes[col + str(row)] = {
+            't': 'shared',
+            'ref': '{col}{row1}:{col}{rowN}'.format(
+                col=col,
+                row1=DATA_FIRST_ROW,
+                rowN=DATA_FIRST_ROW + data_num_rows - 1),
+            'si': str(si)}
+    else:
+        # no formula text, Excel uses the master formula
+        cell.value = '='
+        cell.data_type = 'f'
+        sheet.formula_attributes[col + str(row)] = {
+            't': 'shared',
+            'si': str(si)}
 
 def fill_cell(sheet, row, column, value, style):
     """
@@ -915,8 +2006,17 @@ def org_title_lang_hack(title):
 def template_cols_fields(chromo):
     ''' (col_num, field) ... for fields in template'''
     return enumerate(
-        (f for f in chromo['fields'] if f.get(
-            'import_template_include', True)), DATA_FIRST_COL_NUM)
+        resource_schema(chromo).template_fields, DATA_FIRST_COL_NUM)
+
+
+def _template_cell_refs(schema, datastore_ids, data_ref):
+    '''
+    {datastore_id: data_ref(col_num)} for the template fields in
+    datastore_ids, used to fill in user formula references
+    '''
+    return dict(
+        (fid, data_ref(DATA_FIRST_COL_NUM + schema.template_index[fid]))
+        for fid in datastore_ids if fid in schema.template_index)
 
 def _add_conditional_formatting(
         sheet, col_letter, resource_num, error_style, required_style,
@@ -924,55 +2024,100 @@ def _add_conditional_formatting(
     '''
     Error and required cell hilighting based on e/r sheets
     '''
-    error_fill = openpyxl.styles.PatternFill(
-        bgColor=error_style['PatternFill']['fgColor'],
-        **error_style['PatternFill'])
-    error_font = openpyxl.styles.Font(**error_style['Font'])
-    required_fill = openpyxl.styles.PatternFill(
-        bgColor=required_style['PatternFill']['fgColor'],
-        **required_style['PatternFill'])
-    required_font = openpyxl.styles.Font(**required_style['Font'])
-
     sheet.conditional_formatting.add(
         '{col}{row1}:{col}{rowN}'.format(
             col=RSTATUS_COL,
             row1=DATA_FIRST_ROW,
             rowN=DATA_FIRST_ROW + data_num_rows - 1),
-        FormulaRule([
+        _highlight_rule(
             'AND(e{rnum}!{colA}{row1}=0,r{rnum}!{colA}{row1}>0)'.format(
                 rnum=resource_num,
                 colA=RSTATUS_COL,
-                row1=DATA_FIRST_ROW)],
-        stopIfTrue=True,
-        fill=required_fill,
-        font=required_font))
+                row1=DATA_FIRST_ROW),
+            required_style))
     sheet.conditional_formatting.add(
         '{colA}{row1}:{colZ}{rowN}'.format(
             colA=RSTATUS_COL,
             row1=CSTATUS_ROW,
             colZ=col_letter,
             rowN=DATA_FIRST_ROW + data_num_rows - 1),
-        FormulaRule([
+        _highlight_rule(
             'AND(ISNUMBER(e{rnum}!{colA}{row1}),'
             'e{rnum}!{colA}{row1}>0)'.format(
                 rnum=resource_num,
                 colA=RSTATUS_COL,
-                row1=CSTATUS_ROW)],
-        stopIfTrue=True,
-        fill=error_fill,
-        font=error_font))
+                row1=CSTATUS_ROW),
+            error_style))
     sheet.conditional_formatting.add(
         '{colA}{row1}:{colZ}{rowN}'.format(
             colA=DATA_FIRST_COL,
             row1=CSTATUS_ROW,
             colZ=col_letter,
             rowN=DATA_FIRST_ROW + data_num_rows - 1),
-        FormulaRule([
+        _highlight_rule(
             'AND(ISNUMBER(r{rnum}!{colA}{row1}),'
             'e{rnum}!{colA}{row1}=0,r{rnum}!{colA}{row1}>0)'.format(
                 rnum=resource_num,
                 colA=DATA_FIRST_COL,
-                row1=CSTATUS_ROW)],
+                row1=CSTATUS_ROW),
+            required_style))
+
+
+def _add_table_conditional_formatting(
+        sheet, count, error_style, required_style):
+    '''
+    Error and required cell hilighting based on the calculated columns
+    of a v4 data entry table with count template columns
+    '''
+    e_col = get_column_letter(DATA_FIRST_COL_NUM + count)
+    r_col = get_column_letter(DATA_FIRST_COL_NUM + 2 * count)
+    error_col = get_column_letter(DATA_FIRST_COL_NUM + 3 * count)
+    required_col = get_column_letter(DATA_FIRST_COL_NUM + 3 * count + 1)
+
+    sheet.conditional_formatting.add(
+        '{col}{row1}:{col}{rowN}'.format(
+            col=RSTATUS_COL, row1=DATA_FIRST_ROW, rowN=SHEET_MAX_ROW),
+        _highlight_rule(
+            'AND(${e}{row1}=0,${r}{row1}>0)'.format(
+                e=error_col, r=required_col, row1=DATA_FIRST_ROW),
+            required_style))
+    sheet.conditional_formatting.add(
+        '{col}{row1}:{col}{rowN}'.format(
+            col=RSTATUS_COL, row1=DATA_FIRST_ROW, rowN=SHEET_MAX_ROW),
+        _highlight_rule(
+            '${e}{row1}>0'.format(e=error_col, row1=DATA_FIRST_ROW),
+            error_style))
+    sheet.conditional_formatting.add(
+        '{colA}{row1}:{colZ}{rowN}'.format(
+            colA=DATA_FIRST_COL,
+            row1=CSTATUS_ROW,
+            colZ=get_column_letter(DATA_FIRST_COL_NUM + count - 1),
+            rowN=SHEET_MAX_ROW),
+        _highlight_rule(
+            'AND(ISNUMBER({e}{row1}),{e}{row1}>0)'.format(
+                e=e_col, row1=CSTATUS_ROW),
+            error_style))
+    sheet.conditional_formatting.add(
+        '{colA}{row1}:{colZ}{rowN}'.format(
+            colA=DATA_FIRST_COL,
+            row1=CSTATUS_ROW,
+            colZ=get_column_letter(DATA_FIRST_COL_NUM + count - 1),
+            rowN=SHEET_MAX_ROW),
+        _highlight_rule(
+            'AND(ISNUMBER({r}{row1}),{e}{row1}=0,{r}{row1}>0)'.format(
+                e=e_col, r=r_col, row1=CSTATUS_ROW),
+            required_style))
+
+
+def _highlight_rule(formula, style):
+    '''
+    return a conditional formatting rule applying the fill and font
+    of style when formula is true
+    '''
+    return FormulaRule(
+        [formula],
         stopIfTrue=True,
-        fill=required_fill,
-        font=required_font))
+        fill=openpyxl.styles.PatternFill(
+            bgColor=style['PatternFill']['fgColor'],
+            **style['PatternFill']),
+        font=openpyxl.styles.Font(**style['Font']))
@@ -0,0 +1,78 @@
+"""
+Text replacement inside saved .xlsx files without rebuilding the workbook
+"""
+
+import struct
+import zipfile
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+
+def replace_in_parts(data, part_names, replacements):
+    """
+    return a copy of .xlsx file contents data with replacements applied
+    to the xml parts listed in part_names.
+
+    Other parts are copied as raw compressed bytes so the cost of
+    patching doesn't depend on the size of the rest of the workbook.
+
+    :param data: xlsx file contents
+    :type data: str
+    :param part_names: names of zip members to patch, e.g.
+        'xl/worksheets/sheet1.xml'
+    :type part_names: list of str
+    :param replacements: (placeholder, value) pairs, value is escaped
+        for xml before being inserted
+    :type replacements: list of (unicode, unicode) tuples
+
+    :return: patched xlsx file contents
+    :rtype: str
+    """
+    encoded = [
+        (old.encode('utf-8'), xml_text(new).encode('utf-8'))
+        for old, new in replacements]
+
+    src = zipfile.ZipFile(StringIO(data))
+    out = StringIO()
+    dst = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+    for info in src.infolist():
+        if info.filename in part_names:
+            xml = src.read(info)
+            for old, new in encoded:
+                xml = xml.replace(old, new)
+            dst.writestr(info, xml, zipfile.ZIP_DEFLATED)
+        elif info.flag_bits & 0x08:
+            # sizes stored in a trailing data descriptor, just recompress
+            dst.writestr(info, src.read(info))
+        else:
+            _copy_raw_member(src, info, dst)
+    dst.close()
+    return out.getvalue()
+
+
+def _copy_raw_member(src, info, dst):
+    """
+    copy compressed member info from zipfile src to dst as-is
+    """
+    src.fp.seek(info.header_offset)
+    fheader = struct.unpack(
+        zipfile.structFileHeader, src.fp.read(zipfile.sizeFileHeader))
+    src.fp.seek(
+        fheader[zipfile._FH_FILENAME_LENGTH] +
+        fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    raw = src.fp.read(info.compress_size)
+
+    info.header_offset = dst.fp.tell()
+    dst.fp.write(info.FileHeader())
+    dst.fp.write(raw)
+    dst.filelist.append(info)
+    dst.NameToInfo[info.filename] = info
+
+
+def xml_text(value):
+    """
+    return value as it would be stored in an xml text node by openpyxl
+    """
+    return escape(ILLEGAL_CHARACTERS_RE.sub(u'', value))